@@ -1,6 +1,7 @@
 from django.contrib import admin
 import settings
 import tracker.viewutil as viewutil
+import tracker.cacheutil as cacheutil
 import tracker.views as views
 import tracker.forms as forms
 import tracker.models
@@ -19,12 +20,12 @@ from django.utils.encoding import smart_unicode
 from django.utils.html import escape
 from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.contrib import messages
+from django.utils import timezone
 from django.shortcuts import render, redirect
 import django.forms as djforms
 import django.contrib.auth.models
 
 from datetime import *
-import time
 
 try:
 	import adminplus
@@ -42,7 +43,7 @@ def make_admin_ajax_field(model,model_fieldname,channel,show_help_text = False,*
 
 def latest_event_id():
   try:
-    return tracker.models.Event.objects.latest().id
+    return cacheutil.latest_event().id
   except tracker.models.Event.DoesNotExist:
     return 0
 
@@ -646,8 +647,8 @@ class EventAdmin(CustomModelAdmin):
       self.message_user(request, 'Only select one event for this action', level=messages.ERROR)
       return
     for event in queryset:
-      numRuns = viewutil.merge_schedule_gdoc(event)
-      self.message_user(request, "%d runs merged for %s." % (numRuns, event.name))
+      diff = viewutil.merge_schedule_gdoc(event)
+      self.message_user(request, "%d runs merged for %s (%d added, %d changed, %d removed)." % (len(diff), event.name, len(diff.inserts), len(diff.updates), len(diff.deletes)))
       viewutil.tracker_log(u'schedule', u'Merged schedule for event {0}'.format(event), event=event, user=request.user)
     for event in queryset:
       result = event.start_push_notification(request)
@@ -667,9 +668,9 @@ class PostbackURLAdmin(CustomModelAdmin):
   form = PostbackURLForm
   search_fields = ('url',)
   list_filter = ('event',)
-  list_display = ('url', 'event')
+  list_display = ('url', 'event', 'batch')
   fieldsets = [
-    (None, { 'fields': ['event', 'url'] })
+    (None, { 'fields': ['event', 'url', 'batch'] })
   ]
   def queryset(self, request):
     event = viewutil.get_selected_event(request)
@@ -734,17 +735,14 @@ class PrizeAdmin(CustomModelAdmin):
   def draw_prize_internal(self, request, queryset, limit):
     numDrawn = 0
     for prize in queryset:
-      if not limit:
-        limit = prize.maxwinners
-      drawingError = False
-      while not drawingError and len(prize.get_winners()) < limit:
-        drawn, msg = viewutil.draw_prize(prize)
-        time.sleep(1)
-        if not drawn:
-          self.message_user(request, msg, level=messages.ERROR)
-          drawingError = True
-        else:
-          numDrawn += 1
+      count = (limit or prize.maxwinners) - len(prize.get_winners())
+      if count <= 0:
+        continue
+      drawn, msg = viewutil.draw_prize(prize, count=count)
+      if not drawn:
+        self.message_user(request, msg, level=messages.ERROR)
+      else:
+        numDrawn += len(msg['winners'])
     if numDrawn > 0:
       self.message_user(request, "%d prizes drawn." % numDrawn)
   def draw_prize_once_action(self, request, queryset):
@@ -810,6 +808,38 @@ class SpeedRunAdmin(CustomModelAdmin):
       params['event'] = event.id
     return filters.run_model_query('run', params, user=request.user, mode='admin')
 
+class QueuedIPNAdmin(CustomModelAdmin):
+  search_fields = ['txn_id', 'query']
+  list_filter = ['state', 'payment_status']
+  list_display = ('txn_id', 'payment_status', 'received', 'state', 'attempts', 'donation')
+  raw_id_fields = ['donation']
+  readonly_fields = ['received', 'txn_id', 'payment_status', 'query', 'getquery', 'ipaddress', 'secure', 'claimed', 'lasterror']
+  fieldsets = [
+    (None, { 'fields': ['received', 'txn_id', 'payment_status', 'state', 'attempts', 'nextattempt', 'claimed', 'donation'] }),
+    ('Raw Data', { 'fields': ['query', 'getquery', 'ipaddress', 'secure', 'lasterror'] }),
+  ]
+  def retry_action(self, request, queryset):
+    count = queryset.filter(state='FAILED').update(state='PENDING', attempts=0, nextattempt=timezone.now())
+    self.message_user(request, "%d IPNs queued for another attempt." % count)
+  retry_action.short_description = "Retry failed IPNs"
+  actions = [retry_action]
+
+class PostbackDeliveryAdmin(CustomModelAdmin):
+  search_fields = ['postback__url', 'payload', 'error']
+  list_filter = ['state', 'postback__event']
+  list_display = ('postback', 'timestamp', 'state', 'statuscode', 'latency', 'donations', 'attempts')
+  readonly_fields = ['postback', 'timestamp', 'state', 'donations', 'payload', 'statuscode', 'latency', 'attempts', 'error']
+  fieldsets = [
+    (None, { 'fields': ['postback', 'timestamp', 'state', 'statuscode', 'latency', 'attempts', 'donations'] }),
+    ('Details', { 'fields': ['payload', 'error'] }),
+  ]
+  def queryset(self, request):
+    event = viewutil.get_selected_event(request)
+    if event:
+      return tracker.models.PostbackDelivery.objects.filter(postback__event=event)
+    else:
+      return tracker.models.PostbackDelivery.objects.all()
+
 class LogAdminForm(djforms.ModelForm):
   event = make_admin_ajax_field(tracker.models.SpeedRun, 'event', 'event', initial=latest_event_id)
   class Meta:
@@ -951,13 +981,11 @@ def draw_prize_winners(request):
   if request.method == 'POST':
     form = forms.DrawPrizeWinnersForm(prizes=prizes, data=request.POST)
     if form.is_valid():
+      result = viewutil.draw_prize_batch(form.cleaned_data['prizes'], seed=form.cleaned_data['seed'], user=request.user)
       for prize in form.cleaned_data['prizes']:
-        status = True
-        while status and not prize.maxed_winners():
-          status, data = viewutil.draw_prize(prize, seed=form.cleaned_data['seed'])
-          prize.error = data['error'] if not status else ''
+        prize.error = result['errors'].get(prize.id, '')
         logutil.change(request, prize, 'Prize Drawing')
-      return render(request, 'admin/draw_prize_winners_post.html', { 'prizes': form.cleaned_data['prizes'] })
+      return render(request, 'admin/draw_prize_winners_post.html', { 'prizes': form.cleaned_data['prizes'], 'seed': result['seed'] })
   else:
     form = forms.DrawPrizeWinnersForm(prizes=prizes)
   return render(request, 'admin/draw_prize_winners.html', { 'form': form })
@@ -1005,7 +1033,9 @@ admin.site.register(tracker.models.PrizeWinner, PrizeWinnerAdmin)
 admin.site.register(tracker.models.SpeedRun, SpeedRunAdmin)
 admin.site.register(tracker.models.UserProfile)
 admin.site.register(tracker.models.PostbackURL, PostbackURLAdmin)
+admin.site.register(tracker.models.PostbackDelivery, PostbackDeliveryAdmin)
 admin.site.register(tracker.models.Log, LogAdmin)
+admin.site.register(tracker.models.QueuedIPN, QueuedIPNAdmin)
 admin.site.register(tracker.models.DonorPrizeEntry, DonorPrizeEntryAdmin)
 admin.site.register(admin.models.LogEntry, AdminActionLogEntryAdmin)
 
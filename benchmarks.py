@@ -0,0 +1,220 @@
+from django.db import connection
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
+from django.test.client import RequestFactory
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.forms import AuthenticationForm
+from django.template import RequestContext
+import django
+import simplejson as json
+import datetime
+import platform
+import random
+import timeit
+import sys
+
+from tracker.models import *
+import tracker.filters as filters
+import tracker.viewutil as viewutil
+import tracker.views as views
+import tracker.querylog as querylog
+import tracker.randgen as randgen
+
+# Ad-hoc performance measurements for the tracker's hot paths. These are not
+# tests: they print numbers to compare before/after a change, and can be run
+# from 'manage.py shell' against any database.
+
+def legacy_general_filter(model, text, user=None):
+  # the way model_general_filter used to work, rebuilding everything on each call
+  fields = set()
+  model = filters.normalize_model_param(model)
+  fromModels = [model]
+  for key in filters._GeneralFields[model]:
+    fields |= set(filters.recurse_keys(key, fromModels=fromModels))
+  query = Q()
+  for field in fields:
+    query |= filters.build_general_query_piece(model, field, text, user=user)
+  return query
+
+def benchmark_search_plans(user=None, text='benchmark', repeat=200):
+  results = []
+  for model in sorted(filters._ModelMap):
+    if model not in filters._GeneralFields:
+      continue
+    Model = filters._ModelMap[model]
+    legacyTime = timeit.timeit(lambda: legacy_general_filter(model, text, user=user), number=repeat) / repeat
+    def cold():
+      filters._SearchPlans.clear()
+      filters.search_plan(model, user=user)
+    coldTime = timeit.timeit(cold, number=repeat) / repeat
+    planTime = timeit.timeit(lambda: filters.model_general_filter(model, text, user=user), number=repeat) / repeat
+    results.append({
+      'model': model,
+      'fields': len(filters.search_plan(model, user=user)),
+      'legacy_ms': legacyTime * 1000,
+      'plan_build_ms': coldTime * 1000,
+      'planned_ms': planTime * 1000,
+      'legacy_sql': len(str(Model.objects.filter(legacy_general_filter(model, text, user=user)).query)),
+      'planned_sql': len(str(Model.objects.filter(filters.model_general_filter(model, text, user=user)).query)),
+    })
+  return results
+
+# every feed apply_feed_filter knows about, by model
+FeedNames = {
+  'donation'      : [ 'recent', 'toprocess', 'toread' ],
+  'bid'           : [ 'open', 'closed', 'current', 'future', 'completed', 'suggested' ],
+  'run'           : [ 'current', 'future' ],
+  'prize'         : [ 'current', 'future', 'won', 'unwon', 'todraw' ],
+  'bidsuggestion' : [ 'expired' ],
+}
+
+# Runs every feed the way the search view does and counts the queries each one
+# takes to build and evaluate
+def count_feed_queries(params={}, user=None):
+  results = []
+  for model in sorted(FeedNames):
+    for feed in FeedNames[model]:
+      with CaptureQueriesContext(connection) as queries:
+        started = timeit.default_timer()
+        rows = len(list(filters.run_model_query(model, dict(params, feed=feed), user=user)))
+        elapsed = timeit.default_timer() - started
+      results.append({
+        'model': model,
+        'feed': feed,
+        'queries': len(queries),
+        'rows': rows,
+        'ms': elapsed * 1000,
+      })
+  return results
+
+def print_results(results, out=None):
+  out = out or sys.stdout
+  if not results:
+    return
+  columns = list(sorted(results[0].keys(), key=lambda k: (k != 'model', k)))
+  out.write('\t'.join(columns) + '\n')
+  for row in results:
+    out.write('\t'.join(('%.3f' % row[c]) if isinstance(row[c], float) else unicode(row[c]) for c in columns) + '\n')
+
+def legacy_page_context(request):
+  # what every tracker page used to do before rendering, for comparison
+  if request.user.is_authenticated():
+    try:
+      request.user.get_profile()
+    except UserProfile.DoesNotExist:
+      pass
+  RequestContext(request)
+  AuthenticationForm(request.POST)
+  list(Event.objects.all())
+
+# The fixed cost of a tracker page before its template is rendered, the old way
+# and through views.page_context (after a warm-up call, as on a busy server)
+def benchmark_page_overhead(user=None, repeat=200):
+  factory = RequestFactory()
+  def make_request():
+    request = factory.get('/')
+    request.user = user or AnonymousUser()
+    return request
+  def current():
+    context = {}
+    views.page_context(make_request(), context)
+    # the nav always walks the events
+    list(context['events'])
+  results = []
+  for name, run in [('legacy', lambda: legacy_page_context(make_request())), ('current', current)]:
+    run()
+    with CaptureQueriesContext(connection) as queries:
+      run()
+    results.append({
+      'context': name,
+      'queries': len(queries),
+      'ms': timeit.timeit(run, number=repeat) / repeat * 1000,
+    })
+  return results
+
+# Data set sizes for benchmark_scales, the largest being about what a big
+# marathon ends up with
+Scales = {
+  'small'  : { 'numDonors': 200,   'numDonations': 2000,   'numRuns': 20,  'numBids': 20,  'numPrizes': 10 },
+  'medium' : { 'numDonors': 2000,  'numDonations': 20000,  'numRuns': 80,  'numBids': 100, 'numPrizes': 40 },
+  'large'  : { 'numDonors': 20000, 'numDonations': 200000, 'numRuns': 150, 'numBids': 500, 'numPrizes': 100 },
+}
+ScaleOrder = [ 'small', 'medium', 'large' ]
+
+def _public_request(factory, method, path, data={}):
+  request = getattr(factory, method)(path, data)
+  request.user = AnonymousUser()
+  return request
+
+# The hot paths as (name, function); each function takes the repetition number
+# and returns the response (or None for what isn't a view)
+def hot_endpoints(event):
+  factory = RequestFactory()
+  eventId = str(event.id)
+  prizes = list(Prize.objects.filter(event=event).order_by('id')[:20])
+  def draw_prizes(i):
+    # everything a drawing does short of saving the winners
+    data = viewutil.PrizeDrawData(event, prizes)
+    for prize in prizes:
+      viewutil.WeightedPool(prize.weighted_entries(data.eligible_donor_amounts(prize)))
+  return [
+    ('index_json', lambda i: views.index(_public_request(factory, 'get', '/index/' + eventId, {'json': ''}), event=eventId)),
+    ('search', lambda i: views.search(_public_request(factory, 'get', '/search/', {'type': 'donation', 'event': eventId}))),
+    ('donate', lambda i: views.donate(_public_request(factory, 'get', '/donate/' + eventId), eventId)),
+    ('ipn', lambda i: views.ipn(_public_request(factory, 'post', '/ipn/', {'txn_id': 'benchmark%d_%d' % (event.id, i), 'payment_status': 'Completed'}))),
+    ('prize_draw', draw_prizes),
+  ]
+
+def time_endpoint(name, send, repeat=5):
+  timings = []
+  for i in range(repeat):
+    with querylog.record(name) as recorder:
+      started = timeit.default_timer()
+      response = send(i)
+      if hasattr(response, 'streaming_content'):
+        ''.join(response.streaming_content)
+      elapsed = timeit.default_timer() - started
+    timings.append(elapsed * 1000)
+  timings.sort()
+  return {
+    'endpoint': name,
+    'repeat': repeat,
+    'status': getattr(response, 'status_code', None),
+    # the last run, caches are warm by then
+    'queries': recorder.count,
+    'ms_min': timings[0],
+    'ms_median': timings[len(timings) // 2],
+    'ms_max': timings[-1],
+  }
+
+# Generates an event of the given size (see randgen.build_bulk_event) and times
+# each hot endpoint against it. The first result is the generation itself.
+def benchmark_scale(scale, sizes, seed=0, repeat=5):
+  started = timeit.default_timer()
+  event = randgen.build_bulk_event(random.Random(seed), **sizes)
+  generated = (timeit.default_timer() - started) * 1000
+  results = [{ 'endpoint': 'generate', 'repeat': 1, 'status': None, 'queries': None, 'ms_min': generated, 'ms_median': generated, 'ms_max': generated }]
+  for name, send in hot_endpoints(event):
+    results.append(time_endpoint(name, send, repeat=repeat))
+  for result in results:
+    result['scale'] = scale
+    result.update(sizes)
+  return results
+
+def benchmark_scales(scales=ScaleOrder, seed=0, repeat=5):
+  results = []
+  for scale in scales:
+    results += benchmark_scale(scale, Scales[scale], seed=seed, repeat=repeat)
+  return results
+
+# Writes results as one JSON document, with enough about the environment to
+# tell apart runs that shouldn't be compared
+def write_results(results, out=None):
+  out = out or sys.stdout
+  out.write(json.dumps({
+    'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+    'django': django.get_version(),
+    'python': platform.python_version(),
+    'database': connection.vendor,
+    'results': results,
+  }, indent=1, sort_keys=True) + '\n')
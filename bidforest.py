@@ -0,0 +1,108 @@
+from django.db.models import Q, signals
+from django.dispatch import receiver
+from decimal import Decimal
+import threading
+
+from tracker.models import *
+import tracker.cacheutil as cacheutil
+
+# Every bid of an event, loaded with a single query and kept in memory as a
+# BidForest, so pages that show nested bids don't need a query per level (or
+# per bid). Like the schedule index, the forest is tied to a cacheutil
+# namespace version and is rebuilt on next use after any bid, donation bid or
+# donation of the event changes.
+#
+# The bids are shared between requests: treat them as read-only.
+
+def bids_namespace(eventId):
+  return 'bids:%s' % eventId
+
+def invalidate(eventId):
+  if eventId:
+    cacheutil.bump(bids_namespace(eventId))
+
+def load_event_bids(eventId):
+  return list(Bid.objects.filter(Q(event=eventId) | Q(speedrun__event=eventId)).select_related('speedrun__event', 'event', 'parent').order_by('tree_id', 'lft'))
+
+# Built in one pass over the bids in tree order. Each bid gets 'cachedOptions',
+# its children with the largest total first (the order bid_short shows them
+# in), and its 'parent' is the shared instance, so walking up and down the
+# tree never queries. 'total', 'choiceTotal' and 'challengeTotal' add up the
+# top level bids the way the bid index shows them.
+class BidForest(object):
+  def __init__(self, bids):
+    self.bids = bids
+    self.byId = {}
+    self.roots = []
+    self.total = self.choiceTotal = self.challengeTotal = Decimal('0.00')
+    for bid in bids:
+      bid.cachedOptions = []
+      self.byId[bid.id] = bid
+      if bid.parent_id in self.byId:
+        bid.parent = self.byId[bid.parent_id]
+        bid.parent.cachedOptions.append(bid)
+      elif bid.parent_id is None:
+        self.roots.append(bid)
+        self.total += bid.total
+        if bid.goal is None:
+          self.choiceTotal += bid.total
+        else:
+          self.challengeTotal += bid.total
+    for bid in bids:
+      if len(bid.cachedOptions) > 1:
+        bid.cachedOptions.sort(key=lambda option: option.total, reverse=True)
+  # the cached instances of the given bids (ids), in the order given
+  def select(self, bidIds):
+    return [self.byId[bidId] for bidId in bidIds if bidId in self.byId]
+  # (total, choiceTotal, challengeTotal) of just these (top level) bids
+  def totals(self, bids):
+    if len(bids) == len(self.roots) and all(bid.parent_id is None for bid in bids):
+      return self.total, self.choiceTotal, self.challengeTotal
+    choiceTotal = sum((bid.total for bid in bids if bid.goal is None), Decimal('0.00'))
+    challengeTotal = sum((bid.total for bid in bids if bid.goal is not None), Decimal('0.00'))
+    return choiceTotal + challengeTotal, choiceTotal, challengeTotal
+
+def build_forest(eventId):
+  return BidForest(load_event_bids(eventId))
+
+_Forests = {}
+_ForestLock = threading.Lock()
+
+def get_forest(eventId):
+  version = cacheutil.get_version(bids_namespace(eventId))
+  with _ForestLock:
+    cached = _Forests.get(eventId)
+  if cached and cached[0] == version:
+    return cached[1]
+  forest = build_forest(eventId)
+  with _ForestLock:
+    _Forests[eventId] = (version, forest)
+  return forest
+
+def get_event_bids(eventId):
+  return get_forest(eventId).bids
+
+def select(eventId, bidIds):
+  return get_forest(eventId).select(bidIds)
+
+def _bid_event_id(bid):
+  if bid.speedrun_id:
+    return SpeedRun.objects.filter(pk=bid.speedrun_id).values_list('event', flat=True).first()
+  return bid.event_id
+
+@receiver(signals.post_save, sender=Bid, dispatch_uid='tracker.bidforest.bid_save')
+@receiver(signals.post_delete, sender=Bid, dispatch_uid='tracker.bidforest.bid_delete')
+def bid_changed(sender, instance, **kwargs):
+  invalidate(_bid_event_id(instance))
+
+# totals are kept up to date with queryset updates, which send no signals of
+# their own, so follow what causes them
+@receiver(signals.post_save, sender=DonationBid, dispatch_uid='tracker.bidforest.donationbid_save')
+@receiver(signals.post_delete, sender=DonationBid, dispatch_uid='tracker.bidforest.donationbid_delete')
+def donation_bid_changed(sender, instance, **kwargs):
+  invalidate(instance.donation.event_id)
+
+@receiver(signals.post_save, sender=Donation, dispatch_uid='tracker.bidforest.donation_save')
+@receiver(signals.post_delete, sender=Donation, dispatch_uid='tracker.bidforest.donation_delete')
+def donation_changed(sender, instance, **kwargs):
+  invalidate(instance.event_id)
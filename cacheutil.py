@@ -0,0 +1,134 @@
+from django.core.cache import cache
+from django.db.models import signals
+from django.dispatch import receiver
+from collections import Counter
+import threading
+import time
+
+from tracker.models import *
+
+# Cached values are invalidated by model signals instead of timing out, so
+# they are stored without an expiry. Every namespace carries a version number
+# that is part of its keys; bumping the version orphans everything cached under
+# the old one in O(1), and the backend evicts the orphans eventually.
+
+_KeyPrefix = 'tracker'
+_Forever = 60*60*24*30
+
+_stats = Counter()
+
+def _version_key(namespace):
+  return '%s:version:%s' % (_KeyPrefix, namespace)
+
+# Versions start out at the current time rather than at 1, so a version key
+# that got evicted never comes back as a number something was stored under
+# before (which matters for values held outside the cache, see scheduleindex)
+def _initial_version():
+  return int(time.time() * 1000)
+
+def get_version(namespace):
+  version = cache.get(_version_key(namespace))
+  if version is None:
+    cache.add(_version_key(namespace), _initial_version(), _Forever)
+    version = cache.get(_version_key(namespace)) or _initial_version()
+  return version
+
+def bump(*namespaces):
+  for namespace in namespaces:
+    try:
+      cache.incr(_version_key(namespace))
+    except ValueError:
+      # key was never set or got evicted, anything cached under it is unreachable anyway
+      cache.set(_version_key(namespace), _initial_version(), _Forever)
+
+def make_key(namespace, key):
+  return '%s:%s:%d:%s' % (_KeyPrefix, namespace, get_version(namespace), key)
+
+def get_or_compute(namespace, key, compute):
+  fullKey = make_key(namespace, key)
+  value = cache.get(fullKey)
+  if value is None:
+    _stats[namespace + ':miss'] += 1
+    value = compute()
+    cache.set(fullKey, value, _Forever)
+  else:
+    _stats[namespace + ':hit'] += 1
+  return value
+
+def stats(namespace=None):
+  if namespace is None:
+    return dict(_stats)
+  return { 'hit': _stats[namespace + ':hit'], 'miss': _stats[namespace + ':miss'] }
+
+def reset_stats():
+  _stats.clear()
+
+def index_namespace(eventId):
+  return 'index:%s' % (eventId or 'all')
+
+def invalidate_index(eventId):
+  bump(index_namespace(eventId), index_namespace(None))
+
+def invalidate_all_indexes():
+  bump(index_namespace(None), *[index_namespace(eventId) for eventId in Event.objects.values_list('id', flat=True)])
+
+# everything that feeds the public index page belongs to an event, so a change
+# only needs to drop that event's aggregates and the all-events ones
+@receiver(signals.post_save, sender=Donation, dispatch_uid='tracker.cacheutil.donation_save')
+@receiver(signals.post_delete, sender=Donation, dispatch_uid='tracker.cacheutil.donation_delete')
+@receiver(signals.post_save, sender=Bid, dispatch_uid='tracker.cacheutil.bid_save')
+@receiver(signals.post_delete, sender=Bid, dispatch_uid='tracker.cacheutil.bid_delete')
+@receiver(signals.post_save, sender=Prize, dispatch_uid='tracker.cacheutil.prize_save')
+@receiver(signals.post_delete, sender=Prize, dispatch_uid='tracker.cacheutil.prize_delete')
+@receiver(signals.post_save, sender=SpeedRun, dispatch_uid='tracker.cacheutil.run_save')
+@receiver(signals.post_delete, sender=SpeedRun, dispatch_uid='tracker.cacheutil.run_delete')
+@receiver(signals.post_save, sender=DonorCache, dispatch_uid='tracker.cacheutil.donorcache_save')
+@receiver(signals.post_delete, sender=DonorCache, dispatch_uid='tracker.cacheutil.donorcache_delete')
+def event_content_changed(sender, instance, **kwargs):
+  invalidate_index(instance.event_id)
+
+@receiver(signals.post_save, sender=Event, dispatch_uid='tracker.cacheutil.event_save')
+@receiver(signals.post_delete, sender=Event, dispatch_uid='tracker.cacheutil.event_delete')
+def event_changed(sender, instance, **kwargs):
+  invalidate_index(instance.id)
+  bump(_EventsNamespace)
+
+# The event list that every page's nav shows, and the latest event. They are
+# kept in each process like the schedule index, so a page needs no query for
+# them; any event change makes every process reload them on next use. The
+# instances are shared between requests: treat them as read-only.
+
+_EventsNamespace = 'events'
+_Events = {}
+_EventsLock = threading.Lock()
+
+def _event_list():
+  version = get_version(_EventsNamespace)
+  with _EventsLock:
+    cached = _Events.get('events')
+  if cached and cached[0] == version:
+    return cached[1]
+  events = list(Event.objects.all())
+  latestBy = Event._meta.get_latest_by
+  latest = max(events, key=lambda event: getattr(event, latestBy)) if events else None
+  with _EventsLock:
+    _Events['events'] = (version, (events, latest))
+  return events, latest
+
+def get_events():
+  return _event_list()[0]
+
+# like Event.objects.latest()
+def latest_event():
+  latest = _event_list()[1]
+  if latest is None:
+    raise Event.DoesNotExist('There are no events')
+  return latest
+
+def profile_namespace(userId):
+  return 'profile:%d' % userId
+
+@receiver(signals.post_save, sender=UserProfile, dispatch_uid='tracker.cacheutil.profile_save')
+@receiver(signals.post_delete, sender=UserProfile, dispatch_uid='tracker.cacheutil.profile_delete')
+def profile_changed(sender, instance, **kwargs):
+  bump(profile_namespace(instance.user_id))
@@ -0,0 +1,126 @@
+from django.db.models import signals
+from django.dispatch import receiver
+from decimal import Decimal
+import simplejson as json
+import threading
+import datetime
+import pytz
+
+from tracker.models import *
+import tracker.cacheutil as cacheutil
+import tracker.scheduleindex as scheduleindex
+import tracker.bidforest as bidforest
+
+# What the donate page needs besides its forms: the open bid targets and the
+# ticket prizes as JSON for the page's scripts, and the prizes a donation is
+# currently eligible for. Built with one query per model (the bids come from
+# the event's BidForest, so usually none for them) and kept in each process,
+# already serialized.
+#
+# A payload is tied to the bid forest's and schedule index's versions and to
+# its own namespace for suggestions, so any change to a bid, donation, run,
+# prize or suggestion of the event rebuilds it on next use. Which prizes are
+# current also depends on the time, so it is rebuilt once a draw window opens
+# or closes as well.
+
+def payload_namespace(eventId):
+  return 'donate:%s' % eventId
+
+def invalidate(eventId):
+  if eventId:
+    cacheutil.bump(payload_namespace(eventId))
+
+def _is_target(bid):
+  # the 'bidtarget' filter
+  return bid.allowuseroptions or (bid.istarget and not bid.cachedOptions)
+
+def _parent_info(bid):
+  if bid is None:
+    return None
+  return {'name': bid.name, 'description': bid.description, 'parent': _parent_info(bid.parent)}
+
+def bid_info(bid, suggestions):
+  result = {
+    'id': bid.id,
+    'name': bid.name,
+    'description': bid.description,
+    'label': bid.full_label(not bid.allowuseroptions),
+    'count': bid.count,
+    'amount': bid.total,
+    'goal': Decimal(bid.goal or '0.00'),
+    'parent': _parent_info(bid.parent),
+  }
+  if bid.speedrun:
+    result['runname'] = bid.speedrun.name
+  if suggestions:
+    result['suggested'] = suggestions
+  if bid.allowuseroptions:
+    result['custom'] = ['custom']
+    result['label'] += ' (select and add a name next to "New Option Name")'
+  return result
+
+def prize_info(prize):
+  return {'id': prize['id'], 'name': prize['name'], 'description': prize['description'], 'minimumbid': prize['minimumbid'], 'maximumbid': prize['maximumbid']}
+
+# Bid._meta.ordering for bids of one event, with nulls last as postgres puts them
+def _bid_order(bid):
+  return (bid.speedrun is None, bid.speedrun.starttime if bid.speedrun else None, bid.parent is None, bid.parent.name if bid.parent else None, bid.name)
+
+class DonatePayload(object):
+  def __init__(self, bidsJson, hasBids, ticketPrizesJson, hasTicketPrizes, prizes, expires):
+    self.bidsJson = bidsJson
+    self.hasBids = hasBids
+    self.ticketPrizesJson = ticketPrizesJson
+    self.hasTicketPrizes = hasTicketPrizes
+    # dicts with 'id', 'name', 'image' and 'minimumbid'
+    self.prizes = prizes
+    self.expires = expires
+  def context(self):
+    return {'hasBids': self.hasBids, 'bidsJson': self.bidsJson, 'hasTicketPrizes': self.hasTicketPrizes, 'ticketPrizesJson': self.ticketPrizesJson, 'prizes': self.prizes}
+
+def build_payload(eventId, time=None):
+  time = time or datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+  forest = bidforest.get_forest(eventId)
+  bids = sorted((bid for bid in forest.bids if bid.state == 'OPENED' and _is_target(bid)), key=_bid_order)
+  suggestions = dict((bid.id, []) for bid in bids)
+  if bids:
+    for bidId, name in BidSuggestion.objects.filter(bid__in=suggestions.keys()).values_list('bid', 'name'):
+      suggestions[bidId].append(name)
+  index = scheduleindex.get_index(eventId)
+  # the 'current' prize feed
+  prizes = list(Prize.objects.filter(event=eventId, state='ACCEPTED', prizewinner__isnull=True, pk__in=index.live_prizes(time)).distinct().values('id', 'name', 'description', 'image', 'minimumbid', 'maximumbid', 'ticketdraw'))
+  ticketPrizes = [prize for prize in prizes if prize['ticketdraw']]
+  return DonatePayload(
+    bidsJson=json.dumps([bid_info(bid, suggestions[bid.id]) for bid in bids]),
+    hasBids=bool(bids),
+    ticketPrizesJson=json.dumps([prize_info(prize) for prize in ticketPrizes]),
+    hasTicketPrizes=bool(ticketPrizes),
+    prizes=[prize for prize in prizes if not prize['ticketdraw']],
+    expires=index.next_prize_change(time))
+
+def _version(eventId):
+  return (cacheutil.get_version(bidforest.bids_namespace(eventId)), cacheutil.get_version(scheduleindex.index_namespace(eventId)), cacheutil.get_version(payload_namespace(eventId)))
+
+_Payloads = {}
+_PayloadLock = threading.Lock()
+
+def get_payload(eventId):
+  version = _version(eventId)
+  time = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+  with _PayloadLock:
+    cached = _Payloads.get(eventId)
+  if cached and cached[0] == version and (cached[1].expires is None or cached[1].expires > time):
+    return cached[1]
+  payload = build_payload(eventId, time)
+  with _PayloadLock:
+    _Payloads[eventId] = (version, payload)
+  return payload
+
+# bids, runs and prizes are followed through the forest's and index's
+# versions, suggestions only matter here
+@receiver(signals.post_save, sender=BidSuggestion, dispatch_uid='tracker.donatepayload.suggestion_save')
+@receiver(signals.post_delete, sender=BidSuggestion, dispatch_uid='tracker.donatepayload.suggestion_delete')
+def suggestion_changed(sender, instance, **kwargs):
+  bid = Bid.objects.filter(pk=instance.bid_id).first()
+  if bid:
+    invalidate(bidforest._bid_event_id(bid))
@@ -1,8 +1,11 @@
-from django.db.models import Count,Sum,Max,Avg,Q,F
+from django.db import connection
+from django.db.models import Count,Sum,Min,Max,Avg,Q,F
 from tracker.models import *
 from datetime import *
 import pytz
 import viewutil
+import fulltext
+import scheduleindex
 import dateutil.parser
 
 # TODO: fix these to make more sense, it should in general only be querying top-level bids
@@ -287,8 +290,25 @@ _DonorEmailFields = ['email', 'paypalemail']
 _DonorNameFields = ['firstname', 'lastname']
 _SpecialMarkers = ['icontains', 'contains', 'iexact', 'exact', 'lte', 'gte']
 
+_SearchPermissions = ['tracker.view_emails', 'tracker.view_usernames', 'tracker.view_test', 'tracker.view_comments', 'tracker.view_hidden']
+
+# has_perm goes through every auth backend on each call, and a single search can
+# ask about the same permission for dozens of fields, so the answers are kept on
+# the user object (which lives for the duration of the request)
+def user_has_perm(user, perm):
+  if user == None:
+    return False
+  perms = getattr(user, '_trackerPermCache', None)
+  if perms is None:
+    perms = user._trackerPermCache = {}
+  if perm not in perms:
+    perms[perm] = user.has_perm(perm)
+  return perms[perm]
+
 # additional considerations for permission related visibility at the 'field' level
-def add_permissions_checks(rootmodel, key, query, user=None):
+# returns None if the field must not be searched at all, otherwise a Q object
+# restricting which rows may match on it
+def field_permission_rule(rootmodel, key, user=None):
   toks = key.split('__')
   leading = ''
   if len(toks) >= 2:
@@ -297,27 +317,34 @@ def add_permissions_checks(rootmodel, key, query, user=None):
     rootmodel = ftail
     leading = '__'.join(toks[:-1]) + '__'
   field = toks[-1]
+  rule = Q()
   if rootmodel == 'donor':
     visField = leading + 'visibility'
-    if (field in _DonorEmailFields) and (user == None or not user.has_perm('tracker.view_emails')):
+    if (field in _DonorEmailFields) and not user_has_perm(user, 'tracker.view_emails'):
       # Here, we just want to remove the query altogether, since there is no circumstance that we want personal contact emails displayed publicly without permissions
-      query = Q()
-    elif (field in _DonorNameFields) and (user == None or not user.has_perm('tracker.view_usernames')):
-      query &= Q(**{ visField: 'FULL' })
-    elif (field == 'alias') and (user == None or not user.has_perm('tracker.view_usernames')):
-      query &= Q(Q(**{ visField: 'FULL' }) | Q(**{ visField: 'ALIAS' }))
+      return None
+    elif (field in _DonorNameFields) and not user_has_perm(user, 'tracker.view_usernames'):
+      rule = Q(**{ visField: 'FULL' })
+    elif (field == 'alias') and not user_has_perm(user, 'tracker.view_usernames'):
+      rule = Q(Q(**{ visField: 'FULL' }) | Q(**{ visField: 'ALIAS' }))
   elif rootmodel == 'donation':
-    if (field == 'testdonation') and (user == None or not user.has_perm('tracker.view_test')):
-      query = Q()
-    if (field == 'comment') and (user == None or not user.has_perm('tracker.view_comments')):
+    if (field == 'testdonation') and not user_has_perm(user, 'tracker.view_test'):
+      return None
+    if (field == 'comment') and not user_has_perm(user, 'tracker.view_comments'):
       # only allow searching the textual content of approved comments
       commentStateField = leading + 'commentstate'
-      query &= Q(**{ commentStateField: 'APPROVED' })
+      rule = Q(**{ commentStateField: 'APPROVED' })
   elif rootmodel == 'bid':
     # Prevent 'hidden' bids from showing up in public queries
-    if (field == 'state') and (user == None or not user.has_perm('tracker.view_hidden')):
-      query &= ~Q(**{ key: 'HIDDEN' })
-  return query
+    if (field == 'state') and not user_has_perm(user, 'tracker.view_hidden'):
+      rule = ~Q(**{ key: 'HIDDEN' })
+  return rule
+
+def add_permissions_checks(rootmodel, key, query, user=None):
+  rule = field_permission_rule(rootmodel, key, user=user)
+  if rule is None:
+    return Q()
+  return query & rule
 
 def recurse_keys(key, fromModels=[]):
   tail = key.split('__')[-1]
@@ -347,19 +374,52 @@ def normalize_model_param(model):
     model = _ModelReverseMap[model]
   return model
 
-# This creates a 'q'-esque Q-filter, similar to the search model of the django admin
-def model_general_filter(model, text, user=None):
+class _GrantedPermissions(object):
+  def __init__(self, perms):
+    self.perms = perms
+  def has_perm(self, perm):
+    return perm in self.perms
+
+def general_search_keys(model):
   fields = set()
-  model = normalize_model_param(model)
   fromModels = [model]
   for key in _GeneralFields[model]:
     fields |= set(recurse_keys(key, fromModels=fromModels))
-  fields = list(fields)
+  return sorted(fields)
+
+_SearchPlans = {}
+
+# The fields a 'q' search looks at, and the permission restrictions on each of
+# them, only depend on the model and on which of the search permissions the user
+# holds, so they are worked out once per combination and shared afterwards
+def search_plan(model, user=None):
+  model = normalize_model_param(model)
+  perms = frozenset(perm for perm in _SearchPermissions if user_has_perm(user, perm))
+  plan = _SearchPlans.get((model, perms))
+  if plan is None:
+    granted = _GrantedPermissions(perms)
+    plan = []
+    for key in general_search_keys(model):
+      rule = field_permission_rule(model, key, user=granted)
+      if rule is not None:
+        plan.append((key + '__icontains', rule))
+    plan = _SearchPlans[(model, perms)] = tuple(plan)
+  return plan
+
+# This creates a 'q'-esque Q-filter, similar to the search model of the django admin
+def model_general_filter(model, text, user=None):
   query = Q()
-  for field in fields:
-    query |= build_general_query_piece(model, field, text, user=user)
+  if not text:
+    return query
+  model = normalize_model_param(model)
+  plan = search_plan(model, user=user)
+  indexed = fulltext.general_filter(_ModelMap[model], plan, text)
+  if indexed is not None:
+    return indexed
+  for lookup, rule in plan:
+    query |= Q(**{ lookup: text }) & rule
   return query
-  
+
 # This creates a more specific filter, using UA's json API implementation as a basis
 def model_specific_filter(model, searchDict, user=None):
   query = Q()
@@ -405,23 +465,34 @@ _DEFAULT_DONATION_DELTA = timedelta(hours=3)
 _DEFAULT_DONATION_MAX = 200
 _DEFAULT_DONATION_MIN = 25
 
-# There is a slight complication in how this works, in that we cannot use the 'limit' set-up as a general filter mechanism, so these methods return the actual result, rather than a filter object
+# Selects the rows of 'items' that match 'window', but at least the first
+# 'minimum' and at most the first 'maximum' of them (in the queryset's order).
+# 'window' has to match a leading run of the ordered rows, as a time bound in
+# the direction of the ordering does. The result is then the union of two
+# bounded slices, which stays a single lazy query the caller can keep
+# filtering, instead of a COUNT followed by a second, sliced query.
+def bounded_window(items, window, minimum=None, maximum=None):
+  if maximum is None:
+    selected = window
+  else:
+    selected = Q(pk__in=_sliced_pks(items.filter(window), maximum))
+  if minimum:
+    selected |= Q(pk__in=_sliced_pks(items, minimum))
+  return items.filter(selected)
+
+def _sliced_pks(items, limit):
+  if connection.vendor == 'mysql':
+    # mysql doesn't take a LIMIT inside an IN subquery (error 1235), the
+    # slices are small enough to fetch first
+    return list(items.values_list('pk', flat=True)[:limit])
+  return items.values('pk')[:limit]
+
 def get_recent_donations(donations=None, minDonations=_DEFAULT_DONATION_MIN, maxDonations=_DEFAULT_DONATION_MAX, delta=_DEFAULT_DONATION_DELTA, queryOffset=None):
   offset = default_time(queryOffset)
   if donations == None:
     donations = Donation.objects.all()
-  if delta:
-    highFilter = donations.filter(timereceived__gte=offset-delta)
-  else:
-    highFilter = donations
-  count = highFilter.count()
-  if maxDonations != None and count > maxDonations:
-    donations = donations[:maxDonations]
-  elif minDonations != None and count < minDonations:
-    donations = donations[:minDonations]
-  else:
-    donations = highFilter
-  return donations
+  window = Q(timereceived__gte=offset-delta) if delta else Q()
+  return bounded_window(donations, window, minDonations, maxDonations)
 
 _DEFAULT_RUN_DELTA = timedelta(hours=6)
 _DEFAULT_RUN_MAX = 7
@@ -435,25 +506,37 @@ def get_upcomming_runs(runs=None, includeCurrent=True, maxRuns=_DEFAULT_RUN_MAX,
     runs = runs.filter(endtime__gte=offset)
   else:
     runs = runs.filter(starttime__gte=offset)
-  if delta:
-    highFilter = runs.filter(endtime__lte=offset+delta)
-  else:
-    highFilter = runs
-  count = highFilter.count()
-  if maxRuns != None and count > maxRuns:
-    runs = runs[:maxRuns]
-  elif minRuns != None and count < minRuns:
-    runs = runs[:minRuns]
-  else:
-    runs = highFilter
-  return runs
+  window = Q(endtime__lte=offset+delta) if delta else Q()
+  return bounded_window(runs, window, minRuns, maxRuns)
 
 def get_future_runs(**kwargs):
   return get_upcomming_runs(includeCurrent=False, **kwargs)
 
-def upcomming_bid_filter(**kwargs):
-  runs = map(lambda run: run.id, get_upcomming_runs(SpeedRun.objects.filter(Q(bids__state='OPENED')).distinct(), **kwargs))
-  return Q(speedrun__in=runs)
+# The same selection as get_upcomming_runs over every run, made from the
+# schedule index instead of the database
+def upcomming_run_ids(index=None, includeCurrent=True, maxRuns=_DEFAULT_RUN_MAX, minRuns=_DEFAULT_RUN_MIN, delta=_DEFAULT_RUN_DELTA, queryOffset=None, openBids=False):
+  index = index or scheduleindex.get_index()
+  return index.upcoming_runs(default_time(queryOffset), includeCurrent=includeCurrent, minRuns=minRuns, maxRuns=maxRuns, delta=delta, openBids=openBids)
+
+# params that only steer the run feeds; if nothing else narrows the runs down,
+# the schedule index can pick them on its own
+_RunFeedParams = set(['type', 'feed', 'event', 'maxRuns', 'minRuns', 'delta', 'offset', 'noslice', 'format', 'after', 'limit'])
+
+def schedule_feed_runs(query, params, **kwargs):
+  event = params.get('event')
+  if set(params.keys()) <= _RunFeedParams and (not event or unicode(event).isdigit()):
+    index = scheduleindex.get_index(int(event) if event else None)
+    return query.filter(pk__in=upcomming_run_ids(index=index, **kwargs))
+  return get_upcomming_runs(runs=query, **kwargs)
+
+# the index of the event the feed is narrowed to, when it is given by id
+def event_schedule_index(event):
+  if event and unicode(event).isdigit():
+    return scheduleindex.get_index(int(event))
+  return None
+
+def upcomming_bid_filter(event=None, **kwargs):
+  return Q(speedrun__in=upcomming_run_ids(index=event_schedule_index(event), openBids=True, **kwargs))
 
 def get_upcomming_bids(**kwargs):
   return Bid.objects.filter(upcomming_bid_filter(**kwargs))
@@ -467,27 +550,46 @@ def get_completed_bids(querySet, queryOffset=None):
   
 # Gets all of the current prizes that are possible right now (and also _sepcific_ to right now)
 def concurrent_prizes_filter(runs):
-  runCount = runs.count()
-  if runCount == 0:
+  bounds = runs.aggregate(startTime=Min('starttime'), endTime=Max('endtime'))
+  if bounds['startTime'] is None:
     return Q(id=None)
-  startTime = runs[0].starttime
-  endTime = runs.reverse()[0].endtime
+  startTime, endTime = bounds['startTime'], bounds['endTime']
   # yes, the filter query here is correct.  We want to get all prizes unwon prizes that _start_ before the last run in the list _ends_, and likewise all prizes that _end_ after the first run in the list _starts_.
   return Q(prizewinner__isnull=True) & (Q(startrun__starttime__lte=endTime, endrun__endtime__gte=startTime) | Q(starttime__lte=endTime, endtime__gte=startTime) | Q(startrun__isnull=True, endrun__isnull=True, starttime__isnull=True, endtime__isnull=True))
   
-def current_prizes_filter(queryOffset=None):
+# Without an event, the prizes that have no draw window (which only ever pile
+# up across events) are left to SQL, so the ids inlined into the query are
+# just the ones whose window matched
+_TimelessPrizes = Q(startrun__isnull=True, endrun__isnull=True, starttime__isnull=True, endtime__isnull=True)
+
+def current_prizes_filter(queryOffset=None, event=None):
   offset = default_time(queryOffset)
-  return Q(prizewinner__isnull=True) & (Q(startrun__starttime__lte=offset, endrun__endtime__gte=offset) | Q(starttime__lte=offset, endtime__gte=offset) | Q(startrun__isnull=True, endrun__isnull=True, starttime__isnull=True, endtime__isnull=True))
+  index = event_schedule_index(event)
+  if index:
+    return Q(prizewinner__isnull=True) & Q(pk__in=index.live_prizes(offset))
+  return Q(prizewinner__isnull=True) & (Q(pk__in=scheduleindex.get_index().live_prizes(offset, includeTimeless=False)) | _TimelessPrizes)
   
-def upcomming_prizes_filter(**kwargs):
-  runs = get_upcomming_runs(**kwargs)
-  return concurrent_prizes_filter(runs)
+def upcomming_prizes_filter(event=None, **kwargs):
+  index = event_schedule_index(event)
+  eventIndex = index is not None
+  index = index or scheduleindex.get_index()
+  bounds = index.run_bounds(upcomming_run_ids(index=index, **kwargs))
+  if bounds is None:
+    return Q(id=None)
+  # all unwon prizes whose window overlaps the span of those runs, as in concurrent_prizes_filter
+  if eventIndex:
+    return Q(prizewinner__isnull=True) & Q(pk__in=index.prizes_between(*bounds))
+  return Q(prizewinner__isnull=True) & (Q(pk__in=index.prizes_between(*bounds, includeTimeless=False)) | _TimelessPrizes)
   
 def future_prizes_filter(**kwargs):
   return upcomming_prizes_filter(includeCurrent=False, **kwargs)
   
-def todraw_prizes_filter(queryOffset=None):
+def todraw_prizes_filter(queryOffset=None, event=None):
   offset = default_time(queryOffset)
+  index = event_schedule_index(event)
+  if index:
+    return Q(state='ACCEPTED') & Q(prizewinner__isnull=True) & Q(pk__in=index.ended_prizes(offset))
+  # every ended prize of every event is no list to inline, that stays in SQL
   return Q(state='ACCEPTED') & (Q(prizewinner__isnull=True) & (Q(endrun__endtime__lte=offset) | Q(endtime__lte=offset) | (Q(endtime=None) & Q(endrun=None))))
   
 def run_model_query(model, params={}, user=None, mode='user'):
@@ -573,7 +675,7 @@ def apply_feed_filter(query, model, feedName, params, user=None, noslice=False):
         callParams['minRuns'] = None
       if 'offset' in params:
         callParams['queryOffset'] = default_time(params['offset'])
-      query = query.filter(state='OPENED').filter(upcomming_bid_filter(**callParams))
+      query = query.filter(state='OPENED').filter(upcomming_bid_filter(event=params.get('event'), **callParams))
     elif feedName == 'future':
       callParams = {}
       if 'maxRuns' in params:
@@ -584,16 +686,16 @@ def apply_feed_filter(query, model, feedName, params, user=None, noslice=False):
         callParams['maxRuns'] = None
         callParams['minRuns'] = None
       if 'delta' in params:
-        callParams['delta'] = timedelta(minutes=int(toks[1]))
+        callParams['delta'] = timedelta(minutes=int(params['delta']))
       if 'offset' in params:
         callParams['queryOffset'] = default_time(params['offset'])
-      query = query.filter(future_bid_filter(**callParams))
+      query = query.filter(future_bid_filter(event=params.get('event'), **callParams))
     elif feedName == 'completed':
       query = get_completed_bids(query)
     elif feedName == 'suggested':
       query = query.filter(suggestions__isnull=False)
   elif model == 'run':
-    callParams = { 'runs': query }
+    callParams = {}
     if feedName == 'current':
       if 'maxRuns' in params:
         callParams['maxRuns'] = int(params['maxRuns'])
@@ -604,7 +706,7 @@ def apply_feed_filter(query, model, feedName, params, user=None, noslice=False):
         callParams['minRuns'] = None
       if 'offset' in params:
         callParams['queryOffset'] = default_time(params['offset'])
-      query = get_upcomming_runs(**callParams)
+      query = schedule_feed_runs(query, params, **callParams)
     elif feedName == 'future':
       if 'maxRuns' in params:
         callParams['maxRuns'] = int(params['maxRuns'])
@@ -617,13 +719,13 @@ def apply_feed_filter(query, model, feedName, params, user=None, noslice=False):
         callParams['delta'] = timedelta(minutes=int(params['delta']))
       if 'offset' in params:
         callParams['queryOffset'] = default_time(params['offset'])
-      query = get_future_runs(**callParams)
+      query = schedule_feed_runs(query, params, includeCurrent=False, **callParams)
   elif model == 'prize':
     if feedName == 'current':
       callParams = {}
       if 'offset' in params:
         callParams['queryOffset'] = default_time(params['offset'])
-      query = query.filter(current_prizes_filter(**callParams))
+      query = query.filter(current_prizes_filter(event=params.get('event'), **callParams))
     elif feedName == 'future':
       callParams = {}
       if 'maxRuns' in params:
@@ -637,14 +739,14 @@ def apply_feed_filter(query, model, feedName, params, user=None, noslice=False):
         callParams['delta'] = timedelta(minutes=int(params['delta']))
       if 'offset' in params:
         callParams['queryOffset'] = default_time(params['offset'])
-      x = upcomming_prizes_filter(**callParams)
+      x = upcomming_prizes_filter(event=params.get('event'), **callParams)
       query = query.filter(x)
     elif feedName == 'won':
       query = query.filter(Q(prizewinner__isnull=False))
     elif feedName == 'unwon':
       query = query.filter(Q(prizewinner__isnull=True))
     elif feedName == 'todraw':
-      query = query.filter(todraw_prizes_filter())
+      query = query.filter(todraw_prizes_filter(event=params.get('event')))
   elif model == 'bidsuggestion':
     if feedName == 'expired':
       query = query.filter(bid__state='CLOSED')
@@ -0,0 +1,154 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q, signals
+from django.dispatch import receiver
+import re
+
+from tracker.models import *
+
+# Optional full-text index used by 'q' searches in place of chains of
+# LIKE '%x%' comparisons. Enable it with the TRACKER_FULLTEXT_BACKEND setting:
+#   'sqlite'     -- an FTS5 virtual table (needs an sqlite built with FTS5)
+#   'postgresql' -- a table with a GIN indexed tsvector column
+# The index keeps one row per (model, object, field), written by the signal
+# handlers at the bottom of this file. Its table is created by migration 0076
+# on databases that support it; run rebuild_index() after enabling it on an
+# existing database.
+#
+# Matching is by word prefix rather than by arbitrary substring, so 'mar'
+# finds 'Mario Kart' but no longer finds 'Omar'.
+
+IndexedFields = {
+  'donation' : [ 'comment', 'modcomment' ],
+  'donor'    : [ 'alias', 'firstname', 'lastname', 'email', 'paypalemail' ],
+  'bid'      : [ 'name', 'description', 'shortdescription' ],
+  'prize'    : [ 'name', 'description', 'shortdescription' ],
+}
+
+IndexedModels = {
+  'donation' : Donation,
+  'donor'    : Donor,
+  'bid'      : Bid,
+  'prize'    : Prize,
+}
+
+_TableName = 'tracker_fulltext'
+
+def tokenize(text):
+  return re.findall(r'\w+', text, re.UNICODE)
+
+class FullTextBackend(object):
+  def index(self, modelName, objId, values):
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM ' + _TableName + ' WHERE model = %s AND objid = %s', [modelName, objId])
+    rows = [(modelName, objId, field, value) for field, value in values.items() if value]
+    if rows:
+      cursor.executemany(self.insertSql, rows)
+  def remove(self, modelName, objId):
+    connection.cursor().execute('DELETE FROM ' + _TableName + ' WHERE model = %s AND objid = %s', [modelName, objId])
+  def clear(self):
+    connection.cursor().execute('DELETE FROM ' + _TableName)
+  # A where clause (and its parameters) for .extra() on a modelName queryset,
+  # selecting the objects whose 'field' matches every token. The matches stay
+  # in a subquery, however many there are.
+  def match_clause(self, modelName, field, tokens):
+    return 'id IN (SELECT objid FROM ' + _TableName + ' WHERE ' + self.matchSql + ' AND model = %s AND field = %s)', [self.build_query(tokens), modelName, field]
+
+class SQLiteFullTextBackend(FullTextBackend):
+  insertSql = 'INSERT INTO ' + _TableName + ' (model, objid, field, body) VALUES (%s, %s, %s, %s)'
+  matchSql = _TableName + ' MATCH %s'
+  def build_query(self, tokens):
+    return ' '.join('"%s"*' % token.replace('"', '""') for token in tokens)
+
+class PostgreSQLFullTextBackend(FullTextBackend):
+  insertSql = 'INSERT INTO ' + _TableName + ' (model, objid, field, document) VALUES (%s, %s, %s, to_tsvector(\'simple\', %s))'
+  matchSql = 'document @@ to_tsquery(\'simple\', %s)'
+  def build_query(self, tokens):
+    # tokens are plain word characters, so they can't carry tsquery operators
+    return ' & '.join(token + ':*' for token in tokens)
+
+_Backends = {
+  'sqlite'     : SQLiteFullTextBackend,
+  'postgresql' : PostgreSQLFullTextBackend,
+}
+
+_backend = None
+
+def get_backend():
+  global _backend
+  name = getattr(settings, 'TRACKER_FULLTEXT_BACKEND', None)
+  if not name:
+    return None
+  if not isinstance(_backend, _Backends[name]):
+    _backend = _Backends[name]()
+  return _backend
+
+_Targets = {}
+
+# Resolves a search key like 'donation__donor__alias' to the lookup that selects
+# the related object ('donation__donor'), and the indexed model and field it
+# refers to, or None if the field isn't in the index
+def resolve_target(Model, key):
+  target = _Targets.get((Model, key), False)
+  if target is False:
+    target = None
+    toks = key.split('__')
+    current = Model
+    for tok in toks[:-1]:
+      field, model, direct, m2m = current._meta.get_field_by_name(tok)
+      current = field.rel.to if direct else field.model
+    modelName = current._meta.model_name
+    if toks[-1] in IndexedFields.get(modelName, []):
+      path = '__'.join(toks[:-1]) or 'pk'
+      target = (path + '__in', modelName, toks[-1])
+    _Targets[(Model, key)] = target
+  return target
+
+# Builds the equivalent of filters.model_general_filter on top of the index.
+# 'plan' is the search plan for the model, so every field keeps the permission
+# restrictions it would have in a plain search (e.g. only approved comments)
+def general_filter(Model, plan, text):
+  backend = get_backend()
+  tokens = tokenize(text)
+  if not backend or not tokens:
+    return None
+  query = Q()
+  for lookup, rule in plan:
+    target = resolve_target(Model, lookup[:-len('__icontains')])
+    if target:
+      path, modelName, field = target
+      where, params = backend.match_clause(modelName, field, tokens)
+      matching = IndexedModels[modelName].objects.extra(where=[where], params=params).values('id')
+      query |= Q(**{ path: matching }) & rule
+    else:
+      query |= Q(**{ lookup: text }) & rule
+  if not query:
+    # nothing to search in, and an empty Q() would match everything
+    query = Q(pk__in=[])
+  return query
+
+def index_object(modelName, instance):
+  get_backend().index(modelName, instance.pk, dict((field, getattr(instance, field)) for field in IndexedFields[modelName]))
+
+def rebuild_index():
+  backend = get_backend()
+  backend.clear()
+  for modelName, Model in IndexedModels.items():
+    for values in Model.objects.values_list('pk', *IndexedFields[modelName]).iterator():
+      backend.index(modelName, values[0], dict(zip(IndexedFields[modelName], values[1:])))
+
+@receiver(signals.post_save, sender=Donation, dispatch_uid='tracker.fulltext.donation_save')
+@receiver(signals.post_save, sender=Donor, dispatch_uid='tracker.fulltext.donor_save')
+@receiver(signals.post_save, sender=Bid, dispatch_uid='tracker.fulltext.bid_save')
+@receiver(signals.post_save, sender=Prize, dispatch_uid='tracker.fulltext.prize_save')
+def object_saved(sender, instance, raw, **kwargs):
+  if get_backend():
+    index_object(sender._meta.model_name, instance)
+
+@receiver(signals.post_delete, sender=Donation, dispatch_uid='tracker.fulltext.donation_delete')
+@receiver(signals.post_delete, sender=Donor, dispatch_uid='tracker.fulltext.donor_delete')
+@receiver(signals.post_delete, sender=Bid, dispatch_uid='tracker.fulltext.bid_delete')
+@receiver(signals.post_delete, sender=Prize, dispatch_uid='tracker.fulltext.prize_delete')
+def object_deleted(sender, instance, **kwargs):
+  if get_backend():
+    get_backend().remove(sender._meta.model_name, instance.pk)
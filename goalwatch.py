@@ -0,0 +1,57 @@
+from django.db.models import F
+import datetime
+import pytz
+
+from tracker.models import *
+import tracker.cacheutil as cacheutil
+import tracker.scheduleindex as scheduleindex
+import tracker.bidforest as bidforest
+import tracker.viewutil as viewutil
+
+# Closes bids once their goal is met and reveals the hidden bids that depend
+# on them. Once propagate_bid_delta has applied a donation's amount to a bid's
+# ancestor chain, the open targets on that chain whose total now reaches their
+# goal are read back in one query; they are then closed (with their options)
+# and their dependent bids opened (with theirs), one UPDATE each, and every
+# transition goes to the 'bid' log.
+#
+# The totals are compared in the database, after the update, so concurrent
+# donations to the same chain can't both miss the crossing.
+
+# the open targets of 'chain' (a queryset) that have met their goal, the same
+# rule Bid.update_total closes a bid by; a bid war's parent stays open
+def met_goals(chain):
+  return list(chain.filter(state='OPENED', istarget=True, goal__isnull=False, total__gte=F('goal')))
+
+def _event_id(bid):
+  return bid.event_id or bidforest._bid_event_id(bid)
+
+def _event(eventId):
+  for event in cacheutil.get_events():
+    if event.id == eventId:
+      return event
+  return None
+
+# Closes the bids (which have just met their goal) and their options, and
+# opens the hidden bids that depend on them
+def reached(bids):
+  if not bids:
+    return
+  bidIds = [bid.id for bid in bids]
+  viewutil.get_tree_queryset_descendants(Bid, bids, include_self=True).filter(state='OPENED').update(state='CLOSED')
+  dependents = list(Bid.objects.filter(biddependency__in=bidIds, state='HIDDEN'))
+  if dependents:
+    now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+    viewutil.get_tree_queryset_descendants(Bid, dependents, include_self=True).filter(state='HIDDEN').update(state='OPENED', revealedtime=now)
+  eventIds = set()
+  for bid in bids:
+    eventIds.add(_event_id(bid))
+    viewutil.tracker_log(u'bid', u'Closed bid {0} ({1}), its goal of {2} was met'.format(bid.id, bid.fullname(), bid.goal), event=_event(_event_id(bid)))
+  for dependent in dependents:
+    eventIds.add(_event_id(dependent))
+    viewutil.tracker_log(u'bid', u'Opened bid {0} ({1}), the bid it depends on met its goal'.format(dependent.id, dependent.fullname()), event=_event(_event_id(dependent)))
+  # the updates above send no signals
+  for eventId in eventIds:
+    bidforest.invalidate(eventId)
+    cacheutil.invalidate_index(eventId)
+    scheduleindex.invalidate(eventId)
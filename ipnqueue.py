@@ -0,0 +1,233 @@
+from django.db import connection, transaction
+from django.db.models import Q, F
+from django.http import QueryDict
+from django.utils import timezone
+import post_office.mail
+import threading
+import codecs
+import traceback
+import datetime
+
+from tracker.models import *
+import tracker.paypalutil as paypalutil
+import tracker.viewutil as viewutil
+import tracker.postbacks as postbacks
+import tracker.livefeed as livefeed
+
+# PayPal IPNs are handled in two steps. views.ipn only stores the raw
+# notification (ingest) and answers PayPal right away; the workers here then
+# verify and apply it. Processing is idempotent on (txn_id, payment_status):
+# PayPal re-sending a notification we already handled does nothing, and a
+# failed attempt is rolled back and retried later with exponential backoff.
+# The IPNs of one donation are applied one at a time and in the order they
+# were received: one that comes up after a later IPN of the same donation (or
+# transaction) was applied is superseded by it and skipped, so a retried
+# 'Pending' can't undo a 'Completed'.
+#
+# Run the workers with 'manage.py process_ipns', or call process_pending() to
+# work through the queue in the current thread.
+
+_RetryBaseDelay = datetime.timedelta(seconds=30)
+_RetryMaxDelay = datetime.timedelta(hours=1)
+_MaxAttempts = 8
+# a claim older than this belongs to a worker that died, so it is up for grabs again
+_ClaimTimeout = datetime.timedelta(minutes=10)
+
+def ingest(request):
+  txnId = request.POST.get('txn_id', '')
+  paymentStatus = request.POST.get('payment_status', '')
+  if txnId:
+    existing = QueuedIPN.objects.filter(txn_id=txnId, payment_status=paymentStatus, state__in=['PENDING', 'PROCESSING', 'DONE'])
+    if existing.exists():
+      # PayPal is re-sending something that is already queued or processed
+      return existing[0]
+  return QueuedIPN.objects.create(
+    txn_id=txnId[:32],
+    payment_status=paymentStatus[:64],
+    # the body exactly as PayPal sent it, the verification postback has to
+    # echo it back unchanged; it is urlencoded, so latin-1 holds it losslessly
+    query=request.body.decode('latin-1'),
+    contenttype=request.META.get('CONTENT_TYPE', ''),
+    getquery=request.GET.urlencode(),
+    ipaddress=request.META.get('REMOTE_ADDR', ''),
+    secure=request.is_secure())
+
+# the encoding the IPN's fields are in, named by its 'charset' field
+def ipn_charset(body):
+  charset = QueryDict(body, encoding='latin-1').get('charset', 'utf-8')
+  try:
+    return codecs.lookup(charset).name
+  except LookupError:
+    return 'utf-8'
+
+# Stands in for the original HttpRequest when the IPN is verified and parsed
+class StoredIPNRequest(object):
+  method = 'POST'
+  def __init__(self, entry):
+    self.body = entry.query.encode('latin-1')
+    self.encoding = ipn_charset(self.body)
+    self.POST = QueryDict(self.body, encoding=self.encoding)
+    self.GET = QueryDict(entry.getquery)
+    self.META = { 'REMOTE_ADDR': entry.ipaddress, 'CONTENT_TYPE': entry.contenttype }
+    self.secure = entry.secure
+  def is_secure(self):
+    return self.secure
+
+def retry_delay(attempts):
+  return min(_RetryBaseDelay * (2 ** max(attempts - 1, 0)), _RetryMaxDelay)
+
+def claim(entryId, now=None):
+  now = now or timezone.now()
+  claimable = Q(state='PENDING', nextattempt__lte=now) | Q(state='PROCESSING', claimed__lt=now - _ClaimTimeout)
+  # only one worker can win this update, the others see 0 rows changed
+  if QueuedIPN.objects.filter(claimable, pk=entryId).update(state='PROCESSING', claimed=now, attempts=F('attempts') + 1):
+    return QueuedIPN.objects.get(pk=entryId)
+  return None
+
+def claim_next(now=None, batch=10):
+  now = now or timezone.now()
+  claimable = Q(state='PENDING', nextattempt__lte=now) | Q(state='PROCESSING', claimed__lt=now - _ClaimTimeout)
+  for entryId in QueuedIPN.objects.filter(claimable).order_by('received').values_list('pk', flat=True)[:batch]:
+    entry = claim(entryId, now=now)
+    if entry:
+      return entry
+  return None
+
+# the donation named by the IPN's 'custom' field, see paypalutil.get_ipn_donation
+def ipn_donation_id(entry):
+  try:
+    return int(QueryDict(entry.query).get('custom', '').split(':')[0])
+  except ValueError:
+    return None
+
+def is_superseded(entry, donationId):
+  same = []
+  if entry.txn_id:
+    same.append(Q(txn_id=entry.txn_id))
+  if donationId:
+    same.append(Q(donation=donationId))
+  if not same:
+    return False
+  later = Q(received__gt=entry.received) | Q(received=entry.received, pk__gt=entry.pk)
+  return QueuedIPN.objects.filter(reduce(lambda a, b: a | b, same), later, state='DONE').exists()
+
+def process_entry(entry):
+  if entry.txn_id and QueuedIPN.objects.filter(txn_id=entry.txn_id, payment_status=entry.payment_status, state='DONE').exclude(pk=entry.pk).exists():
+    QueuedIPN.objects.filter(pk=entry.pk).update(state='DUPLICATE')
+    return None
+  donationId = ipn_donation_id(entry)
+  ipnObj = None
+  try:
+    # verifying asks PayPal over the network, which is done before the
+    # transaction is opened and the donation locked
+    ipnObj = paypalutil.create_ipn(StoredIPNRequest(entry))
+    # the live feed only hears of the changes once they are committed
+    with livefeed.deferred(), transaction.atomic():
+      if donationId:
+        # held until the IPN is applied, so another worker's IPN for the same
+        # donation waits for it and then sees it in is_superseded
+        list(Donation.objects.select_for_update().filter(pk=donationId).values_list('pk', flat=True))
+      if is_superseded(entry, donationId):
+        QueuedIPN.objects.filter(pk=entry.pk).update(state='SUPERSEDED')
+        return None
+      donation = apply_ipn(ipnObj)
+      QueuedIPN.objects.filter(pk=entry.pk).update(state='DONE', donation=donation, lasterror='')
+  except Exception as inst:
+    error = u'{0}\n{1}'.format(inst, traceback.format_exc(inst))
+    if entry.attempts >= _MaxAttempts:
+      QueuedIPN.objects.filter(pk=entry.pk).update(state='FAILED', lasterror=error)
+      if ipnObj:
+        paypalutil.log_ipn(ipnObj, u'{0}. POST data : {1}'.format(error, entry.query))
+      else:
+        viewutil.tracker_log('paypal', u'IPN processing failed: {0}. POST data : {1}'.format(error, entry.query))
+    else:
+      QueuedIPN.objects.filter(pk=entry.pk).update(state='PENDING', lasterror=error, nextattempt=timezone.now() + retry_delay(entry.attempts))
+    return None
+  if donation.transactionstate == 'COMPLETED':
+    # outside the transaction, a slow or broken listener must not undo the donation
+    postbacks.send_donation(donation)
+  return donation
+
+# Everything views.ipn used to do synchronously, given the verified (and not
+# yet saved) IPN. Raises on failure so the caller can roll back and retry.
+def apply_ipn(ipnObj):
+  ipnObj.save()
+
+  donation = paypalutil.initialize_paypal_donation(ipnObj)
+  donation.save()
+
+  if donation.transactionstate == 'PENDING':
+    reasonExplanation, ourFault = paypalutil.get_pending_reason_details(ipnObj.pending_reason)
+    if donation.event.pendingdonationemailtemplate:
+      formatContext = {
+        'event': donation.event,
+        'donation': donation,
+        'donor': donation.donor,
+        'pending_reason': ipnObj.pending_reason,
+        'reason_info': reasonExplanation if not ourFault else '',
+      }
+      post_office.mail.send(recipients=[donation.donor.email], sender=donation.event.donationemailsender, template=donation.event.pendingdonationemailtemplate, context=formatContext)
+    # some pending reasons can be a problem with the receiver account, we should keep track of them
+    if ourFault:
+      paypalutil.log_ipn(ipnObj, 'Unhandled pending error')
+  elif donation.transactionstate == 'COMPLETED':
+    if donation.event.donationemailtemplate != None:
+      formatContext = {
+        'donation': donation,
+        'donor': donation.donor,
+        'event': donation.event,
+        'prizes': viewutil.get_donation_prize_info(donation),
+      }
+      post_office.mail.send(recipients=[donation.donor.email], sender=donation.event.donationemailsender, template=donation.event.donationemailtemplate, context=formatContext)
+  elif donation.transactionstate == 'CANCELLED':
+    # eventually we may want to send out e-mail for some of the possible cases
+    # such as payment reversal due to double-transactions (this has happened before)
+    paypalutil.log_ipn(ipnObj, 'Cancelled/reversed payment')
+  return donation
+
+# Works through everything that is due, in the current thread. Returns the
+# number of entries that were attempted.
+def process_pending(limit=None, now=None):
+  count = 0
+  while limit is None or count < limit:
+    entry = claim_next(now=now)
+    if not entry:
+      break
+    process_entry(entry)
+    count += 1
+  postbacks.get_dispatcher().flush()
+  return count
+
+def _worker(stopEvent, once, idleSleep):
+  try:
+    while not stopEvent.is_set():
+      entry = claim_next()
+      if entry:
+        process_entry(entry)
+      elif once:
+        break
+      else:
+        stopEvent.wait(idleSleep)
+      # record the postbacks that finished in the meantime
+      postbacks.get_dispatcher().save_results()
+  finally:
+    # every thread gets its own database connection, which must not leak
+    connection.close()
+
+# Runs 'workers' threads pulling from the queue. With once=True they stop as
+# soon as nothing is due, otherwise they keep polling until stopEvent is set.
+def run_workers(workers=4, once=False, idleSleep=1.0, stopEvent=None):
+  stopEvent = stopEvent or threading.Event()
+  threads = [threading.Thread(target=_worker, args=(stopEvent, once, idleSleep)) for i in range(workers)]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+  try:
+    while any(thread.is_alive() for thread in threads):
+      for thread in threads:
+        thread.join(0.5)
+  except KeyboardInterrupt:
+    stopEvent.set()
+    for thread in threads:
+      thread.join()
+  postbacks.get_dispatcher().flush()
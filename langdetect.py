@@ -0,0 +1,175 @@
+from django.db import connection, DatabaseError
+from django.db.models import signals
+from django.dispatch import receiver
+from django.core.cache import cache
+import threading
+import hashlib
+import warnings
+import Queue
+
+from tracker.models import *
+from tracker.models.donation import LanguageChoices
+import tracker.cacheutil as cacheutil
+
+try:
+  import cld
+except ImportError:
+  warnings.warn('Could not import cld, chromium_compact_language_detector not installed, language detection will not function')
+  cld = None
+
+# Works out which language donation comments are in without making the save
+# wait for it. A comment whose language is unknown is handed to a small pool
+# of worker threads once the donation is saved. The workers write their results
+# back themselves, with one UPDATE per language, through their own database
+# connection: that one is in autocommit mode, so no request's transaction can
+# roll them back. A donation whose own transaction isn't committed yet can't be
+# seen from there, its result is kept and tried again whenever a worker has
+# been idle for a while, a few times before it is given up on. The queue is
+# bounded, anything that doesn't fit (or was lost with its process) is picked
+# up by the 'detect_languages' command.
+#
+# Detected languages are cached by the comment's content, so a comment that
+# was seen before (re-saved, or the same text from someone else) gets its
+# language when it is saved, without being detected again.
+
+_Namespace = 'language'
+_Codes = set(code for code, name in LanguageChoices)
+_MaxAttempts = 12
+
+def content_key(comment):
+  return hashlib.sha1(comment.encode('utf-8')).hexdigest()
+
+def _detect(comment):
+  if not cld:
+    return 'un'
+  detectedLangName, detectedLangCode, isReliable, textBytesFound, details = cld.detect(comment.encode('utf-8'), hintLanguageCode='en')
+  return detectedLangCode if detectedLangCode in _Codes else 'un'
+
+def detect(comment):
+  return cacheutil.get_or_compute(_Namespace, content_key(comment), lambda: _detect(comment))
+
+# the language of a comment that was detected before, None if it wasn't
+def cached_language(comment):
+  return cache.get(cacheutil.make_key(_Namespace, content_key(comment)))
+
+def _save_languages(languages):
+  for language in set(languages.values()):
+    if language != 'un':
+      Donation.objects.filter(pk__in=[donationId for donationId, found in languages.items() if found == language], commentlanguage='un').update(commentlanguage=language)
+
+class LanguageClassifier(object):
+  def __init__(self, workers=2, maxQueued=1000, detector=detect, retryInterval=5.0):
+    self.workers = workers
+    self.detector = detector
+    self.retryInterval = retryInterval
+    self.work = Queue.Queue(maxQueued)
+    self.results = Queue.Queue()
+    self.lock = threading.Lock()
+    self.threads = []
+  def _start_workers(self):
+    # called with self.lock held
+    self.threads = [thread for thread in self.threads if thread.is_alive()]
+    while len(self.threads) < self.workers:
+      thread = threading.Thread(target=self._worker)
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+  # False if the queue is full, the comment is left for the backfill then
+  def submit(self, donationId, comment):
+    with self.lock:
+      self._start_workers()
+    try:
+      self.work.put_nowait((donationId, comment))
+      return True
+    except Queue.Full:
+      return False
+  def _worker(self):
+    while True:
+      try:
+        donationId, comment = self.work.get(timeout=self.retryInterval)
+      except Queue.Empty:
+        # idle for a while: retry what couldn't be written yet, then let go of
+        # this thread's connection, like the ipn workers do
+        try:
+          self.save_results()
+        finally:
+          connection.close()
+        continue
+      try:
+        self.results.put((donationId, self.detector(comment), 0))
+        self.save_results()
+      finally:
+        self.work.task_done()
+  # Writes out what the workers found so far, returns the number of donations
+  # that were written. Must not run inside a transaction, a rollback would
+  # lose the results already taken off the queue.
+  def save_results(self):
+    # a donation submitted more than once keeps its latest result
+    languages = {}
+    attempts = {}
+    while True:
+      try:
+        donationId, language, attempt = self.results.get_nowait()
+      except Queue.Empty:
+        break
+      languages[donationId] = language
+      attempts[donationId] = attempt
+    if not languages:
+      return 0
+    try:
+      _save_languages(languages)
+      saved = set(Donation.objects.filter(pk__in=languages.keys()).values_list('pk', flat=True))
+    except DatabaseError:
+      saved = set()
+    for donationId, language in languages.items():
+      if donationId not in saved and attempts[donationId] + 1 < _MaxAttempts:
+        self.results.put((donationId, language, attempts[donationId] + 1))
+    return len(saved)
+  # waits for the workers to finish and saves the results
+  def flush(self):
+    self.work.join()
+    return self.save_results()
+
+_classifier = None
+_classifierLock = threading.Lock()
+
+def get_classifier():
+  global _classifier
+  with _classifierLock:
+    if _classifier is None:
+      _classifier = LanguageClassifier()
+    return _classifier
+
+# The backfill: detects every unknown comment (of one event, or of all of
+# them), 'batchSize' donations at a time. Returns the number of donations
+# that got a language.
+def detect_languages(event=None, batchSize=500):
+  donations = Donation.objects.filter(commentlanguage='un').exclude(comment='').order_by('id')
+  if event:
+    donations = donations.filter(event=event)
+  found = 0
+  lastId = 0
+  while True:
+    batch = list(donations.filter(id__gt=lastId).values_list('id', 'comment')[:batchSize])
+    if not batch:
+      break
+    languages = dict((donationId, detect(comment)) for donationId, comment in batch)
+    _save_languages(languages)
+    found += sum(1 for language in languages.values() if language != 'un')
+    lastId = batch[-1][0]
+  return found
+
+@receiver(signals.pre_save, sender=Donation, dispatch_uid='tracker.langdetect.donation_pre_save')
+def donation_language(sender, instance, raw, **kwargs):
+  if raw:
+    return
+  if not instance.comment:
+    instance.commentlanguage = 'un'
+  elif instance.commentlanguage in ('un', None):
+    instance.commentlanguage = cached_language(instance.comment) or 'un'
+
+@receiver(signals.post_save, sender=Donation, dispatch_uid='tracker.langdetect.donation_save')
+def donation_saved(sender, instance, raw, **kwargs):
+  if raw or not cld or not instance.comment or instance.commentlanguage != 'un':
+    return
+  get_classifier().submit(instance.id, instance.comment)
@@ -0,0 +1,208 @@
+from django.core.cache import cache
+from django.db.models import Q, signals
+from django.dispatch import receiver
+from contextlib import contextmanager
+import threading
+import time
+
+from tracker.models import *
+
+# A push channel for overlays and the donation processing pages, so they don't
+# have to poll the 'recent', 'toread' and 'toprocess' feeds. The model signals
+# publish every change once, as an entry in a ring buffer kept in the cache,
+# and each connected client (see views.live) only reads the buffer. That way
+# the database sees one query per change however many clients are listening.
+#
+# Entries are numbered; a client passes the last number it saw (the SSE
+# Last-Event-ID) to pick up where it left off. If it was gone long enough that
+# entries fell out of the buffer it gets a 'reset' instead, and should reload
+# its state with a regular search before following the feed again.
+#
+# Changes made inside a deferred() block (the ipn workers and the donate page
+# wrap their transactions in one) are only published once the block is left,
+# and dropped if it raised, so clients never see a donation or total from a
+# transaction that was rolled back. Publishing reads the rows as they are then,
+# never the values the signal saw.
+#
+# Entries are stored unfiltered, with a flag telling whether the public may see
+# them at all; views.live applies the usual privacy filters per client.
+#
+# Publishers and clients only meet in the cache, so with more than one server
+# process this needs a shared backend (memcached etc.), not the default locmem.
+
+_KeyPrefix = 'tracker:live'
+_RingSize = 1000
+_EntryTimeout = 60*60
+_Forever = 60*60*24*30
+
+def _seq_key():
+  return _KeyPrefix + ':seq'
+
+def _slot_key(seq):
+  return '%s:slot:%d' % (_KeyPrefix, seq % _RingSize)
+
+def latest():
+  return cache.get(_seq_key()) or 0
+
+def publish(kind, eventId, data, public=True):
+  try:
+    seq = cache.incr(_seq_key())
+  except ValueError:
+    cache.add(_seq_key(), 0, _Forever)
+    seq = cache.incr(_seq_key())
+  cache.set(_slot_key(seq), { 'id': seq, 'kind': kind, 'event': eventId, 'public': public, 'data': data }, _EntryTimeout)
+  return seq
+
+# Returns (entries, cursor, missed): the entries after 'cursor' in order, the
+# cursor to continue from, and whether entries were lost in between
+def read_since(cursor):
+  seq = latest()
+  if cursor > seq:
+    # the cache was cleared, nothing the client saw is meaningful anymore
+    return [], seq, True
+  start = max(cursor + 1, seq - _RingSize + 1)
+  missed = start > cursor + 1
+  slots = cache.get_many([_slot_key(i) for i in range(start, seq + 1)])
+  entries = []
+  gap = False
+  for i in range(start, seq + 1):
+    entry = slots.get(_slot_key(i))
+    if entry is None or entry['id'] != i:
+      # usually a publisher that has bumped the counter but not written its
+      # entry yet; only a hole with later entries behind it is really lost
+      gap = True
+      continue
+    if gap:
+      missed = True
+      gap = False
+    entries.append(entry)
+    cursor = i
+  if not entries and not gap:
+    cursor = seq
+  return entries, cursor, missed
+
+def format_entry(kind, seq, data):
+  return 'id: %d\nevent: %s\ndata: %s\n\n' % (seq, kind, data)
+
+# Follows the buffer for 'duration' seconds, yielding an SSE message for each
+# entry 'transform' returns data for. Ends afterwards so the server thread is
+# freed; EventSource clients reconnect on their own with their Last-Event-ID.
+def follow(cursor, transform, duration=30, poll=0.5, keepalive=10, sleep=time.sleep):
+  yield 'retry: 2000\n\n'
+  started = lastSent = time.time()
+  while True:
+    entries, nextCursor, missed = read_since(cursor)
+    if missed:
+      yield format_entry('reset', nextCursor, '{}')
+      lastSent = time.time()
+    cursor = nextCursor
+    for entry in entries:
+      data = transform(entry)
+      if data is not None:
+        yield format_entry(entry['kind'], entry['id'], data)
+        lastSent = time.time()
+    now = time.time()
+    if now - started >= duration:
+      return
+    if now - lastSent >= keepalive:
+      yield ': keepalive\n\n'
+      lastSent = now
+    sleep(poll)
+
+_BidFields = ('id', 'name', 'event', 'speedrun', 'speedrun__event', 'parent', 'state', 'goal', 'total', 'count', 'istarget')
+
+def donation_row(donationId):
+  fields = [f.name for f in Donation._meta.concrete_fields]
+  fields += ['donor__' + f.name for f in Donor._meta.concrete_fields if not f.rel]
+  fields += ['event__usepaypalsandbox']
+  rows = list(Donation.objects.filter(pk=donationId).values(*fields))
+  return rows[0] if rows else None
+
+def publish_donation(donationId):
+  row = donation_row(donationId)
+  if row:
+    sandbox = row.pop('event__usepaypalsandbox')
+    public = row['transactionstate'] == 'COMPLETED' and row['testdonation'] == sandbox
+    publish('donation', row['event'], row, public=public)
+
+# publishes the current totals of the given bids and everything above them
+def publish_bid_chains(bidIds):
+  bids = list(Bid.objects.filter(pk__in=bidIds).values('tree_id', 'lft', 'rght'))
+  if not bids:
+    return
+  chains = Q()
+  for bid in bids:
+    chains |= Q(tree_id=bid['tree_id'], lft__lte=bid['lft'], rght__gte=bid['rght'])
+  for row in Bid.objects.filter(chains).values(*_BidFields):
+    eventId = row.pop('speedrun__event') or row['event']
+    publish('bid', eventId, row, public=row['state'] not in ('HIDDEN', 'PENDING', 'DENIED'))
+
+_Pending = threading.local()
+
+def _pending():
+  if not hasattr(_Pending, 'changes'):
+    _Pending.depth = 0
+    _Pending.changes = { 'donations': set(), 'deleted': {}, 'bids': set() }
+  return _Pending.changes
+
+def _discard():
+  _Pending.changes = { 'donations': set(), 'deleted': {}, 'bids': set() }
+
+def flush():
+  changes = _pending()
+  _discard()
+  for donationId, eventId in sorted(changes['deleted'].items()):
+    # a delete that was rolled back didn't happen
+    if not Donation.objects.filter(pk=donationId).exists():
+      publish('donation_delete', eventId, { 'id': donationId }, public=True)
+  bidIds = set(changes['bids'])
+  for donationId in sorted(changes['donations']):
+    publish_donation(donationId)
+  if changes['donations']:
+    bidIds.update(DonationBid.objects.filter(donation__in=changes['donations']).values_list('bid', flat=True))
+  if bidIds:
+    publish_bid_chains(bidIds)
+
+# Records a change, publishing it right away unless a deferred() block is open
+def changed(donations=(), bids=(), deleted=()):
+  changes = _pending()
+  changes['donations'].update(donations)
+  changes['bids'].update(bids)
+  changes['deleted'].update(deleted)
+  if not _Pending.depth:
+    flush()
+
+@contextmanager
+def deferred():
+  _pending()
+  _Pending.depth += 1
+  try:
+    yield
+  except:
+    _Pending.depth -= 1
+    if not _Pending.depth:
+      _discard()
+    raise
+  _Pending.depth -= 1
+  if not _Pending.depth:
+    flush()
+
+@receiver(signals.post_save, sender=Donation, dispatch_uid='tracker.livefeed.donation_save')
+def donation_saved(sender, instance, raw, **kwargs):
+  if raw: return
+  changed(donations=[instance.id])
+
+@receiver(signals.post_delete, sender=Donation, dispatch_uid='tracker.livefeed.donation_delete')
+def donation_deleted(sender, instance, **kwargs):
+  changed(deleted=[(instance.id, instance.event_id)])
+
+@receiver(signals.post_save, sender=DonationBid, dispatch_uid='tracker.livefeed.donationbid_save')
+@receiver(signals.post_delete, sender=DonationBid, dispatch_uid='tracker.livefeed.donationbid_delete')
+def donation_bid_changed(sender, instance, **kwargs):
+  if kwargs.get('raw'): return
+  changed(bids=[instance.bid_id])
+
+@receiver(signals.post_save, sender=Bid, dispatch_uid='tracker.livefeed.bid_save')
+def bid_saved(sender, instance, raw, **kwargs):
+  if raw: return
+  changed(bids=[instance.id])
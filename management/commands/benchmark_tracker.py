@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from optparse import make_option
+
+import tracker.benchmarks as benchmarks
+
+class Command(BaseCommand):
+  help = 'Generate events of increasing size and time the hot endpoints against them, printing the results as JSON'
+  option_list = BaseCommand.option_list + (
+    make_option('--scales', dest='scales', default=','.join(benchmarks.ScaleOrder), help='Comma separated data set sizes to run (%s)' % ', '.join(benchmarks.ScaleOrder)),
+    make_option('--repeat', dest='repeat', type='int', default=5, help='Number of times each endpoint is timed'),
+    make_option('--seed', dest='seed', type='int', default=0, help='Seed for the generated data'),
+    make_option('--output', dest='output', default=None, help='File to write the results to instead of stdout'),
+    make_option('--noinput', action='store_false', dest='interactive', default=True, help='Do not ask for confirmation'),
+  )
+  def handle(self, *args, **options):
+    scales = [scale.strip() for scale in options['scales'].split(',') if scale.strip()]
+    for scale in scales:
+      if scale not in benchmarks.Scales:
+        raise CommandError('Unknown scale %s' % scale)
+    if options['interactive']:
+      donations = sum(benchmarks.Scales[scale]['numDonations'] for scale in scales)
+      confirm = raw_input('This adds %d generated donations (and their donors, runs, bids and prizes) to the database "%s", and leaves them there. Only use a scratch database.\nType \'yes\' to continue: ' % (donations, connection.settings_dict['NAME']))
+      if confirm != 'yes':
+        raise CommandError('Benchmark cancelled.')
+    results = benchmarks.benchmark_scales(scales, seed=options['seed'], repeat=options['repeat'])
+    if options['output']:
+      with open(options['output'], 'w') as out:
+        benchmarks.write_results(results, out)
+    else:
+      benchmarks.write_results(results, self.stdout)
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.http import Http404
+from optparse import make_option
+
+import tracker.langdetect as langdetect
+import tracker.viewutil as viewutil
+
+class Command(BaseCommand):
+  help = 'Detect the language of every donation comment whose language is still unknown'
+  option_list = BaseCommand.option_list + (
+    make_option('--event', dest='event', default=None, help='Only the donations of this event (id or short name)'),
+    make_option('--batch-size', dest='batchsize', type='int', default=500, help='Number of donations loaded and updated at a time'),
+  )
+  def handle(self, *args, **options):
+    if not langdetect.cld:
+      self.stderr.write('cld is not installed, no languages can be detected')
+      return
+    try:
+      event = viewutil.get_event(options['event']) if options['event'] else None
+    except Http404:
+      raise CommandError('No such event: %s' % options['event'])
+    found = langdetect.detect_languages(event=event, batchSize=options['batchsize'])
+    self.stdout.write('Detected the language of %d comments' % found)
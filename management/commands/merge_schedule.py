@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.http import Http404
+from optparse import make_option
+import simplejson as json
+
+import tracker.viewutil as viewutil
+
+class Command(BaseCommand):
+  args = '<event>'
+  help = 'Merge the schedule of an event (id or short name) from its spreadsheet, or from a CSV file with the same columns, and print what changed as JSON'
+  option_list = BaseCommand.option_list + (
+    make_option('--csv', dest='csv', default=None, help='Read the schedule from this CSV file instead of the spreadsheet'),
+    make_option('--dry-run', action='store_true', dest='dryrun', default=False, help='Only print what would change'),
+  )
+  def handle(self, *args, **options):
+    if len(args) != 1:
+      raise CommandError('Give the event to merge the schedule of')
+    try:
+      event = viewutil.get_event(args[0])
+    except Http404:
+      raise CommandError('No such event: %s' % args[0])
+    if not options['csv']:
+      if options['dryrun']:
+        raise CommandError('A dry run needs --csv')
+      diff = viewutil.merge_schedule_gdoc(event)
+    else:
+      with open(options['csv'], 'rb') as lines:
+        rows = viewutil.parse_csv_as_list(lines)
+      diff = viewutil.diff_schedule(event, viewutil.parse_schedule_list(event, rows))
+      if not options['dryrun']:
+        viewutil.apply_schedule_diff(event, diff)
+    self.stdout.write(json.dumps(diff.summary(), indent=1))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+import tracker.ipnqueue as ipnqueue
+
+class Command(BaseCommand):
+  help = 'Process queued PayPal IPNs'
+  option_list = BaseCommand.option_list + (
+    make_option('--workers', dest='workers', type='int', default=4, help='Number of worker threads'),
+    make_option('--once', action='store_true', dest='once', default=False, help='Stop once nothing is due instead of polling for new IPNs'),
+  )
+  def handle(self, *args, **options):
+    ipnqueue.run_workers(workers=options['workers'], once=options['once'])
@@ -9,18 +9,19 @@ import calendar
 import urllib2
 from datetime import datetime
 import re
-import cld
 
 from event import *
 from bid import *
 from donation import *
 from prize import *
+from ipn import *
 
 __all__ = [
     'FlowModel',
     'CredentialsModel',
     'Event',
     'PostbackURL',
+    'PostbackDelivery',
     'Bid',
     'DonationBid',
     'BidSuggestion',
@@ -35,6 +36,7 @@ __all__ = [
     'SpeedRun',
     'UserProfile',
     'Log',
+    'QueuedIPN',
 ]
 
 class UserProfile(models.Model):
@@ -76,3 +78,6 @@ class Log(models.Model):
       result += u': ' + m
     return result
 
+# comment language detection runs off the Donation signals, connected here so
+# that every process that loads the models (web, ipn workers, commands) has it
+import tracker.langdetect
@@ -1,5 +1,5 @@
 from django.db import models
-from django.db.models import signals,Sum,Q
+from django.db.models import signals,Sum,Q,F
 from django.core.exceptions import ValidationError
 from django.dispatch import receiver
 
@@ -113,6 +113,7 @@ class Bid(mptt.models.MPTTModel):
       # auto close this if it's a challenge with no children and the goal's been met
       if self.goal and self.state == 'OPENED' and self.total >= self.goal and self.istarget:
         self.state = 'CLOSED'
+        self._goalMet = True
     else:
       self.total = self.options.aggregate(Sum('total'))['total__sum'] or Decimal('0.00')
       self.count = self.options.aggregate(Sum('count'))['count__sum'] or 0
@@ -143,16 +144,47 @@ class Bid(mptt.models.MPTTModel):
   def fullname(self):
     return ((self.parent.fullname() + ' -- ') if self.parent else '') + self.name
 
+def propagate_bid_delta(bid, amountDelta, countDelta, includeSelf=True):
+  # Applies a signed amount/count delta to a bid and all of its ancestors in one UPDATE over the
+  # MPTT ancestor range, rather than re-aggregating and saving each level of the tree.
+  # update_total() remains the authoritative computation, and is used to repair totals.
+  if not amountDelta and not countDelta:
+    return
+  if includeSelf:
+    chain = Bid.objects.filter(tree_id=bid.tree_id, lft__lte=bid.lft, rght__gte=bid.rght)
+  else:
+    chain = Bid.objects.filter(tree_id=bid.tree_id, lft__lt=bid.lft, rght__gt=bid.rght)
+  chain.update(total=F('total') + amountDelta, count=F('count') + countDelta)
+  if amountDelta > 0:
+    # the bids on the chain whose goal this met are closed, see goalwatch
+    import tracker.goalwatch as goalwatch
+    goalwatch.reached(goalwatch.met_goals(chain))
+  if includeSelf:
+    bid.total += amountDelta
+    bid.count = (bid.count or 0) + countDelta
+
 @receiver(signals.pre_save, sender=Bid)
 def BidTotalUpdate(sender, instance, raw, **kwargs):
   if raw: return
+  # the stored totals, the instance may predate a propagate_bid_delta on it
+  stored = Bid.objects.filter(pk=instance.pk).values_list('total', 'count').first() if instance.pk else None
+  oldTotal, oldCount = stored or (Decimal('0.00'), 0)
   instance.update_total()
+  instance._totalDelta = (instance.total - oldTotal, instance.count - oldCount)
+
+@receiver(signals.post_save, sender=Bid)
+def BidGoalReached(sender, instance, raw, **kwargs):
+  if raw or not getattr(instance, '_goalMet', False): return
+  instance._goalMet = False
+  import tracker.goalwatch as goalwatch
+  goalwatch.reached([instance])
 
 @receiver(signals.post_save, sender=Bid)
 def BidParentUpdate(sender, instance, created, raw, **kwargs):
   if created or raw: return
-  if instance.parent:
-    instance.parent.save()
+  if instance.parent_id:
+    amountDelta, countDelta = getattr(instance, '_totalDelta', (Decimal('0.00'), 0))
+    propagate_bid_delta(instance, amountDelta, countDelta, includeSelf=False)
 
 class DonationBid(models.Model):
   bid = models.ForeignKey('Bid',on_delete=models.PROTECT,related_name='bids')
@@ -167,23 +199,37 @@ class DonationBid(models.Model):
     if not self.bid.is_leaf_node():
       raise ValidationError('Target bid must be a leaf node')
     self.donation.clean(self)
-    import tracker.viewutil as viewutil
-    bidsTree = viewutil.get_tree_queryset_all(Bid, [self.bid]).select_related('parent').prefetch_related('options')
-    for bid in bidsTree:
-      if bid.state == 'OPENED' and bid.goal != None and bid.goal <= bid.total:
-        bid.state = 'CLOSED'
-        if hasattr(bid, 'dependent_bids_set'):
-          for dependentBid in bid.dependent_bids_set():
-            if dependentBid.state == 'HIDDEN':
-              dependentBid.state = 'OPENED'
-              dependentBid.save()
+    # goals met by the amount are handled once it is saved, see goalwatch
   def __unicode__(self):
     return unicode(self.bid) + ' -- ' + unicode(self.donation)
 
+@receiver(signals.post_init, sender=DonationBid)
+def DonationBidTrackChanges(sender, instance, **kwargs):
+  # remember what this row contributed to the bid totals, so saves can apply a delta
+  instance._trackedBid = instance.bid_id
+  instance._trackedAmount = instance.amount
+
 @receiver(signals.post_save, sender=DonationBid)
 def DonationBidParentUpdate(sender, instance, created, raw, **kwargs):
   if raw: return
-  if instance.donation.transactionstate == 'COMPLETED': instance.bid.save()
+  if instance.donation.transactionstate == 'COMPLETED':
+    oldBid = getattr(instance, '_trackedBid', None)
+    oldAmount = Decimal(getattr(instance, '_trackedAmount', None) or 0)
+    if created or not oldBid:
+      propagate_bid_delta(instance.bid, Decimal(instance.amount), 1)
+    elif oldBid != instance.bid_id:
+      propagate_bid_delta(Bid.objects.get(pk=oldBid), -oldAmount, -1)
+      propagate_bid_delta(instance.bid, Decimal(instance.amount), 1)
+    elif oldAmount != instance.amount:
+      propagate_bid_delta(instance.bid, Decimal(instance.amount) - oldAmount, 0)
+  DonationBidTrackChanges(sender, instance)
+
+@receiver(signals.post_delete, sender=DonationBid)
+def DonationBidDeleteUpdate(sender, instance, **kwargs):
+  oldBid = getattr(instance, '_trackedBid', None) or instance.bid_id
+  oldAmount = Decimal(getattr(instance, '_trackedAmount', None) or instance.amount)
+  if instance.donation.transactionstate == 'COMPLETED':
+    propagate_bid_delta(Bid.objects.get(pk=oldBid), -oldAmount, -1)
 
 class BidSuggestion(models.Model):
   bid = models.ForeignKey('Bid', related_name='suggestions', null=False,on_delete=models.PROTECT)
@@ -1,20 +1,15 @@
-from django.db import models
+from django.db import models,transaction
 from django.db.models import signals
-from django.db.models import Count,Sum,Max,Avg
+from django.db.models import Count,Sum,Max,Avg,Q
 from django.core.exceptions import ValidationError
 from django.dispatch import receiver
 
 from tracker.validators import *
 from event import Event
+from bid import propagate_bid_delta
 
 from decimal import Decimal
 from django.utils import timezone
-try:
-  import cld
-except ImportError:
-  import warnings
-  warnings.warn('Could not import cld, chromium_compact_language_detector not installed, language detection will not function')
-  cld = None
 import calendar
 
 __all__ = [
@@ -75,10 +70,21 @@ class Donation(models.Model):
     )
     get_latest_by = 'timereceived'
     ordering = [ '-timereceived' ]
+    # keyset paging of the donation index, see tracker.pagination
+    index_together = [ ['event', 'timereceived', 'id'] ]
 
   def bid_total(self):
     return reduce(lambda a, b: a + b, map(lambda b: b.amount, self.bids.all()), Decimal('0.00'))
 
+  # the amounts of the donation's bids, and those of its prize tickets, may not add up to more than the donation
+  def check_totals(self, bidAmounts, ticketAmounts):
+    bidtotal = reduce(lambda a,b: a+b,bidAmounts,Decimal('0'))
+    if self.amount and bidtotal > self.amount:
+      raise ValidationError('Bid total is greater than donation amount: %s > %s' % (bidtotal,self.amount))
+    ticketTotal = reduce(lambda a,b: a+b,ticketAmounts,Decimal('0'))
+    if self.amount and ticketTotal > self.amount:
+      raise ValidationError('Prize ticket total is greater than donation amount: %s > %s' % (ticketTotal,self.amount))
+
   def clean(self,bid=None):
     super(Donation,self).clean()
     if self.domain == 'LOCAL': # local donations are always complete, duh
@@ -92,35 +98,36 @@ class Donation(models.Model):
     bids = set()
     if bid:
       bids |= set([bid])
-    bids |= set()|set(self.bids.all())
-    bids = map(lambda b: b.amount,bids)
-    bidtotal = reduce(lambda a,b: a+b,bids,Decimal('0'))
-    if self.amount and bidtotal > self.amount:
-      raise ValidationError('Bid total is greater than donation amount: %s > %s' % (bidtotal,self.amount))
-
-    tickets = self.tickets.all()
-    ticketTotal = reduce(lambda a,b: a+b, map(lambda b: b.amount, tickets), Decimal('0'))
-    if self.amount and ticketTotal > self.amount:
-      raise ValidationError('Prize ticket total is greater than donation amount: %s > %s' % (ticketTotal,self.amount))
-
-    if self.comment and cld:
-      if self.commentlanguage == 'un' or self.commentlanguage == None:
-        detectedLangName, detectedLangCode, isReliable, textBytesFound, details = cld.detect(self.comment.encode('utf-8'), hintLanguageCode ='en')
-        if detectedLangCode in map(lambda x: x[0], LanguageChoices):
-          self.commentlanguage = detectedLangCode
-        else:
-          self.commentlanguage = 'un'
-    else:
-      self.commentlanguage = 'un'
+    # an unsaved donation has nothing attached to it yet
+    if self.id:
+      bids |= set(self.bids.all())
+    tickets = self.tickets.all() if self.id else []
+    self.check_totals(map(lambda b: b.amount, bids), map(lambda t: t.amount, tickets))
+    # the comment's language is found after the save, see langdetect
   def __unicode__(self):
     return unicode(self.donor.visible_name() if self.donor else self.donor) + ' (' + unicode(self.amount) + ') (' + unicode(self.timereceived) + ')'
 
+# the fields the bid totals and the donor cache are derived from
+_DonationTrackedFields = ('transactionstate', 'amount', 'event_id', 'donor_id')
+
+@receiver(signals.post_init, sender=Donation)
+def DonationTrackChanges(sender, instance, **kwargs):
+  instance._tracked = dict((field, getattr(instance, field)) for field in _DonationTrackedFields)
+
 @receiver(signals.post_save, sender=Donation)
 def DonationBidsUpdate(sender, instance, created, raw, **kwargs):
   if raw: return
-  if instance.transactionstate == 'COMPLETED':
-    for b in instance.bids.all():
-      b.save()
+  trackedState = instance._tracked['transactionstate'] if hasattr(instance, '_tracked') else None
+  wasCompleted = not created and trackedState == 'COMPLETED'
+  isCompleted = instance.transactionstate == 'COMPLETED'
+  if not created and trackedState is None:
+    # previous state unknown (e.g. a deferred instance), fall back to a full recompute
+    for donationBid in instance.bids.select_related('bid'):
+      donationBid.bid.save()
+  elif wasCompleted != isCompleted:
+    sign = 1 if isCompleted else -1
+    for donationBid in instance.bids.select_related('bid'):
+      propagate_bid_delta(donationBid.bid, sign * donationBid.amount, sign)
 
 class DonorManager(models.Manager):
   def get_by_natural_key(self, email):
@@ -210,26 +217,98 @@ class DonorCache(models.Model):
   donation_max = models.DecimalField(decimal_places=2,max_digits=20,validators=[positive,nonzero],editable=False,default=0)
   @staticmethod
   @receiver(signals.post_save, sender=Donation)
+  def donation_update(sender, instance, created, raw, **args):
+    if raw: return
+    tracked = getattr(instance, '_tracked', None)
+    if not created and tracked is None:
+      # previous values unknown (e.g. a deferred instance), recompute this donor's rows
+      if instance.donor_id:
+        DonorCache.refresh(instance.donor_id, instance.event_id)
+        DonorCache.refresh(instance.donor_id, None)
+      return
+    oldContribution = None
+    if not created and tracked['transactionstate'] == 'COMPLETED' and tracked['donor_id']:
+      oldContribution = (tracked['donor_id'], tracked['event_id'], Decimal(tracked['amount']))
+    newContribution = None
+    if instance.transactionstate == 'COMPLETED' and instance.donor_id:
+      newContribution = (instance.donor_id, instance.event_id, Decimal(instance.amount))
+    # saves that only touch read/comment/bid state and the like leave the cache alone
+    if oldContribution == newContribution: return
+    if oldContribution:
+      DonorCache.remove_donation(*oldContribution)
+    if newContribution:
+      DonorCache.add_donation(*newContribution)
+  @staticmethod
   @receiver(signals.post_delete, sender=Donation)
-  def donation_update(sender, instance, **args):
-    if not instance.donor: return
-    cache,c = DonorCache.objects.get_or_create(event=instance.event,donor=instance.donor)
-    cache.update()
-    if cache.donation_count:
+  def donation_delete(sender, instance, **args):
+    tracked = getattr(instance, '_tracked', None)
+    if tracked is None:
+      tracked = dict((field, getattr(instance, field)) for field in _DonationTrackedFields)
+    if tracked['transactionstate'] == 'COMPLETED' and tracked['donor_id']:
+      DonorCache.remove_donation(tracked['donor_id'], tracked['event_id'], Decimal(tracked['amount']))
+  @staticmethod
+  def _rows_for(donorId, eventId):
+    # The per-event row and the all-events row for this donor, fetched together.
+    # Callers hold a transaction, the donor's row is locked for its duration so
+    # concurrent ipn workers apply their deltas one after the other (the cache
+    # rows can't be locked instead, the all-events row may not exist yet and
+    # unique_together doesn't cover its null event everywhere)
+    list(Donor.objects.select_for_update().filter(pk=donorId).values_list('id', flat=True))
+    return dict((c.event_id, c) for c in DonorCache.objects.filter(Q(event=eventId) | Q(event=None), donor=donorId))
+  @staticmethod
+  def add_donation(donorId, eventId, amount):
+    with transaction.atomic():
+      caches = DonorCache._rows_for(donorId, eventId)
+      for key in (eventId, None):
+        cache = caches.get(key)
+        if not cache:
+          cache,c = DonorCache.objects.get_or_create(event_id=key, donor_id=donorId)
+        cache.donation_total = Decimal(cache.donation_total) + amount
+        cache.donation_count += 1
+        cache.donation_max = max(Decimal(cache.donation_max), amount)
+        cache.donation_avg = (cache.donation_total / cache.donation_count).quantize(Decimal('0.01'))
+        cache.save()
+  @staticmethod
+  def remove_donation(donorId, eventId, amount):
+    with transaction.atomic():
+      DonorCache._remove_donation(donorId, eventId, amount)
+  @staticmethod
+  def _remove_donation(donorId, eventId, amount):
+    caches = DonorCache._rows_for(donorId, eventId)
+    emptyCaches = []
+    for key in (eventId, None):
+      cache = caches.get(key)
+      if not cache:
+        # the cache had drifted, rebuild the missing row from scratch
+        DonorCache.refresh(donorId, key)
+        continue
+      cache.donation_count -= 1
+      if cache.donation_count <= 0:
+        emptyCaches.append(cache.id)
+        continue
+      cache.donation_total = Decimal(cache.donation_total) - amount
+      cache.donation_avg = (cache.donation_total / cache.donation_count).quantize(Decimal('0.01'))
+      if amount >= cache.donation_max:
+        # the maximum cannot be derived arithmetically once its donation is gone
+        cache.donation_max = cache.completed_donations().aggregate(max=Max('amount'))['max'] or 0
       cache.save()
-    else:
-      cache.delete()
-    cache,c = DonorCache.objects.get_or_create(event=None,donor=instance.donor)
+    if emptyCaches:
+      DonorCache.objects.filter(id__in=emptyCaches).delete()
+  @staticmethod
+  def refresh(donorId, eventId):
+    cache,c = DonorCache.objects.get_or_create(event_id=eventId,donor_id=donorId)
     cache.update()
     if cache.donation_count:
       cache.save()
     else:
       cache.delete()
+  def completed_donations(self):
+    donations = Donation.objects.filter(donor=self.donor_id,transactionstate='COMPLETED')
+    if self.event_id:
+      donations = donations.filter(event=self.event_id)
+    return donations
   def update(self):
-    aggregate = Donation.objects.filter(donor=self.donor,transactionstate='COMPLETED')
-    if self.event:
-      aggregate = aggregate.filter(event=self.event)
-    aggregate = aggregate.aggregate(total=Sum('amount'),count=Count('amount'),max=Max('amount'),avg=Avg('amount'))	  
+    aggregate = self.completed_donations().aggregate(total=Sum('amount'),count=Count('amount'),max=Max('amount'),avg=Avg('amount'))
     self.donation_total = aggregate['total'] or 0
     self.donation_count = aggregate['count'] or 0
     self.donation_max = aggregate['max'] or 0
@@ -255,4 +334,9 @@ class DonorCache(models.Model):
     app_label = 'tracker'
     ordering = ('donor', )
     unique_together = ('event', 'donor')
+    # keyset paging of the donor index, see tracker.pagination
+    index_together = [ ['event', 'donation_total', 'id'] ]
   
+
+# connected after every other Donation post_save handler, so that they all see the previously saved values
+signals.post_save.connect(DonationTrackChanges, sender=Donation)
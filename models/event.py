@@ -21,6 +21,7 @@ __all__ = [
   'CredentialsModel',
   'Event',
   'PostbackURL',
+  'PostbackDelivery',
   'SpeedRun',
 ]
 
@@ -153,8 +154,32 @@ class Event(models.Model):
 class PostbackURL(models.Model):
   event = models.ForeignKey('Event', on_delete=models.PROTECT, verbose_name='Event', null=False, blank=False, related_name='postbacks')
   url = models.URLField(blank=False,null=False,verbose_name='URL')
+  batch = models.BooleanField(default=False,verbose_name='Batch Donations',help_text='Send donations that arrive close together as a single JSON list instead of one request each')
   class Meta:
     app_label = 'tracker'
+  def __unicode__(self):
+    return self.url
+
+PostbackDeliveryStateChoices = (('SENT', 'Sent'), ('FAILED', 'Failed'), ('SKIPPED', 'Skipped (endpoint unavailable)'))
+
+# One POST (or attempt at one) to a postback url, see tracker.postbacks
+class PostbackDelivery(models.Model):
+  postback = models.ForeignKey('PostbackURL', on_delete=models.CASCADE, related_name='deliveries', verbose_name='Postback URL')
+  timestamp = models.DateTimeField(verbose_name='Timestamp')
+  state = models.CharField(max_length=16, choices=PostbackDeliveryStateChoices, verbose_name='State')
+  donations = models.IntegerField(default=1, verbose_name='Donations')
+  payload = models.TextField(blank=True, verbose_name='Payload')
+  statuscode = models.IntegerField(null=True, blank=True, verbose_name='HTTP Status')
+  latency = models.FloatField(null=True, blank=True, verbose_name='Latency (ms)')
+  attempts = models.IntegerField(default=0, verbose_name='Attempts')
+  error = models.TextField(blank=True, verbose_name='Error')
+  class Meta:
+    app_label = 'tracker'
+    verbose_name = 'Postback Delivery'
+    verbose_name_plural = 'Postback Deliveries'
+    ordering = ['-timestamp']
+  def __unicode__(self):
+    return u'{0} -- {1} ({2})'.format(self.postback, self.timestamp, self.state)
 
 class SpeedRunManager(models.Manager):
   def get_by_natural_key(self, name, event):
@@ -0,0 +1,32 @@
+from django.db import models
+from django.utils import timezone
+
+__all__ = [
+  'QueuedIPN',
+]
+
+IPNQueueStateChoices = (('PENDING', 'Pending'), ('PROCESSING', 'Processing'), ('DONE', 'Done'), ('DUPLICATE', 'Duplicate'), ('SUPERSEDED', 'Superseded'), ('FAILED', 'Failed'))
+
+# A PayPal IPN as it was received, waiting for (or done with) processing by
+# the ipn workers (see tracker.ipnqueue)
+class QueuedIPN(models.Model):
+  received = models.DateTimeField(auto_now_add=True, verbose_name='Received')
+  txn_id = models.CharField(max_length=32, blank=True, db_index=True, verbose_name='Transaction ID')
+  payment_status = models.CharField(max_length=64, blank=True, verbose_name='Payment Status')
+  query = models.TextField(blank=True, verbose_name='POST Data')
+  contenttype = models.CharField(max_length=128, blank=True, verbose_name='Content Type')
+  getquery = models.TextField(blank=True, verbose_name='GET Data')
+  ipaddress = models.CharField(max_length=64, blank=True, verbose_name='IP Address')
+  secure = models.BooleanField(default=False, verbose_name='Received over SSL')
+  state = models.CharField(max_length=16, choices=IPNQueueStateChoices, default='PENDING', db_index=True, verbose_name='State')
+  attempts = models.IntegerField(default=0, verbose_name='Attempts')
+  nextattempt = models.DateTimeField(default=timezone.now, verbose_name='Next Attempt')
+  claimed = models.DateTimeField(null=True, blank=True, verbose_name='Claimed')
+  lasterror = models.TextField(blank=True, verbose_name='Last Error')
+  donation = models.ForeignKey('Donation', null=True, blank=True, on_delete=models.SET_NULL)
+  class Meta:
+    app_label = 'tracker'
+    verbose_name = 'Queued IPN'
+    ordering = ['received']
+  def __unicode__(self):
+    return u'{0} {1} ({2})'.format(self.txn_id or u'(no txn_id)', self.payment_status, self.state)
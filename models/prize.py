@@ -1,6 +1,6 @@
 from django.db import models
 from django.core.exceptions import ValidationError
-from django.db.models import Sum, Q
+from django.db.models import Sum, Max, Q
 
 from tracker.validators import *
 from event import Event
@@ -87,33 +87,41 @@ class Prize(models.Model):
         raise ValidationError('Maximum Bid cannot differ from Minimum Bid if Sum Donations is not checked')
     if self.image and self.imagefile:
       raise ValidationError('Cannot have both an Image URL and an Image File')
-  def eligible_donors(self):
-    qs = Donation.objects.filter(event=self.event,transactionstate='COMPLETED').select_related('donor')
+  # The amount each eligible donor has entered into this prize with, as a
+  # dict of donor id -> amount. The per-donor sum or maximum is computed by the
+  # database, so only one small row per donor is ever loaded.
+  def eligible_donor_amounts(self):
+    qs = Donation.objects.filter(event=self.event,transactionstate='COMPLETED',donor__isnull=False)
     # remove all donations from donors who have already won this prize, or have won a prize under the same category for this event
     qs = qs.exclude(Q(donor__prizewinner__prize=self) | Q(donor__prizewinner__prize__category=self.category, donor__prizewinner__prize__event=self.event))
-    if self.ticketdraw:
-      qs = qs.filter(tickets__prize=self).annotate(ticketAmount=Sum('tickets__amount'))
-    elif self.has_draw_time():
-      qs = qs.filter(timereceived__gte=self.start_draw_time(),timereceived__lte=self.end_draw_time())
     donors = {}
-    for d in qs:
+    if self.ticketdraw:
+      qs = qs.filter(tickets__prize=self)
       if self.sumdonations:
-        donors.setdefault(d.donor, Decimal('0.0'))
-        if self.ticketdraw:
-          donors[d.donor] += d.ticketAmount
-        else:
-          donors[d.donor] += d.amount
+        rows = qs.order_by().values_list('donor').annotate(amount=Sum('tickets__amount'))
       else:
-        if self.ticketdraw:
-          donors[d.donor] = max(d.ticketAmount,donors.get(d.donor,Decimal('0.0')))
-        else:
-          donors[d.donor] = max(d.amount,donors.get(d.donor,Decimal('0.0')))
-    directEntries = DonorPrizeEntry.objects.filter(prize=self).exclude(Q(donor__prizewinner__prize=self))
-    for entry in directEntries:
-      donors.setdefault(entry.donor, Decimal('0.0'))
-      donors[entry.donor] = max(entry.weight*self.minimumbid, donors[entry.donor])
+        # the largest single donation's tickets, which needs a sum per donation first
+        rows = qs.order_by().values_list('donor','id').annotate(amount=Sum('tickets__amount'))
+      for row in rows:
+        donors[row[0]] = max(row[-1], donors.get(row[0],Decimal('0.0')))
+    else:
+      if self.has_draw_time():
+        qs = qs.filter(timereceived__gte=self.start_draw_time(),timereceived__lte=self.end_draw_time())
+      donors = dict(qs.order_by().values_list('donor').annotate(amount=Sum('amount') if self.sumdonations else Max('amount')))
+    directEntries = DonorPrizeEntry.objects.filter(prize=self).exclude(Q(donor__prizewinner__prize=self)).values_list('donor','weight')
+    for donor, weight in directEntries:
+      donors[donor] = max(weight*self.minimumbid, donors.get(donor,Decimal('0.0')))
       if self.maximumbid:
-        donors[entry.donor] = min(donors[entry.donor], self.maximumbid)
+        donors[donor] = min(donors[donor], self.maximumbid)
+    return donors
+  def eligible_donors(self):
+    entries = self.weighted_entries(self.eligible_donor_amounts())
+    # a non-random prize goes to the largest donor, the rest only matter once
+    # that one has won
+    return entries if self.randomdraw else entries[:1]
+  # turns a dict of donor id -> amount into the list of draw entries, which for
+  # a non-random prize are every donor ranked by amount, the largest first
+  def weighted_entries(self, donors):
     if not donors:
       return []
     elif self.randomdraw:
@@ -121,10 +129,9 @@ class Prize(models.Model):
         if a < mn: return 0.0
         if mx != None and a > mx: return float(mx/mn)
         return float(a/mn)
-      return sorted(filter(lambda d: d['weight'] >= 1.0,map(lambda d: {'donor':d[0].id,'amount':d[1],'weight':weight(self.minimumbid,self.maximumbid,d[1])}, donors.items())),key=lambda d: d['donor'])
+      return sorted(filter(lambda d: d['weight'] >= 1.0,map(lambda d: {'donor':d[0],'amount':d[1],'weight':weight(self.minimumbid,self.maximumbid,d[1])}, donors.items())),key=lambda d: d['donor'])
     else:
-      m = max(donors.items(), key=lambda d: d[1])
-      return [{'donor':m[0].id,'amount':m[1],'weight':1.0}]
+      return map(lambda d: {'donor':d[0],'amount':d[1],'weight':1.0}, sorted(donors.items(), key=lambda d: (-d[1],d[0])))
   def games_based_drawing(self):
     return self.startrun and self.endrun
   def games_range(self):
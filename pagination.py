@@ -0,0 +1,96 @@
+from django.core.paginator import Paginator, Page
+from django.db.models import Q, Count
+import hashlib
+
+import tracker.cacheutil as cacheutil
+
+# Paging for the long index pages (donations, donors). Counting a filtered set
+# and OFFSET queries both get slower the more rows there are, so:
+#
+# - counts (and other aggregates) are cached in the event's index namespace,
+#   which the donation signals bump (see cacheutil). Changes the namespace
+#   doesn't follow, like a donor renaming themselves, leave a count slightly
+#   off until the next donation; fine for page numbers and headers.
+# - when sorted by a column with an index on (event, column, id), as
+#   Donation.timereceived and DonorCache.donation_total have, pages continue
+#   from the last row seen ('keyset' paging on the column and the id) instead
+#   of skipping rows with OFFSET. Previous/next links carry the cursor;
+#   jumping to a page by number still uses OFFSET, but only for that one page.
+
+# what an aggregate computes, Aggregate objects have no repr of their own
+def aggregate_key(alias, aggregate):
+  return (alias, type(aggregate).__name__, aggregate.lookup, sorted(aggregate.extra.items()))
+
+def cached_aggregate(namespace, queryset, **aggregates):
+  sql, params = queryset.query.sql_with_params()
+  key = 'aggregate:' + hashlib.md5(repr((sql, params, sorted(aggregate_key(alias, aggregate) for alias, aggregate in aggregates.items())))).hexdigest()
+  return cacheutil.get_or_compute(namespace, key, lambda: queryset.aggregate(**aggregates))
+
+def cached_count(namespace, queryset):
+  return cached_aggregate(namespace, queryset.order_by(), count=Count('id'))['count']
+
+# A Paginator that is told its count instead of running it
+class CountedPaginator(Paginator):
+  def __init__(self, object_list, per_page, count):
+    super(CountedPaginator, self).__init__(object_list, per_page)
+    self._count = count
+
+def encode_cursor(value, pk):
+  if hasattr(value, 'isoformat'):
+    value = value.isoformat()
+  return u'%s_%d' % (value, pk)
+
+def decode_cursor(model, field, cursor):
+  value, sep, pk = cursor.rpartition('_')
+  if not sep:
+    raise ValueError('Malformed cursor')
+  return model._meta.get_field(field).to_python(value), int(pk)
+
+class KeysetPage(Page):
+  def __init__(self, object_list, number, paginator, previousCursor, nextCursor):
+    super(KeysetPage, self).__init__(object_list, number, paginator)
+    self.previous_cursor = previousCursor
+    self.next_cursor = nextCursor
+  # the rows fetched decide, the (cached) count may be a little behind
+  def has_next(self):
+    return self.next_cursor is not None
+  def has_previous(self):
+    return self.previous_cursor is not None
+  def next_page_number(self):
+    return self.number + 1
+  def previous_page_number(self):
+    return max(self.number - 1, 1)
+
+def _after(field, value, pk, descending):
+  op = 'lt' if descending else 'gt'
+  return Q(**{field + '__' + op: value}) | Q(**{field: value, 'id__' + op: pk})
+
+# One page of 'queryset' ordered by (field, id). 'after' and 'before' are
+# cursors from a previous page's next_cursor/previous_cursor; without either
+# the page is found by its number.
+def keyset_page(queryset, field, descending, paginator, number, after=None, before=None):
+  size = paginator.per_page
+  order = [('-' if descending else '') + f for f in (field, 'id')]
+  backwardOrder = [('' if descending else '-') + f for f in (field, 'id')]
+  if before:
+    value, pk = decode_cursor(queryset.model, field, before)
+    rows = list(queryset.filter(_after(field, value, pk, not descending)).order_by(*backwardOrder)[:size + 1])
+    hasPrevious = len(rows) > size
+    rows = rows[:size]
+    rows.reverse()
+    hasNext = True
+  elif after:
+    value, pk = decode_cursor(queryset.model, field, after)
+    rows = list(queryset.filter(_after(field, value, pk, descending)).order_by(*order)[:size + 1])
+    hasNext = len(rows) > size
+    rows = rows[:size]
+    hasPrevious = True
+  else:
+    offset = (number - 1) * size
+    rows = list(queryset.order_by(*order)[offset:offset + size + 1])
+    hasNext = len(rows) > size
+    rows = rows[:size]
+    hasPrevious = number > 1
+  previousCursor = encode_cursor(getattr(rows[0], field), rows[0].id) if hasPrevious and rows else None
+  nextCursor = encode_cursor(getattr(rows[-1], field), rows[-1].id) if hasNext and rows else None
+  return KeysetPage(rows, number, paginator, previousCursor, nextCursor)
@@ -8,6 +8,7 @@ import random
 from decimal import *
 import pytz
 
+# Parses and verifies the IPN, without saving it
 def create_ipn(request):
   flag = None
   ipnObj = None
@@ -31,7 +32,7 @@ def create_ipn(request):
     else:
       donation = get_ipn_donation(ipnObj)
       ipnObj.verify(None, donation.event.paypalemail)
-  ipnObj.save()
+  # saved by the caller, see ipnqueue.apply_ipn
   return ipnObj
 
 def get_ipn(request):
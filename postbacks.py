@@ -0,0 +1,210 @@
+from django.utils import timezone
+import simplejson as json
+import threading
+import Queue
+import urllib2
+import time
+
+from tracker.models import *
+
+# Postbacks tell overlays and other listeners about completed donations. They
+# are sent by a small pool of worker threads, so a slow or dead endpoint never
+# holds up IPN processing, and each endpoint gets its own circuit breaker so a
+# dead one is skipped for a while instead of eating retries on every donation.
+#
+# Endpoints with PostbackURL.batch set receive every donation that arrives
+# within 'window' seconds of the first one as a single JSON list; all others
+# receive one JSON object per donation, as they always have.
+#
+# The workers never touch the database. What happened to each request is
+# collected and written out as PostbackDelivery rows by save_results(), which
+# whoever owns a database connection (the ipn workers) calls now and then.
+
+class CircuitBreaker(object):
+  def __init__(self, threshold=5, cooldown=60.0, clock=time.time):
+    self.threshold = threshold
+    self.cooldown = cooldown
+    self.clock = clock
+    self.failures = 0
+    self.openedAt = None
+    self.lock = threading.Lock()
+  def is_open(self):
+    return self.openedAt is not None
+  # closed, or open long enough that one request may probe the endpoint again
+  def allow(self):
+    with self.lock:
+      if self.openedAt is None:
+        return True
+      if self.clock() - self.openedAt >= self.cooldown:
+        # half-open, a further failure closes the door for another cooldown
+        self.openedAt = self.clock()
+        return True
+      return False
+  def success(self):
+    with self.lock:
+      self.failures = 0
+      self.openedAt = None
+  def failure(self):
+    with self.lock:
+      self.failures += 1
+      if self.failures >= self.threshold:
+        self.openedAt = self.clock()
+
+def postback_payload(donation):
+  # TODO: this should eventually share code with the 'search' method, to
+  return {
+    'id': donation.id,
+    'timereceived': str(donation.timereceived),
+    'comment': donation.comment,
+    'amount': donation.amount,
+    'donor__visibility': donation.donor.visibility,
+    'donor__visiblename': donation.donor.visible_name(),
+  }
+
+class PostbackDispatcher(object):
+  def __init__(self, workers=4, window=0.5, retries=3, retryDelay=0.5, timeout=5, threshold=5, cooldown=60.0):
+    self.workers = workers
+    self.window = window
+    self.retries = retries
+    self.retryDelay = retryDelay
+    self.timeout = timeout
+    self.threshold = threshold
+    self.cooldown = cooldown
+    self.work = Queue.Queue()
+    self.results = Queue.Queue()
+    self.lock = threading.Lock()
+    self.threads = []
+    self.breakers = {}
+    # postback id -> (url, eventId, payloads, timer) waiting for their window to close
+    self.pending = {}
+  def breaker(self, postbackId):
+    with self.lock:
+      if postbackId not in self.breakers:
+        self.breakers[postbackId] = CircuitBreaker(self.threshold, self.cooldown)
+      return self.breakers[postbackId]
+  def _start_workers(self):
+    # called with self.lock held
+    self.threads = [thread for thread in self.threads if thread.is_alive()]
+    while len(self.threads) < self.workers:
+      thread = threading.Thread(target=self._worker)
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+  def send(self, postback, payload):
+    with self.lock:
+      self._start_workers()
+      if not postback.batch:
+        self.work.put((postback.id, postback.url, postback.event_id, [payload], False))
+      elif postback.id in self.pending:
+        self.pending[postback.id][2].append(payload)
+      else:
+        timer = threading.Timer(self.window, self._release, [postback.id])
+        timer.daemon = True
+        self.pending[postback.id] = (postback.url, postback.event_id, [payload], timer)
+        timer.start()
+  def _release(self, postbackId):
+    with self.lock:
+      entry = self.pending.pop(postbackId, None)
+      if entry:
+        url, eventId, payloads, timer = entry
+        timer.cancel()
+        # queued while still holding the lock, so a flush() can't slip in between
+        self.work.put((postbackId, url, eventId, payloads, True))
+  def release_all(self):
+    for postbackId in list(self.pending.keys()):
+      self._release(postbackId)
+  def _worker(self):
+    while True:
+      job = self.work.get()
+      try:
+        self.results.put(self.deliver(*job))
+      finally:
+        self.work.task_done()
+  def post(self, url, body):
+    req = urllib2.Request(url, body, headers={'Content-Type': 'application/json; charset=utf-8'})
+    response = urllib2.build_opener().open(req, timeout=self.timeout)
+    try:
+      return response.getcode()
+    finally:
+      response.close()
+  def deliver(self, postbackId, url, eventId, payloads, batch):
+    body = json.dumps(payloads if batch else payloads[0])
+    result = {
+      'postback_id': postbackId,
+      'event_id': eventId,
+      'timestamp': timezone.now(),
+      'donations': len(payloads),
+      'payload': body,
+      'attempts': 0,
+      'statuscode': None,
+      'latency': None,
+      'error': '',
+    }
+    breaker = self.breaker(postbackId)
+    if not breaker.allow():
+      result['state'] = 'SKIPPED'
+      result['error'] = u'Endpoint failed {0} times in a row, waiting for it to recover'.format(breaker.failures)
+      return result
+    result['state'] = 'FAILED'
+    while result['attempts'] < self.retries:
+      result['attempts'] += 1
+      started = time.time()
+      try:
+        result['statuscode'] = self.post(url, body)
+        result['latency'] = (time.time() - started) * 1000
+        result['state'] = 'SENT'
+        result['error'] = ''
+        breaker.success()
+        break
+      except urllib2.HTTPError as inst:
+        result['statuscode'] = inst.code
+        result['error'] = unicode(inst)
+      except Exception as inst:
+        result['error'] = unicode(inst)
+      result['latency'] = (time.time() - started) * 1000
+      breaker.failure()
+      if breaker.is_open() or result['attempts'] >= self.retries:
+        break
+      time.sleep(self.retryDelay * (2 ** (result['attempts'] - 1)))
+    return result
+  # Writes out what the workers did so far, returns the number of deliveries
+  def save_results(self):
+    deliveries = []
+    while True:
+      try:
+        result = self.results.get_nowait()
+      except Queue.Empty:
+        break
+      eventId = result.pop('event_id')
+      postbackId = result.pop('postback_id')
+      if result['state'] == 'FAILED':
+        Log.objects.create(category='postback', message=u'Postback {0} failed after {1} attempts: {2}'.format(postbackId, result['attempts'], result['error']), event_id=eventId)
+      deliveries.append(PostbackDelivery(postback_id=postbackId, **result))
+    if deliveries:
+      PostbackDelivery.objects.bulk_create(deliveries)
+    return len(deliveries)
+  # Sends everything still waiting for its batch window, waits for the workers
+  # to finish and saves the results
+  def flush(self):
+    self.release_all()
+    self.work.join()
+    return self.save_results()
+
+_dispatcher = None
+_dispatcherLock = threading.Lock()
+
+def get_dispatcher():
+  global _dispatcher
+  with _dispatcherLock:
+    if _dispatcher is None:
+      _dispatcher = PostbackDispatcher()
+    return _dispatcher
+
+def send_donation(donation, dispatcher=None):
+  dispatcher = dispatcher or get_dispatcher()
+  postbacks = list(PostbackURL.objects.filter(event=donation.event_id))
+  if postbacks:
+    payload = postback_payload(donation)
+    for postback in postbacks:
+      dispatcher.send(postback, payload)
+  return len(postbacks)
@@ -0,0 +1,105 @@
+from django.db import connection
+from django.http import HttpResponse
+from django.test.utils import CaptureQueriesContext
+from collections import Counter
+import simplejson as json
+import logging
+import re
+
+# Counts the queries a request (or any block of code) makes, how long the
+# database took over them, and which statements ran more than once with only
+# their parameters changed, the usual sign of a query per row. Every request
+# going through QueryLogMiddleware is logged to 'tracker.queries' with these
+# numbers in the record's 'querystats', for whatever handler the site sets up.
+#
+# Users with the 'show_queries' permission can add '?queries' to a page to get
+# its queries as JSON instead, and users with 'show_rendertime' see the count
+# next to the render time. tests.py uses the same recorder to hold views to a
+# query budget.
+
+logger = logging.getLogger('tracker.queries')
+
+# a statement repeated this often in one request gets logged as a warning
+DuplicateWarning = 10
+
+_Strings = re.compile(r"'(?:[^']|'')*'")
+_Numbers = re.compile(r'\b\d+(?:\.\d+)?\b')
+_Lists = re.compile(r'\((?:\s*\?\s*,)+\s*\?\s*\)')
+
+# the statement with its literals taken out, so the same query for another row
+# gives the same fingerprint
+def fingerprint(sql):
+  sql = _Numbers.sub('?', _Strings.sub('?', sql))
+  return _Lists.sub('(?)', sql)
+
+def view_name(view_func):
+  return '%s.%s' % (view_func.__module__, getattr(view_func, '__name__', view_func.__class__.__name__))
+
+class QueryRecorder(CaptureQueriesContext):
+  def __init__(self, name=None, connection=connection):
+    super(QueryRecorder, self).__init__(connection)
+    self.name = name
+  # the queries so far, also while still recording
+  @property
+  def queries(self):
+    return self.captured_queries
+  @property
+  def count(self):
+    return len(self.queries)
+  @property
+  def time(self):
+    return sum(float(query['time']) for query in self.queries) * 1000
+  # (fingerprint, count) of every statement that ran more than once, most repeated first
+  def duplicates(self):
+    counts = Counter(fingerprint(query['sql']) for query in self.queries)
+    return sorted(((sql, n) for sql, n in counts.items() if n > 1), key=lambda item: -item[1])
+  def summary(self):
+    return {
+      'view': self.name,
+      'queries': self.count,
+      'db_ms': round(self.time, 3),
+      'duplicates': [{'sql': sql, 'count': n} for sql, n in self.duplicates()],
+    }
+  def log(self):
+    stats = self.summary()
+    worst = stats['duplicates'][0]['count'] if stats['duplicates'] else 0
+    level = logging.WARNING if worst >= DuplicateWarning else logging.INFO
+    logger.log(level, '%s: %d queries, %.1fms in the database, %d repeated statements', self.name, stats['queries'], stats['db_ms'], len(stats['duplicates']), extra={'querystats': stats})
+    return stats
+
+def record(name=None):
+  return QueryRecorder(name)
+
+def wants_queries(request):
+  return 'queries' in request.GET and request.user.has_perm('tracker.show_queries')
+
+# The '?queries' page. Without the middleware only connection.queries is left,
+# which Django fills in DEBUG mode only.
+def queries_response(request):
+  recorder = getattr(request, 'querylog', None)
+  if recorder is not None:
+    data = recorder.summary()
+    data['sql'] = recorder.queries
+  else:
+    data = connection.queries
+  return HttpResponse(json.dumps(data, ensure_ascii=False, indent=1), content_type='application/json;charset=utf-8')
+
+# Add 'tracker.querylog.QueryLogMiddleware' to MIDDLEWARE_CLASSES to record
+# every request. Streamed responses are logged before their content is made,
+# so queries made while streaming are not counted.
+class QueryLogMiddleware(object):
+  def process_request(self, request):
+    request.querylog = QueryRecorder(request.path)
+    request.querylog.__enter__()
+  def process_view(self, request, view_func, view_args, view_kwargs):
+    if hasattr(request, 'querylog'):
+      request.querylog.name = view_name(view_func)
+  def process_response(self, request, response):
+    recorder = getattr(request, 'querylog', None)
+    if recorder is None or recorder.final_queries is not None:
+      return response
+    recorder.__exit__(None, None, None)
+    stats = recorder.log()
+    if hasattr(request, 'user') and request.user.has_perm('tracker.show_queries'):
+      response['X-Query-Count'] = str(stats['queries'])
+    return response
@@ -1,6 +1,7 @@
 import random
 import decimal
 from decimal import Decimal
+from django.db.models import Max
 from tracker.models import *
 from tracker.models.donation import DonorVisibilityChoices, DonationDomainChoices
 import datetime
@@ -240,7 +241,8 @@ def get_bid_targets(bid, children):
     targets.append(bid)
   return targets
 
-def assign_bids(rand, donation, fromSet):
+def random_bid_split(rand, donation, fromSet):
+  result = []
   amount = random_amount(rand, maxAmount=donation.amount)
   while amount > Decimal('0.00') and len(fromSet) > 0:
     if amount < Decimal('1.00') or rand.getrandbits(1) == 1:
@@ -249,7 +251,12 @@ def assign_bids(rand, donation, fromSet):
       useAmount = random_amount(rand, minAmount=Decimal('1.00'), maxAmount=amount)
     amount = amount - useAmount
     bid = rand.choice(fromSet)
-    DonationBid.objects.create(donation=donation, bid=bid, amount=useAmount)
+    result.append((bid, useAmount))
+  return result
+
+def assign_bids(rand, donation, fromSet):
+  for bid, amount in random_bid_split(rand, donation, fromSet):
+    DonationBid.objects.create(donation=donation, bid=bid, amount=amount)
 
 def generate_runs(rand, event, numRuns, startTime):
   lastRunTime = startTime.replace(tzinfo=pytz.utc)
@@ -329,12 +336,16 @@ def generate_donations(rand, event, numDonations, startTime=None, endTime=None,
     listOfDonations.append(donation)
   return listOfDonations
   
-def build_random_event(rand, startTime=None, numDonors=0, numDonations=0, numRuns=0, numBids=0, numPrizes=0):
-  if not PrizeCategory.objects.all().exists() and numPrizes > 0:
+def ensure_prize_categories():
+  if not PrizeCategory.objects.all().exists():
     PrizeCategory.objects.create(name='Game')
     PrizeCategory.objects.create(name='Grand')
     PrizeCategory.objects.create(name='Grab Bag')
 
+def build_random_event(rand, startTime=None, numDonors=0, numDonations=0, numRuns=0, numBids=0, numPrizes=0):
+  if numPrizes > 0:
+    ensure_prize_categories()
+
   event = generate_event(rand, startTime=startTime)
   if not startTime:
     startTime = datetime.datetime.combine(event.date, datetime.time()).replace(tzinfo = pytz.utc)
@@ -348,3 +359,57 @@ def build_random_event(rand, startTime=None, numDonors=0, numDonations=0, numRun
   
   return event
 
+# Bulk mode, for data sets the size of a real marathon. Donors, donations and
+# donation bids are written with bulk_create, which sends no signals, so the
+# totals, the donor cache and the search index that the signals would have kept
+# up to date are rebuilt once at the end instead. Runs, bids and prizes are
+# few enough (and bids need their tree fields) to be saved one at a time.
+
+_BULK_BATCH_SIZE = 500
+
+def bulk_generate_donors(rand, numDonors, batchSize=_BULK_BATCH_SIZE):
+  lastId = Donor.objects.aggregate(Max('id'))['id__max'] or 0
+  for start in range(0, numDonors, batchSize):
+    Donor.objects.bulk_create([generate_donor(rand) for i in range(start, min(numDonors, start + batchSize))])
+  # bulk_create doesn't hand back the ids, but they are given out in order
+  return list(Donor.objects.filter(id__gt=lastId).order_by('id').values_list('id', flat=True))
+
+def bulk_generate_donations(rand, event, numDonations, startTime, endTime, donorIds, bidTargetsList=None, batchSize=_BULK_BATCH_SIZE):
+  for start in range(0, numDonations, batchSize):
+    donations = []
+    for i in range(start, min(numDonations, start + batchSize)):
+      donation = generate_donation(rand, event=event, minTime=startTime, maxTime=endTime)
+      donation.donor_id = pick_random_element(rand, donorIds) if donorIds else None
+      if not donation.donor_id:
+        donation.transactionstate = 'PENDING'
+      donations.append(donation)
+    Donation.objects.bulk_create(donations)
+    if bidTargetsList:
+      # the domain ids are random, so they find the new rows again
+      ids = dict(Donation.objects.filter(event=event, domainId__in=[d.domainId for d in donations]).values_list('domainId', 'id'))
+      donationBids = []
+      for donation in donations:
+        for bid, amount in random_bid_split(rand, donation, bidTargetsList):
+          donationBids.append(DonationBid(donation_id=ids[donation.domainId], bid=bid, amount=amount))
+      DonationBid.objects.bulk_create(donationBids)
+
+def build_bulk_event(rand, startTime=None, numDonors=0, numDonations=0, numRuns=0, numBids=0, numPrizes=0, batchSize=_BULK_BATCH_SIZE):
+  # imported here, viewutil pulls in a lot more than the rest of randgen needs
+  import tracker.viewutil as viewutil
+  import tracker.fulltext as fulltext
+  if numPrizes > 0:
+    ensure_prize_categories()
+  event = generate_event(rand, startTime=startTime)
+  if not startTime:
+    startTime = datetime.datetime.combine(event.date, datetime.time()).replace(tzinfo = pytz.utc)
+  event.save()
+  listOfRuns, lastRunTime = generate_runs(rand, event=event, numRuns=numRuns, startTime=startTime)
+  donorIds = bulk_generate_donors(rand, numDonors, batchSize=batchSize)
+  topBidsList, bidTargetsList = generate_bids(rand, event=event, numBids=numBids, listOfRuns=listOfRuns)
+  generate_prizes(rand, event=event, numPrizes=numPrizes, listOfRuns=listOfRuns)
+  bulk_generate_donations(rand, event, numDonations, startTime, lastRunTime, donorIds, bidTargetsList=bidTargetsList, batchSize=batchSize)
+  viewutil.rebuild_bid_totals(event)
+  viewutil.rebuild_donor_cache(event)
+  if fulltext.get_backend():
+    fulltext.rebuild_index()
+  return event
@@ -0,0 +1,247 @@
+from django.db.models import signals
+from django.dispatch import receiver
+import bisect
+import threading
+import pytz
+
+from tracker.models import *
+import tracker.cacheutil as cacheutil
+
+# An in-memory index of the schedule (run times and prize draw windows), so the
+# time based feeds can find the runs and prizes they want by bisecting sorted
+# lists instead of comparing every row's times in SQL. The feeds then only
+# need a 'pk__in' filter, which composes with everything else in the query.
+# PrizeEligibility uses the same windows to tell which prizes a donation counts
+# towards without any queries.
+#
+# There is one index per event plus one over all events, built on first use
+# in each process. Every index is tied to a cacheutil namespace version, so a
+# save anywhere (see the signal handlers at the bottom) makes all processes
+# rebuild on their next use.
+
+def _utc(time):
+  if time is not None and time.tzinfo is None:
+    return time.replace(tzinfo=pytz.utc)
+  return time
+
+def _later(a, b):
+  if a is None:
+    return b
+  if b is None:
+    return a
+  return max(a, b)
+
+# A static interval tree: the intervals sorted by start, with a segment tree of
+# the latest end time over them. Finding the intervals that overlap a span is a
+# bisect for the ones that start in time, then a walk down the segment tree
+# that only enters the branches holding an interval that ends late enough,
+# O(log n) per result.
+class IntervalIndex(object):
+  def __init__(self, intervals):
+    self.items = sorted(intervals, key=lambda item: item[0])
+    self.starts = [item[0] for item in self.items]
+    self.size = 1
+    while self.size < len(self.items):
+      self.size *= 2
+    self.maxEnd = [None] * (2 * self.size)
+    for i, item in enumerate(self.items):
+      self.maxEnd[self.size + i] = item[1]
+    for node in range(self.size - 1, 0, -1):
+      self.maxEnd[node] = _later(self.maxEnd[2 * node], self.maxEnd[2 * node + 1])
+  def __len__(self):
+    return len(self.items)
+  def _collect(self, node, lo, hi, limit, start, found):
+    if lo >= limit or self.maxEnd[node] is None or self.maxEnd[node] < start:
+      return
+    if hi - lo == 1:
+      found.append(lo)
+      return
+    mid = (lo + hi) // 2
+    self._collect(2 * node, lo, mid, limit, start, found)
+    self._collect(2 * node + 1, mid, hi, limit, start, found)
+  # the values of every interval with start <= end and end >= start, in start order
+  def overlapping(self, start, end):
+    found = []
+    if self.items:
+      self._collect(1, 0, self.size, bisect.bisect_right(self.starts, end), start, found)
+    return [self.items[i][2] for i in found]
+  def at(self, time):
+    return self.overlapping(time, time)
+
+class ScheduleIndex(object):
+  # runs are dicts with 'id', 'starttime', 'endtime' and 'openbids', prizes are
+  # dicts with 'id', 'start' and 'end' (None for prizes without a draw window)
+  def __init__(self, runs, prizes):
+    self.runs = sorted(runs, key=lambda run: (run['starttime'], run['id']))
+    self.runStarts = [run['starttime'] for run in self.runs]
+    self.runPositions = dict((run['id'], i) for i, run in enumerate(self.runs))
+    self.runIntervals = IntervalIndex([(run['starttime'], run['endtime'], run) for run in self.runs])
+    windowed = [prize for prize in prizes if prize['start'] is not None and prize['end'] is not None]
+    self.timelessPrizes = [prize['id'] for prize in prizes if prize['start'] is None and prize['end'] is None]
+    self.prizeIntervals = IntervalIndex([(prize['start'], prize['end'], prize['id']) for prize in windowed])
+    # draw windows by end time, for the 'todraw' feed
+    ended = sorted((prize['end'], prize['id']) for prize in prizes if prize['end'] is not None)
+    self.prizeEnds = [end for end, prizeId in ended]
+    self.prizeEndIds = [prizeId for end, prizeId in ended]
+    self.openEndedPrizes = [prize['id'] for prize in prizes if prize['end'] is None]
+
+  def live_runs(self, time):
+    return [run['id'] for run in self.runIntervals.at(time)]
+
+  # The runs get_upcomming_runs would pick, as a list of ids in schedule order
+  def upcoming_runs(self, time, includeCurrent=True, minRuns=None, maxRuns=None, delta=None, openBids=False):
+    start = bisect.bisect_left(self.runStarts, time)
+    candidates = self.runs[start:]
+    if includeCurrent:
+      # runs that started earlier but are still going
+      candidates = [run for run in self.runIntervals.at(time) if self.runPositions[run['id']] < start] + candidates
+    if openBids:
+      candidates = [run for run in candidates if run['openbids']]
+    if delta:
+      window = [run for run in candidates if run['endtime'] <= time + delta]
+    else:
+      window = candidates
+    if maxRuns is not None and len(window) > maxRuns:
+      candidates = candidates[:maxRuns]
+    elif minRuns is not None and len(window) < minRuns:
+      candidates = candidates[:minRuns]
+    else:
+      candidates = window
+    return [run['id'] for run in candidates]
+
+  def run_bounds(self, runIds):
+    runs = [self.runs[self.runPositions[runId]] for runId in runIds if runId in self.runPositions]
+    if not runs:
+      return None
+    return min(run['starttime'] for run in runs), max(run['endtime'] for run in runs)
+
+  # prizes whose draw window includes 'time' (or, with includeTimeless, that
+  # have none at all)
+  def live_prizes(self, time, includeTimeless=True):
+    return self.prizeIntervals.at(time) + (self.timelessPrizes if includeTimeless else [])
+
+  def prizes_between(self, start, end, includeTimeless=True):
+    return self.prizeIntervals.overlapping(start, end) + (self.timelessPrizes if includeTimeless else [])
+
+  # prizes whose draw window is over by 'time' (or that never close)
+  def ended_prizes(self, time):
+    return self.prizeEndIds[:bisect.bisect_right(self.prizeEnds, time)] + self.openEndedPrizes
+
+  # the first time after 'time' at which live_prizes may give another answer
+  # (a window opening or closing), None if it never will
+  def next_prize_change(self, time):
+    changes = []
+    opening = bisect.bisect_right(self.prizeIntervals.starts, time)
+    if opening < len(self.prizeIntervals.starts):
+      changes.append(self.prizeIntervals.starts[opening])
+    closing = bisect.bisect_left(self.prizeEnds, time)
+    if closing < len(self.prizeEnds):
+      changes.append(self.prizeEnds[closing])
+    return min(changes) if changes else None
+
+def index_namespace(eventId):
+  return 'schedule:%s' % (eventId or 'all')
+
+def invalidate(eventId):
+  cacheutil.bump(index_namespace(eventId), index_namespace(None))
+
+def build_index(eventId=None):
+  runs = SpeedRun.objects.all()
+  prizes = Prize.objects.all()
+  if eventId:
+    runs = runs.filter(event=eventId)
+    prizes = prizes.filter(event=eventId)
+  openBidRuns = set(Bid.objects.filter(state='OPENED', speedrun__isnull=False).values_list('speedrun', flat=True))
+  runRows = []
+  for run in runs.values('id', 'starttime', 'endtime'):
+    if run['starttime'] is None or run['endtime'] is None:
+      continue
+    runRows.append({ 'id': run['id'], 'starttime': _utc(run['starttime']), 'endtime': _utc(run['endtime']), 'openbids': run['id'] in openBidRuns })
+  prizeRows = []
+  for prize in prizes.values('id', 'starttime', 'endtime', 'startrun__starttime', 'endrun__endtime'):
+    # the same precedence as Prize.start_draw_time/end_draw_time
+    prizeRows.append({
+      'id': prize['id'],
+      'start': _utc(prize['startrun__starttime'] or prize['starttime']),
+      'end': _utc(prize['endrun__endtime'] or prize['endtime']),
+    })
+  return ScheduleIndex(runRows, prizeRows)
+
+# Which prizes a donation counts towards, going by its time and amount. Holds
+# every prize of one event (with their start/end runs loaded), so neither the
+# windows nor the minimum/sum rules need a query. Prizes that already have a
+# winner are left out, as the 'current' prize feed does.
+class PrizeEligibility(object):
+  def __init__(self, prizes, wonIds):
+    self.prizes = dict((prize.id, prize) for prize in prizes)
+    self.rank = dict((prize.id, i) for i, prize in enumerate(prizes))
+    drawable = [prize for prize in prizes if prize.state == 'ACCEPTED' and not prize.ticketdraw and prize.id not in wonIds]
+    self.windows = IntervalIndex([(prize.start_draw_time(), prize.end_draw_time(), prize) for prize in drawable if prize.has_draw_time()])
+    self.anytime = [prize for prize in drawable if prize.start_draw_time() is None and prize.end_draw_time() is None]
+
+  @staticmethod
+  def contribution(prize, time, amount):
+    if prize.contains_draw_time(time) and (prize.sumdonations or amount >= prize.minimumbid):
+      return amount
+    return None
+
+  # The same list as viewutil.get_donation_prize_info: 'tickets' are the
+  # donation's (prize id, amount) ticket pairs, followed by the time based
+  # prizes in their usual order
+  def donation_prizes(self, donation, tickets=()):
+    time = _utc(donation.timereceived)
+    prizeList = []
+    for prizeId, amount in tickets:
+      prize = self.prizes.get(prizeId) or Prize.objects.get(pk=prizeId)
+      amount = self.contribution(prize, time, amount)
+      if amount != None:
+        prizeList.append({'prize': prize, 'amount': amount})
+    for prize in sorted(self.windows.at(time) + self.anytime, key=lambda prize: self.rank[prize.id]):
+      amount = self.contribution(prize, time, donation.amount)
+      if amount != None:
+        prizeList.append({'prize': prize, 'amount': amount})
+    return prizeList
+
+def build_prize_eligibility(eventId):
+  prizes = list(Prize.objects.filter(event=eventId).select_related('startrun', 'endrun'))
+  wonIds = set(PrizeWinner.objects.filter(prize__event=eventId).values_list('prize', flat=True))
+  return PrizeEligibility(prizes, wonIds)
+
+_Indexes = {}
+_IndexLock = threading.Lock()
+
+def _cached(kind, eventId, build):
+  version = cacheutil.get_version(index_namespace(eventId))
+  with _IndexLock:
+    cached = _Indexes.get((kind, eventId))
+  if cached and cached[0] == version:
+    return cached[1]
+  index = build(eventId)
+  with _IndexLock:
+    _Indexes[(kind, eventId)] = (version, index)
+  return index
+
+def get_index(eventId=None):
+  return _cached('schedule', eventId, build_index)
+
+def get_prize_eligibility(eventId):
+  return _cached('prizes', eventId, build_prize_eligibility)
+
+@receiver(signals.post_save, sender=SpeedRun, dispatch_uid='tracker.scheduleindex.run_save')
+@receiver(signals.post_delete, sender=SpeedRun, dispatch_uid='tracker.scheduleindex.run_delete')
+@receiver(signals.post_save, sender=Prize, dispatch_uid='tracker.scheduleindex.prize_save')
+@receiver(signals.post_delete, sender=Prize, dispatch_uid='tracker.scheduleindex.prize_delete')
+def schedule_changed(sender, instance, **kwargs):
+  invalidate(instance.event_id)
+
+@receiver(signals.post_save, sender=PrizeWinner, dispatch_uid='tracker.scheduleindex.prizewinner_save')
+@receiver(signals.post_delete, sender=PrizeWinner, dispatch_uid='tracker.scheduleindex.prizewinner_delete')
+def prize_winner_changed(sender, instance, **kwargs):
+  invalidate(Prize.objects.filter(pk=instance.prize_id).values_list('event', flat=True).first())
+
+# only whether a run has open bids is indexed, but that is what the bid feeds select on
+@receiver(signals.post_save, sender=Bid, dispatch_uid='tracker.scheduleindex.bid_save')
+@receiver(signals.post_delete, sender=Bid, dispatch_uid='tracker.scheduleindex.bid_delete')
+def bid_changed(sender, instance, **kwargs):
+  if instance.speedrun_id:
+    invalidate(SpeedRun.objects.filter(pk=instance.speedrun_id).values_list('event', flat=True).first())
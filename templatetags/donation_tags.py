@@ -126,7 +126,14 @@ class PagePNNode(template.Node):
     sort = tryresolve(template.Variable('request.GET.sort'),context)
     order = tryresolve(template.Variable('request.GET.order'),context)
     page = self.page.resolve(context)
-    return sortlink(self.tag[4:], PagePNNode.dc[self.tag], sort=sort, order=order, page=page)
+    args = { 'sort' : sort, 'order' : order, 'page' : page }
+    # keyset paged lists continue from the row they stopped at (see tracker.pagination)
+    pageinfo = tryresolve(template.Variable('pageinfo'),context)
+    if self.tag == 'pagenext':
+      args['after'] = getattr(pageinfo, 'next_cursor', None)
+    else:
+      args['before'] = getattr(pageinfo, 'previous_cursor', None)
+    return sortlink(self.tag[4:], PagePNNode.dc[self.tag], **args)
     
 @register.tag("pagelink")
 def do_pagelink(parser, token):
@@ -324,20 +331,25 @@ def admin_url(obj):
     
 @register.simple_tag
 def bid_event(bid):
-  return bid.event if bid.event else bid.speedrun.event
+  # checking the id first skips a query for speedrun bids without an event
+  return bid.event if bid.event_id else bid.speedrun.event
 
 @register.simple_tag
 def bid_short(bid, showEvent=False, showRun=False, showOptions=False, addTable=True, showMain=True, showPending=False):
   options = []
   if showOptions:
-    if showPending:
-      options = bid.options.all()
+    if hasattr(bid, 'cachedOptions'):
+      # part of a tracker.bidforest.BidForest, already sorted by total
+      options = [option for option in bid.cachedOptions if showPending or option.state in ('OPENED', 'CLOSED')]
     else:
-      options = bid.options.filter(Q(state='OPENED')|Q(state='CLOSED'))
-    options = list(reversed(sorted(options, key=lambda b: b.total)))
+      if showPending:
+        options = bid.options.all()
+      else:
+        options = bid.options.filter(Q(state='OPENED')|Q(state='CLOSED'))
+      options = list(reversed(sorted(options, key=lambda b: b.total)))
   event = None
   if showEvent:
-    event = bid.event if bid.event else bid.speedrun.event
+    event = bid_event(bid)
   bidNameSpan = 1
   if not showEvent:
     bidNameSpan += 1
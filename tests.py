@@ -1,5 +1,11 @@
 from django.test import TestCase
-from django.db.models import ProtectedError
+from django.test.utils import override_settings
+from django.db import connection,transaction
+from django.db.models import ProtectedError,Q,F,Count,Sum
+from django.core.cache import cache
+from django.utils import timezone
+from django.test.client import RequestFactory
+from django.contrib.auth.models import AnonymousUser,User
 import tracker.randgen as randgen
 from dateutil.parser import parse as parse_date
 import random
@@ -7,12 +13,30 @@ import pytz
 import tracker.models
 import datetime
 import tracker.viewutil as viewutil
+import tracker.cacheutil as cacheutil
 from decimal import Decimal
 import tracker.filters as filters
+import tracker.fulltext as fulltext
+import tracker.benchmarks as benchmarks
+import tracker.scheduleindex as scheduleindex
 import post_office.models
 from collections import Counter
 import tracker.prizemail as prizemail
 import tracker.forms
+import tracker.views
+import tracker.ipnqueue as ipnqueue
+import tracker.postbacks as postbacks
+import tracker.livefeed as livefeed
+import tracker.bidforest as bidforest
+import tracker.querylog as querylog
+import tracker.pagination as pagination
+import tracker.donatepayload as donatepayload
+import tracker.langdetect as langdetect
+import tracker.goalwatch as goalwatch
+from django.core.urlresolvers import reverse
+import BaseHTTPServer
+import threading
+import simplejson as json
 
 from django.core.exceptions import ValidationError
 
@@ -84,6 +108,876 @@ class TestDonorTotals(TestCase):
     self.assertFalse(tracker.models.DonorCache.objects.filter(donor=self.jane,event=self.ev1).exists())
     self.assertFalse(tracker.models.DonorCache.objects.filter(donor=self.jane,event=None).exists())
     self.assertEqual(0, tracker.models.DonorCache.objects.count())
+  def test_donor_cache_unrelated_save(self):
+    d1 = tracker.models.Donation.objects.create(donor=self.john,event=self.ev1,amount=5,domainId='d1',transactionstate='COMPLETED',timereceived=datetime.datetime.now(pytz.utc))
+    tracker.models.DonorCache.objects.filter(donor=self.john).update(donation_total=99)
+    d1.readstate = 'READ'
+    d1.save()
+    # nothing that affects the cache changed, so the (deliberately wrong) rows are left alone
+    self.assertEqual(99, tracker.models.DonorCache.objects.get(donor=self.john,event=self.ev1).donation_total)
+    # an amount change applies the difference to them instead of recomputing
+    d1.amount = 7
+    d1.save()
+    self.assertEqual(101, tracker.models.DonorCache.objects.get(donor=self.john,event=self.ev1).donation_total)
+  def test_donor_cache_missing_row(self):
+    tracker.models.Donation.objects.create(donor=self.john,event=self.ev1,amount=5,domainId='d1',transactionstate='COMPLETED',timereceived=datetime.datetime.now(pytz.utc))
+    tracker.models.DonorCache.objects.filter(donor=self.john,event=None).delete()
+    tracker.models.DonorCache.add_donation(self.john.id, self.ev1.id, Decimal('3.00'))
+    self.assertEqual((8, 2), tracker.models.DonorCache.objects.filter(donor=self.john,event=self.ev1).values_list('donation_total','donation_count').get())
+    self.assertEqual((3, 1), tracker.models.DonorCache.objects.filter(donor=self.john,event=None).values_list('donation_total','donation_count').get())
+  def test_rebuild_donor_cache(self):
+    tracker.models.Donation.objects.create(donor=self.john,event=self.ev1,amount=5,domainId='d1',transactionstate='COMPLETED',timereceived=datetime.datetime.now(pytz.utc))
+    tracker.models.Donation.objects.create(donor=self.john,event=self.ev2,amount=5,domainId='d2',transactionstate='COMPLETED',timereceived=datetime.datetime.now(pytz.utc))
+    tracker.models.Donation.objects.create(donor=self.john,event=self.ev2,amount=10,domainId='d3',transactionstate='COMPLETED',timereceived=datetime.datetime.now(pytz.utc))
+    tracker.models.Donation.objects.create(donor=self.jane,event=self.ev1,amount=20,domainId='d4',transactionstate='COMPLETED',timereceived=datetime.datetime.now(pytz.utc))
+    tracker.models.Donation.objects.create(donor=self.jane,event=self.ev2,amount=20,domainId='d5',transactionstate='PENDING',timereceived=datetime.datetime.now(pytz.utc))
+    expected = sorted(tracker.models.DonorCache.objects.values_list('donor','event','donation_total','donation_count','donation_max','donation_avg'))
+    tracker.models.DonorCache.objects.all().update(donation_total=0)
+    self.assertEqual(5, viewutil.rebuild_donor_cache())
+    self.assertEqual(expected, sorted(tracker.models.DonorCache.objects.values_list('donor','event','donation_total','donation_count','donation_max','donation_avg')))
+    tracker.models.DonorCache.objects.filter(event=self.ev2).delete()
+    tracker.models.DonorCache.objects.filter(event=None).update(donation_total=0)
+    self.assertEqual(3, viewutil.rebuild_donor_cache(self.ev2))
+    self.assertEqual(expected, sorted(tracker.models.DonorCache.objects.values_list('donor','event','donation_total','donation_count','donation_max','donation_avg')))
+
+class TestBidTotals(TestCase):
+  def setUp(self):
+    self.donor = tracker.models.Donor.objects.create(firstname='John', lastname='Doe', email='johndoe@example.com')
+    self.event = tracker.models.Event.objects.create(short='ev1',name='Event 1',targetamount=5,date=datetime.date.today())
+    self.parent = tracker.models.Bid.objects.create(event=self.event, name='Parent', istarget=False)
+    self.option1 = tracker.models.Bid.objects.create(event=self.event, name='Option 1', parent=self.parent, istarget=True)
+    self.option2 = tracker.models.Bid.objects.create(event=self.event, name='Option 2', parent=self.parent, istarget=True)
+    self.challenge = tracker.models.Bid.objects.create(event=self.event, name='Challenge', istarget=True, goal=Decimal('15.00'))
+  def bid_total(self, bid):
+    bid = tracker.models.Bid.objects.get(pk=bid.pk)
+    return bid.total, bid.count
+  def make_donation(self, amount, state='COMPLETED'):
+    return tracker.models.Donation.objects.create(donor=self.donor, event=self.event, amount=amount, domainId=str(random.getrandbits(64)), transactionstate=state, timereceived=datetime.datetime.now(pytz.utc))
+  def test_completed_donation_propagates(self):
+    d1 = self.make_donation(Decimal('20.00'))
+    tracker.models.DonationBid.objects.create(donation=d1, bid=self.option1, amount=Decimal('5.00'))
+    tracker.models.DonationBid.objects.create(donation=d1, bid=self.option2, amount=Decimal('7.00'))
+    self.assertEqual((Decimal('5.00'), 1), self.bid_total(self.option1))
+    self.assertEqual((Decimal('7.00'), 1), self.bid_total(self.option2))
+    self.assertEqual((Decimal('12.00'), 2), self.bid_total(self.parent))
+  def test_transaction_state_changes(self):
+    d1 = self.make_donation(Decimal('20.00'), state='PENDING')
+    tracker.models.DonationBid.objects.create(donation=d1, bid=self.option1, amount=Decimal('5.00'))
+    self.assertEqual((Decimal('0.00'), 0), self.bid_total(self.parent))
+    d1.transactionstate = 'COMPLETED'
+    d1.save()
+    self.assertEqual((Decimal('5.00'), 1), self.bid_total(self.option1))
+    self.assertEqual((Decimal('5.00'), 1), self.bid_total(self.parent))
+    d1.readstate = 'READ'
+    d1.save()
+    self.assertEqual((Decimal('5.00'), 1), self.bid_total(self.parent))
+    d1.transactionstate = 'CANCELLED'
+    d1.save()
+    self.assertEqual((Decimal('0.00'), 0), self.bid_total(self.option1))
+    self.assertEqual((Decimal('0.00'), 0), self.bid_total(self.parent))
+  def test_donation_bid_changes(self):
+    d1 = self.make_donation(Decimal('20.00'))
+    donationBid = tracker.models.DonationBid.objects.create(donation=d1, bid=self.option1, amount=Decimal('5.00'))
+    donationBid.amount = Decimal('8.00')
+    donationBid.save()
+    self.assertEqual((Decimal('8.00'), 1), self.bid_total(self.option1))
+    self.assertEqual((Decimal('8.00'), 1), self.bid_total(self.parent))
+    donationBid.bid = self.option2
+    donationBid.save()
+    self.assertEqual((Decimal('0.00'), 0), self.bid_total(self.option1))
+    self.assertEqual((Decimal('8.00'), 1), self.bid_total(self.option2))
+    self.assertEqual((Decimal('8.00'), 1), self.bid_total(self.parent))
+    donationBid.delete()
+    self.assertEqual((Decimal('0.00'), 0), self.bid_total(self.option2))
+    self.assertEqual((Decimal('0.00'), 0), self.bid_total(self.parent))
+  def test_challenge_auto_close(self):
+    d1 = self.make_donation(Decimal('20.00'))
+    tracker.models.DonationBid.objects.create(donation=d1, bid=self.challenge, amount=Decimal('10.00'))
+    self.assertEqual('OPENED', tracker.models.Bid.objects.get(pk=self.challenge.pk).state)
+    d2 = self.make_donation(Decimal('20.00'))
+    tracker.models.DonationBid.objects.create(donation=d2, bid=self.challenge, amount=Decimal('10.00'))
+    self.assertEqual('CLOSED', tracker.models.Bid.objects.get(pk=self.challenge.pk).state)
+  def test_stale_instance_save(self):
+    subBid = tracker.models.Bid.objects.create(event=self.event, name='Sub', parent=self.parent, istarget=False)
+    subOption = tracker.models.Bid.objects.create(event=self.event, name='Sub Option', parent=subBid, istarget=True)
+    d1 = self.make_donation(Decimal('20.00'))
+    tracker.models.DonationBid.objects.create(donation=d1, bid=subOption, amount=Decimal('5.00'))
+    # subBid was loaded before the donation reached it, saving it must not count the donation again
+    subBid.description = 'changed'
+    subBid.save()
+    self.assertEqual((Decimal('5.00'), 1), self.bid_total(subBid))
+    self.assertEqual((Decimal('5.00'), 1), self.bid_total(self.parent))
+  def test_rebuild_matches_incremental(self):
+    d1 = self.make_donation(Decimal('20.00'))
+    tracker.models.DonationBid.objects.create(donation=d1, bid=self.option1, amount=Decimal('5.00'))
+    tracker.models.DonationBid.objects.create(donation=d1, bid=self.option2, amount=Decimal('7.00'))
+    tracker.models.Bid.objects.filter(event=self.event).update(total=Decimal('0.00'), count=0)
+    viewutil.rebuild_bid_totals(self.event)
+    self.assertEqual((Decimal('5.00'), 1), self.bid_total(self.option1))
+    self.assertEqual((Decimal('12.00'), 2), self.bid_total(self.parent))
+
+class TestGoalWatch(TestCase):
+  def setUp(self):
+    self.donor = tracker.models.Donor.objects.create(firstname='John', lastname='Doe', email='johndoe@example.com')
+    self.event = tracker.models.Event.objects.create(short='ev1',name='Event 1',targetamount=5,date=datetime.date.today())
+    self.challenge = tracker.models.Bid.objects.create(event=self.event, name='Challenge', istarget=True, goal=Decimal('15.00'), state='OPENED')
+    self.secret = tracker.models.Bid.objects.create(event=self.event, name='Secret', istarget=False, state='HIDDEN', biddependency=self.challenge)
+    self.secretOption = tracker.models.Bid.objects.create(event=self.event, name='Secret Option', parent=self.secret, istarget=True, state='HIDDEN')
+    self.parent = tracker.models.Bid.objects.create(event=self.event, name='Parent', istarget=False, goal=Decimal('10.00'), state='OPENED')
+    self.option1 = tracker.models.Bid.objects.create(event=self.event, name='Option 1', parent=self.parent, istarget=True, state='OPENED')
+    self.option2 = tracker.models.Bid.objects.create(event=self.event, name='Option 2', parent=self.parent, istarget=True, state='OPENED')
+  def state(self, bid):
+    return tracker.models.Bid.objects.get(pk=bid.pk).state
+  def donate(self, bids, state='COMPLETED'):
+    donation = tracker.models.Donation.objects.create(donor=self.donor, event=self.event, amount=sum(amount for bid, amount in bids), domainId=str(random.getrandbits(64)), transactionstate=state, timereceived=datetime.datetime.now(pytz.utc))
+    for bid, amount in bids:
+      tracker.models.DonationBid.objects.create(donation=donation, bid=bid, amount=amount)
+    return donation
+  def test_dependency_revealed(self):
+    self.donate([(self.challenge, Decimal('10.00'))])
+    self.assertEqual('HIDDEN', self.state(self.secret))
+    self.donate([(self.challenge, Decimal('5.00'))])
+    self.assertEqual('CLOSED', self.state(self.challenge))
+    self.assertEqual(['OPENED', 'OPENED'], [self.state(self.secret), self.state(self.secretOption)])
+    self.assertIsNotNone(tracker.models.Bid.objects.get(pk=self.secret.pk).revealedtime)
+    self.assertEqual(2, tracker.models.Log.objects.filter(category='bid', event=self.event).count())
+  def test_parent_goal(self):
+    self.donate([(self.option1, Decimal('6.00'))])
+    self.donate([(self.option2, Decimal('4.00'))])
+    # only targets close on their goal, a bid war's parent stays open
+    self.assertEqual(Decimal('10.00'), tracker.models.Bid.objects.get(pk=self.parent.pk).total)
+    self.assertEqual(['OPENED', 'OPENED', 'OPENED'], [self.state(bid) for bid in [self.parent, self.option1, self.option2]])
+    self.assertEqual(0, tracker.models.Log.objects.filter(category='bid').count())
+  def test_completed_with_several_bids(self):
+    donation = self.donate([(self.challenge, Decimal('15.00')), (self.option1, Decimal('6.00'))], state='PENDING')
+    self.assertEqual('OPENED', self.state(self.challenge))
+    donation.transactionstate = 'COMPLETED'
+    donation.save()
+    self.assertEqual(['CLOSED', 'OPENED', 'OPENED'], [self.state(bid) for bid in [self.challenge, self.parent, self.option1]])
+    self.assertEqual(2, tracker.models.Log.objects.filter(category='bid').count())
+  def test_concurrent_donations(self):
+    self.donate([(self.challenge, Decimal('1.00'))])
+    # another process' donation landed, nothing here heard of it
+    tracker.models.Bid.objects.filter(pk=self.challenge.pk).update(total=F('total') + Decimal('13.00'))
+    self.donate([(self.challenge, Decimal('1.00'))])
+    self.assertEqual('CLOSED', self.state(self.challenge))
+    self.assertEqual('OPENED', self.state(self.secret))
+  def test_met_goals(self):
+    chain = tracker.models.Bid.objects.filter(pk__in=[self.parent.pk, self.option1.pk, self.challenge.pk])
+    self.assertEqual([], goalwatch.met_goals(chain))
+    tracker.models.Bid.objects.filter(pk=self.parent.pk).update(total=Decimal('10.00'))
+    self.assertEqual([], goalwatch.met_goals(chain))
+    tracker.models.Bid.objects.filter(pk=self.challenge.pk).update(total=Decimal('15.00'))
+    self.assertEqual([self.challenge], goalwatch.met_goals(chain))
+
+class TestBidTrees(TestCase):
+  def setUp(self):
+    self.donor = tracker.models.Donor.objects.create(firstname='John', lastname='Doe', email='johndoe@example.com')
+    self.event = tracker.models.Event.objects.create(short='ev1',name='Event 1',targetamount=5,date=datetime.date.today())
+    self.parent = tracker.models.Bid.objects.create(event=self.event, name='Parent', istarget=False)
+    self.option1 = tracker.models.Bid.objects.create(event=self.event, name='Option 1', parent=self.parent, istarget=False)
+    self.option2 = tracker.models.Bid.objects.create(event=self.event, name='Option 2', parent=self.parent, istarget=True)
+    self.nested = tracker.models.Bid.objects.create(event=self.event, name='Nested', parent=self.option1, istarget=True)
+    self.challenge = tracker.models.Bid.objects.create(event=self.event, name='Challenge', istarget=True, goal=Decimal('15.00'))
+  def ids(self, bids):
+    return sorted(bid.id for bid in bids)
+  def naive_descendants(self, nodes, include_self):
+    result = set()
+    for node in nodes:
+      result |= set(node.get_descendants(include_self=include_self).values_list('id', flat=True))
+    return sorted(result)
+  def naive_ancestors(self, nodes):
+    result = set()
+    for node in nodes:
+      result |= set(node.get_ancestors().values_list('id', flat=True))
+    return sorted(result)
+  def test_descendants(self):
+    for nodes in [[self.parent], [self.option1, self.nested], [self.option2, self.challenge], [self.parent, self.nested]]:
+      for include_self in [True, False]:
+        self.assertEqual(self.naive_descendants(nodes, include_self), self.ids(viewutil.get_tree_queryset_descendants(tracker.models.Bid, nodes, include_self=include_self)))
+    self.assertEqual(0, viewutil.get_tree_queryset_descendants(tracker.models.Bid, []).count())
+  def test_descendants_of_queryset(self):
+    roots = tracker.models.Bid.objects.filter(parent=None)
+    self.assertEqual(self.ids(tracker.models.Bid.objects.all()), self.ids(viewutil.get_tree_queryset_descendants(tracker.models.Bid, roots, include_self=True)))
+  def test_ancestors(self):
+    for nodes in [[self.nested], [self.option1, self.option2], [self.nested, self.option2, self.challenge], [self.parent]]:
+      self.assertEqual(self.naive_ancestors(nodes), self.ids(viewutil.get_tree_queryset_ancestors(tracker.models.Bid, nodes)))
+  def test_all(self):
+    self.assertEqual(self.ids([self.parent, self.option1, self.option2, self.nested]), self.ids(viewutil.get_tree_queryset_all(tracker.models.Bid, [self.nested])))
+  def test_event_bids_single_query(self):
+    bidforest.invalidate(self.event.id)
+    with self.assertNumQueries(1):
+      bids = bidforest.get_event_bids(self.event.id)
+      parent, = bidforest.select(self.event.id, [self.parent.id])
+      self.assertEqual(['Option 1', 'Option 2'], [option.name for option in parent.cachedOptions])
+      self.assertEqual(['Nested'], [option.name for option in parent.cachedOptions[0].cachedOptions])
+      self.assertEqual('Parent', parent.cachedOptions[0].cachedOptions[0].parent.parent.name)
+    with self.assertNumQueries(0):
+      self.assertIs(bids, bidforest.get_event_bids(self.event.id))
+  def test_event_bids_follow_donations(self):
+    bidforest.get_event_bids(self.event.id)
+    donation = tracker.models.Donation.objects.create(donor=self.donor, event=self.event, amount=Decimal('20.00'), domainId='bidtrees', transactionstate='COMPLETED', timereceived=datetime.datetime.now(pytz.utc))
+    tracker.models.DonationBid.objects.create(donation=donation, bid=self.nested, amount=Decimal('5.00'))
+    nested, = bidforest.select(self.event.id, [self.nested.id])
+    self.assertEqual(Decimal('5.00'), nested.total)
+    self.assertEqual(Decimal('5.00'), nested.parent.parent.total)
+
+  def test_forest_order_and_totals(self):
+    donation = tracker.models.Donation.objects.create(donor=self.donor, event=self.event, amount=Decimal('20.00'), domainId='bidforest', transactionstate='COMPLETED', timereceived=datetime.datetime.now(pytz.utc))
+    tracker.models.DonationBid.objects.create(donation=donation, bid=self.option2, amount=Decimal('5.00'))
+    tracker.models.DonationBid.objects.create(donation=donation, bid=self.challenge, amount=Decimal('3.00'))
+    forest = bidforest.get_forest(self.event.id)
+    self.assertEqual([self.parent.id, self.challenge.id], [bid.id for bid in forest.roots])
+    self.assertEqual(['Option 2', 'Option 1'], [option.name for option in forest.byId[self.parent.id].cachedOptions])
+    self.assertEqual((Decimal('8.00'), Decimal('5.00'), Decimal('3.00')), forest.totals(forest.roots))
+    self.assertEqual((Decimal('3.00'), Decimal('0.00'), Decimal('3.00')), forest.totals(forest.select([self.challenge.id])))
+  def test_bid_short_from_forest(self):
+    import tracker.templatetags.donation_tags as donation_tags
+    parent, = bidforest.select(self.event.id, [self.parent.id])
+    with self.assertNumQueries(0):
+      html = donation_tags.bid_short(parent, showEvent=True, showRun=True, showOptions=True, addTable=False)
+    self.assertIn('Nested', html)
+
+class TestIndexCache(TestCase):
+  def setUp(self):
+    self.ev1 = tracker.models.Event.objects.create(short='ev1',name='Event 1',targetamount=5,date=datetime.date.today())
+    self.ev2 = tracker.models.Event.objects.create(short='ev2',name='Event 2',targetamount=5,date=datetime.date.today())
+    self.computed = 0
+    cache.clear()
+    cacheutil.reset_stats()
+  def compute(self):
+    self.computed += 1
+    return self.computed
+  def cached(self, event):
+    return cacheutil.get_or_compute(cacheutil.index_namespace(event.id if event else None), 'test', self.compute)
+  def test_read_through(self):
+    self.assertEqual(1, self.cached(self.ev1))
+    self.assertEqual(1, self.cached(self.ev1))
+    self.assertEqual({'hit': 1, 'miss': 1}, cacheutil.stats(cacheutil.index_namespace(self.ev1.id)))
+  def test_signals_invalidate(self):
+    self.cached(self.ev1)
+    self.cached(self.ev2)
+    self.cached(None)
+    tracker.models.SpeedRun.objects.create(name='Test Run', event=self.ev1, starttime=datetime.datetime(2000, 1, 1, 0, 0, 0, tzinfo=pytz.utc), endtime=datetime.datetime(2000, 1, 1, 1, 0, 0, tzinfo=pytz.utc))
+    self.assertEqual(3, self.computed)
+    self.assertEqual(4, self.cached(self.ev1))
+    self.assertEqual(2, self.cached(self.ev2))
+    self.assertEqual(5, self.cached(None))
+
+class TestKeysetPagination(TestCase):
+  def setUp(self):
+    cache.clear()
+    self.event = tracker.models.Event.objects.create(short='ev1',name='Event 1',targetamount=5,date=datetime.date.today())
+    self.donor = tracker.models.Donor.objects.create(firstname='John', lastname='Doe', email='johndoe@example.com')
+    now = datetime.datetime(2014, 1, 1, 12, 0, 0, tzinfo=pytz.utc)
+    # a few share their time, the ids have to break those ties
+    minutes = [0, 1, 1, 1, 2, 3, 3, 4]
+    self.donations = [tracker.models.Donation.objects.create(donor=self.donor,event=self.event,amount=1+i,domainId='page%d' % i,transactionstate='COMPLETED',timereceived=now + datetime.timedelta(minutes=m)) for i, m in enumerate(minutes)]
+    self.queryset = tracker.models.Donation.objects.filter(event=self.event)
+  def walk(self, descending):
+    pages = pagination.CountedPaginator(self.queryset, 3, len(self.donations))
+    pageinfo = pagination.keyset_page(self.queryset, 'timereceived', descending, pages, 1)
+    forward = [[d.id for d in pageinfo.object_list]]
+    while pageinfo.has_next():
+      pageinfo = pagination.keyset_page(self.queryset, 'timereceived', descending, pages, pageinfo.next_page_number(), after=pageinfo.next_cursor)
+      forward.append([d.id for d in pageinfo.object_list])
+    backward = [[d.id for d in pageinfo.object_list]]
+    while pageinfo.has_previous():
+      pageinfo = pagination.keyset_page(self.queryset, 'timereceived', descending, pages, pageinfo.previous_page_number(), before=pageinfo.previous_cursor)
+      backward.insert(0, [d.id for d in pageinfo.object_list])
+    return forward, backward
+  def test_walk_pages(self):
+    for descending in [True, False]:
+      expected = [d.id for d in sorted(self.donations, key=lambda d: (d.timereceived, d.id), reverse=descending)]
+      forward, backward = self.walk(descending)
+      self.assertEqual([expected[0:3], expected[3:6], expected[6:8]], forward)
+      self.assertEqual(forward, backward)
+  def test_page_by_number(self):
+    pages = pagination.CountedPaginator(self.queryset, 3, len(self.donations))
+    pageinfo = pagination.keyset_page(self.queryset, 'timereceived', True, pages, 2)
+    following = pagination.keyset_page(self.queryset, 'timereceived', True, pages, 3, after=pageinfo.next_cursor)
+    self.assertEqual([d.id for d in pagination.keyset_page(self.queryset, 'timereceived', True, pages, 3).object_list], [d.id for d in following.object_list])
+  def test_bad_cursor(self):
+    pages = pagination.CountedPaginator(self.queryset, 3, len(self.donations))
+    self.assertRaises(ValueError, pagination.keyset_page, self.queryset, 'timereceived', True, pages, 1, after='nonsense')
+  def test_cached_count(self):
+    namespace = cacheutil.index_namespace(self.event.id)
+    self.assertEqual(8, pagination.cached_count(namespace, self.queryset))
+    with self.assertNumQueries(0):
+      self.assertEqual(8, pagination.cached_count(namespace, self.queryset))
+    tracker.models.Donation.objects.create(donor=self.donor,event=self.event,amount=1,domainId='page_new',transactionstate='COMPLETED',timereceived=datetime.datetime.now(pytz.utc))
+    self.assertEqual(9, pagination.cached_count(namespace, self.queryset))
+  def test_aggregate_key(self):
+    # built fresh on every request, the key mustn't depend on the objects themselves
+    self.assertEqual(pagination.aggregate_key('n', Count('id')), pagination.aggregate_key('n', Count('id')))
+    self.assertNotEqual(pagination.aggregate_key('n', Count('id')), pagination.aggregate_key('n', Sum('id')))
+    self.assertNotEqual(pagination.aggregate_key('n', Count('id')), pagination.aggregate_key('n', Count('id', distinct=True)))
+  def test_full_list_streams(self):
+    request = RequestFactory().get('/donations/', {'page': 'full'})
+    request.user = User.objects.create_superuser('staff', 'staff@example.com', 'password')
+    response = tracker.views.donationindex(request, event=str(self.event.id))
+    content = ''.join(response.streaming_content)
+    for donation in self.donations:
+      self.assertIn(reverse('tracker.views.donation', kwargs={'id': donation.id}), content)
+
+class TestPageContext(TestCase):
+  def setUp(self):
+    cache.clear()
+    self.factory = RequestFactory()
+    self.event = tracker.models.Event.objects.create(short='ev1',name='Event 1',targetamount=5,date=datetime.date(2014, 1, 1))
+  def request(self, user=None):
+    request = self.factory.get('/')
+    request.user = user or AnonymousUser()
+    return request
+  def test_warm_context_is_free(self):
+    tracker.views.page_context(self.request(), {})
+    with self.assertNumQueries(0):
+      context = {}
+      tracker.views.page_context(self.request(), context)
+      self.assertEqual([self.event], list(context['events']))
+  def test_events_follow_changes(self):
+    self.assertEqual(self.event, cacheutil.latest_event())
+    later = tracker.models.Event.objects.create(short='ev2',name='Event 2',targetamount=5,date=datetime.date(2015, 1, 1))
+    self.assertEqual([self.event.id, later.id], sorted(event.id for event in cacheutil.get_events()))
+    self.assertEqual(later, cacheutil.latest_event())
+    later.delete()
+    self.assertEqual(self.event, cacheutil.latest_event())
+  def test_profile_prepend(self):
+    user = User.objects.create_user('someone', 'someone@example.com', 'password')
+    self.assertEqual('', viewutil.user_prepend(user))
+    profile = tracker.models.UserProfile.objects.get(user=user)
+    profile.prepend = 'custom/'
+    profile.save()
+    self.assertEqual('custom/', viewutil.user_prepend(User.objects.get(pk=user.pk)))
+    cacheutil.get_events()
+    with self.assertNumQueries(0):
+      self.assertEqual('custom/', tracker.views.page_context(self.request(user), {}))
+  def test_overhead_benchmark(self):
+    results = dict((result['context'], result) for result in benchmarks.benchmark_page_overhead(repeat=2))
+    self.assertEqual(0, results['current']['queries'])
+    self.assertEqual(1, results['legacy']['queries'])
+
+class TestSearchStream(TestCase):
+  def setUp(self):
+    self.factory = RequestFactory()
+    self.event = tracker.models.Event.objects.create(short='ev1',name='Event 1',targetamount=5,date=datetime.date.today())
+    self.donor = tracker.models.Donor.objects.create(firstname='John', lastname='Doe', email='johndoe@example.com', visibility='ANON')
+    self.donations = [tracker.models.Donation.objects.create(donor=self.donor,event=self.event,amount=5+i,domainId='d%d' % i,transactionstate='COMPLETED',timereceived=datetime.datetime.now(pytz.utc)) for i in range(5)]
+  def stream(self, **params):
+    params.update(type='donation', format='ndjson')
+    request = self.factory.get('/search', params)
+    request.user = AnonymousUser()
+    response = tracker.views.search(request)
+    return [json.loads(line) for line in ''.join(response.streaming_content).splitlines()]
+  def test_stream_all(self):
+    rows = self.stream()
+    self.assertEqual([d.id for d in self.donations], [row['pk'] for row in rows])
+    self.assertEqual('5.00', rows[0]['fields']['amount'])
+    self.assertEqual('(Anonymous)', rows[0]['fields']['donor__public'])
+    self.assertNotIn('domainId', rows[0]['fields'])
+    self.assertNotIn('donor__email', rows[0]['fields'])
+  def test_stream_cursor(self):
+    rows = self.stream(after=self.donations[1].id, limit=2)
+    self.assertEqual([self.donations[2].id, self.donations[3].id], [row['pk'] for row in rows])
+  def test_stream_malformed(self):
+    for params in ({'after': 'abc'}, {'limit': 'abc'}):
+      params.update(type='donation', format='ndjson')
+      request = self.factory.get('/search', params)
+      request.user = AnonymousUser()
+      response = tracker.views.search(request)
+      self.assertEqual(400, response.status_code)
+      self.assertIn('error', json.loads(response.content))
+
+class TestLiveFeed(TestCase):
+  def setUp(self):
+    cache.clear()
+    self.factory = RequestFactory()
+    self.event = tracker.models.Event.objects.create(short='ev1',name='Event 1',targetamount=5,date=datetime.date.today())
+    self.donor = tracker.models.Donor.objects.create(firstname='John', lastname='Doe', email='johndoe@example.com', alias='JD', visibility='ALIAS')
+    self.bid = tracker.models.Bid.objects.create(name='Challenge', event=self.event, istarget=True, state='OPENED')
+  def donate(self, amount, **kwargs):
+    return tracker.models.Donation.objects.create(donor=self.donor,event=self.event,amount=amount,domainId='live%d' % amount,transactionstate='COMPLETED',timereceived=datetime.datetime.now(pytz.utc),**kwargs)
+  def follow(self, user=None, lastEventId=None, **params):
+    request = self.factory.get('/live', params, **({'HTTP_LAST_EVENT_ID': str(lastEventId)} if lastEventId is not None else {}))
+    request.user = user or AnonymousUser()
+    oldDuration, tracker.views.liveDuration = tracker.views.liveDuration, 0
+    try:
+      content = ''.join(tracker.views.live(request).streaming_content)
+    finally:
+      tracker.views.liveDuration = oldDuration
+    messages = []
+    for block in content.split('\n\n'):
+      message = dict(line.split(': ', 1) for line in block.splitlines() if not line.startswith(':') and ': ' in line)
+      if 'event' in message:
+        message['data'] = json.loads(message['data'])
+        messages.append(message)
+    return messages
+  def test_ring_buffer(self):
+    first = livefeed.publish('test', self.event.id, {'n': 1})
+    livefeed.publish('test', self.event.id, {'n': 2})
+    entries, cursor, missed = livefeed.read_since(first)
+    self.assertEqual([{'n': 2}], [entry['data'] for entry in entries])
+    self.assertEqual(livefeed.latest(), cursor)
+    self.assertFalse(missed)
+    oldSize, livefeed._RingSize = livefeed._RingSize, 10
+    try:
+      for i in range(10):
+        livefeed.publish('test', self.event.id, {'n': i})
+      entries, cursor, missed = livefeed.read_since(first)
+    finally:
+      livefeed._RingSize = oldSize
+    self.assertTrue(missed)
+    self.assertEqual(range(10), [entry['data']['n'] for entry in entries])
+  def test_donation_publishes_bid_totals(self):
+    cursor = livefeed.latest()
+    donation = self.donate(5)
+    tracker.models.DonationBid.objects.create(donation=donation, bid=self.bid, amount=5)
+    entries, cursor, missed = livefeed.read_since(cursor)
+    self.assertEqual('donation', entries[0]['kind'])
+    self.assertEqual(donation.id, entries[0]['data']['id'])
+    self.assertEqual(Decimal('5.00'), entries[-1]['data']['total'])
+    self.assertEqual(self.bid.id, entries[-1]['data']['id'])
+  def test_deferred_until_commit(self):
+    cursor = livefeed.latest()
+    with livefeed.deferred():
+      donation = self.donate(5)
+      self.assertEqual(cursor, livefeed.latest())
+    entries, cursor, missed = livefeed.read_since(cursor)
+    self.assertEqual([donation.id], [entry['data']['id'] for entry in entries])
+    # nothing from a block that raised, its transaction was rolled back
+    try:
+      with livefeed.deferred(), transaction.atomic():
+        self.donate(7)
+        raise ValidationError('rolled back')
+    except ValidationError:
+      pass
+    self.assertEqual(cursor, livefeed.latest())
+  def test_stream_privacy_and_resume(self):
+    cursor = livefeed.latest()
+    donation = self.donate(5, comment='Hi', commentstate='PENDING')
+    messages = self.follow(after=cursor, kinds='donation')
+    self.assertEqual(1, len(messages))
+    fields = messages[0]['data']
+    self.assertEqual(donation.id, fields['id'])
+    self.assertEqual('JD', fields['donor__public'])
+    self.assertEqual(None, fields['donor__lastname'])
+    self.assertEqual(None, fields['comment'])
+    self.assertNotIn('donor__email', fields)
+    self.assertNotIn('domainId', fields)
+    # picking up from the last id seen only returns what came after it
+    second = self.donate(10)
+    messages = self.follow(lastEventId=messages[0]['id'], kinds='donation')
+    self.assertEqual([second.id], [message['data']['id'] for message in messages])
+  def test_stream_hides_private_entries(self):
+    cursor = livefeed.latest()
+    self.donate(5, transactionstate='PENDING')
+    hidden = tracker.models.Bid.objects.create(name='Secret', event=self.event, state='HIDDEN')
+    self.assertEqual([], self.follow(after=cursor))
+    admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+    messages = self.follow(user=admin, after=cursor)
+    self.assertEqual(['donation', 'bid'], [message['event'] for message in messages])
+    self.assertEqual('Doe', messages[0]['data']['donor__lastname'])
+    self.assertEqual(hidden.id, messages[1]['data']['id'])
+  def test_stream_reset(self):
+    livefeed.publish('test', self.event.id, {})
+    cache.clear()
+    messages = self.follow(after=5)
+    self.assertEqual(['reset'], [message['event'] for message in messages])
+
+class TestSearchPlans(TestCase):
+  def test_plan_is_shared(self):
+    user = User.objects.create(username='admin', is_superuser=True)
+    for model in filters._GeneralFields:
+      plan = filters.search_plan(model, user=user)
+      self.assertIs(plan, filters.search_plan(model, user=user))
+      # with every permission nothing is left out of the search
+      self.assertEqual([key + '__icontains' for key in filters.general_search_keys(model)], [lookup for lookup, rule in plan])
+  def test_permissions(self):
+    plan = dict(filters.search_plan('donor'))
+    self.assertNotIn('email__icontains', plan)
+    self.assertNotIn('paypalemail__icontains', plan)
+    self.assertEqual(str(Q(visibility='FULL')), str(plan['firstname__icontains']))
+    user = User.objects.create(username='admin', is_superuser=True)
+    plan = dict(filters.search_plan('donor', user=user))
+    self.assertIn('email__icontains', plan)
+    self.assertEqual(str(Q()), str(plan['firstname__icontains']))
+
+@override_settings(TRACKER_FULLTEXT_BACKEND='sqlite')
+class TestFullTextSearch(TestCase):
+  def setUp(self):
+    if connection.vendor != 'sqlite':
+      self.skipTest('the test full-text backend needs sqlite')
+    if fulltext._TableName not in connection.introspection.table_names():
+      self.skipTest('sqlite was built without FTS5')
+    self.event = tracker.models.Event.objects.create(short='ev1',name='Event 1',targetamount=5,date=datetime.date.today())
+    self.donor = tracker.models.Donor.objects.create(firstname='John', lastname='Doe', alias='Speedy', email='johndoe@example.com', visibility='ALIAS')
+    self.approved = tracker.models.Donation.objects.create(donor=self.donor,event=self.event,amount=5,domainId='d1',transactionstate='COMPLETED',comment='Kill the animals',commentstate='APPROVED',timereceived=datetime.datetime.now(pytz.utc))
+    self.pending = tracker.models.Donation.objects.create(event=self.event,amount=5,domainId='d2',transactionstate='COMPLETED',comment='Save the animals',commentstate='PENDING',timereceived=datetime.datetime.now(pytz.utc))
+    self.admin = User.objects.create(username='admin', is_superuser=True)
+  def search(self, model, text, user=None):
+    return set(filters.run_model_query(model, {'q': text}, user=user, mode='admin'))
+  def test_comment_permissions(self):
+    self.assertEqual(set([self.approved]), self.search('donation', 'anim'))
+    self.assertEqual(set([self.approved, self.pending]), self.search('donation', 'anim', user=self.admin))
+    self.assertEqual(set(), self.search('donation', 'nothing'))
+  def test_donor_fields(self):
+    self.assertEqual(set([self.donor]), self.search('donor', 'speedy'))
+    # names are hidden by the donor's visibility, emails need the permission
+    self.assertEqual(set(), self.search('donor', 'john'))
+    self.assertEqual(set([self.donor]), self.search('donor', 'johndoe', user=self.admin))
+  def test_index_follows_changes(self):
+    self.donor.alias = 'Slowpoke'
+    self.donor.save()
+    self.assertEqual(set(), self.search('donor', 'speedy'))
+    self.assertEqual(set([self.donor]), self.search('donor', 'slow'))
+    self.approved.delete()
+    self.assertEqual(set(), self.search('donation', 'kill'))
+  def test_many_matches(self):
+    # more matches than sqlite takes parameters, they mustn't pass through a parameter list
+    now = datetime.datetime.now(pytz.utc)
+    tracker.models.Donation.objects.bulk_create([tracker.models.Donation(donor=self.donor,event=self.event,amount=5,domainId='bulk%d' % i,transactionstate='COMPLETED',comment='More animals',commentstate='APPROVED',timereceived=now) for i in range(1000)])
+    fulltext.rebuild_index()
+    self.assertEqual(1001, filters.run_model_query('donation', {'q': 'anim'}, mode='admin').count())
+
+class TestFeedQueries(TestCase):
+  def setUp(self):
+    self.event = tracker.models.Event.objects.create(short='ev1',name='Event 1',targetamount=5,date=datetime.date.today())
+    self.donor = tracker.models.Donor.objects.create(firstname='John', lastname='Doe', email='johndoe@example.com')
+    self.now = datetime.datetime(2014, 1, 1, 12, 0, 0, tzinfo=pytz.utc)
+    # three donations in the last hour, seven older ones
+    self.donations = [tracker.models.Donation.objects.create(donor=self.donor,event=self.event,amount=1+i,domainId='feed%d' % i,transactionstate='COMPLETED',timereceived=self.now - datetime.timedelta(hours=i if i < 3 else 24 + i)) for i in range(10)]
+    self.runs = [tracker.models.SpeedRun.objects.create(name='Run %d' % i, event=self.event, starttime=self.now + datetime.timedelta(hours=i), endtime=self.now + datetime.timedelta(hours=i + 1)) for i in range(10)]
+    tracker.models.Bid.objects.create(name='Bid', speedrun=self.runs[0], istarget=True, state='OPENED')
+  def recent(self, **kwargs):
+    return [d.id for d in filters.get_recent_donations(queryOffset=self.now, delta=datetime.timedelta(hours=3), **kwargs)]
+  def test_recent_donation_bounds(self):
+    ids = [d.id for d in self.donations]
+    self.assertEqual(ids[:3], self.recent(minDonations=2, maxDonations=5))
+    self.assertEqual(ids[:5], self.recent(minDonations=5, maxDonations=8))
+    self.assertEqual(ids[:2], self.recent(minDonations=1, maxDonations=2))
+    self.assertEqual(ids[:3], self.recent(minDonations=None, maxDonations=None))
+  def test_feeds_stay_lazy(self):
+    donations = filters.get_recent_donations(queryOffset=self.now, minDonations=5, maxDonations=8, delta=datetime.timedelta(hours=3))
+    runs = filters.get_upcomming_runs(queryOffset=self.now, minRuns=2, maxRuns=4, delta=datetime.timedelta(hours=3))
+    with self.assertNumQueries(1):
+      self.assertEqual([self.donations[1].id, self.donations[3].id], [d.id for d in donations.filter(amount__in=[2, 4])])
+    with self.assertNumQueries(1):
+      self.assertEqual([run.id for run in self.runs[:3]], [run.id for run in runs])
+  def test_feed_query_counts(self):
+    # the time based feeds come from the schedule index once it is built
+    scheduleindex.get_index()
+    for result in benchmarks.count_feed_queries({'offset': self.now.isoformat()}):
+      self.assertEqual(1, result['queries'], '{model} feed={feed}: {queries} queries'.format(**result))
+
+class TestDonatePayload(TestCase):
+  def setUp(self):
+    cache.clear()
+    self.event = tracker.models.Event.objects.create(short='ev1',name='Event 1',targetamount=5,date=datetime.date.today())
+    self.now = datetime.datetime.now(pytz.utc)
+    self.run = tracker.models.SpeedRun.objects.create(name='Run', event=self.event, starttime=self.now - datetime.timedelta(hours=1), endtime=self.now + datetime.timedelta(hours=1))
+    self.parent = tracker.models.Bid.objects.create(speedrun=self.run, name='Parent', istarget=False, state='OPENED')
+    self.option = tracker.models.Bid.objects.create(speedrun=self.run, name='Option', parent=self.parent, istarget=True, state='OPENED')
+    self.challenge = tracker.models.Bid.objects.create(event=self.event, name='Challenge', istarget=True, goal=Decimal('100.00'), state='OPENED')
+    tracker.models.Bid.objects.create(event=self.event, name='Closed', istarget=True, state='CLOSED')
+    self.prize = tracker.models.Prize.objects.create(name='Prize', event=self.event, minimumbid=Decimal('5.00'), state='ACCEPTED')
+    self.ticketPrize = tracker.models.Prize.objects.create(name='Ticket Prize', event=self.event, minimumbid=Decimal('5.00'), ticketdraw=True, state='ACCEPTED', startrun=self.run, endrun=self.run)
+    tracker.models.Prize.objects.create(name='Later Prize', event=self.event, minimumbid=Decimal('5.00'), state='ACCEPTED', starttime=self.now + datetime.timedelta(hours=2), endtime=self.now + datetime.timedelta(hours=3))
+  def bids(self, payload):
+    return json.loads(payload.bidsJson)
+  def test_payload(self):
+    payload = donatepayload.get_payload(self.event.id)
+    bids = self.bids(payload)
+    self.assertEqual([self.option.id, self.challenge.id], [bid['id'] for bid in bids])
+    self.assertEqual({'name': 'Parent', 'description': '', 'parent': None}, bids[0]['parent'])
+    self.assertEqual('Run', bids[0]['runname'])
+    self.assertTrue(payload.hasBids)
+    self.assertEqual([self.ticketPrize.id], [prize['id'] for prize in json.loads(payload.ticketPrizesJson)])
+    self.assertEqual([self.prize.id], [prize['id'] for prize in payload.prizes])
+    self.assertEqual(self.run.endtime, payload.expires)
+  def test_cached(self):
+    donatepayload.get_payload(self.event.id)
+    self.assertNumQueries(0, lambda: donatepayload.get_payload(self.event.id))
+  def test_invalidated(self):
+    donatepayload.get_payload(self.event.id)
+    tracker.models.BidSuggestion.objects.create(bid=self.challenge, name='Suggestion')
+    self.assertEqual(['Suggestion'], self.bids(donatepayload.get_payload(self.event.id))[1]['suggested'])
+    self.challenge.state = 'CLOSED'
+    self.challenge.save()
+    self.assertEqual([self.option.id], [bid['id'] for bid in self.bids(donatepayload.get_payload(self.event.id))])
+    self.prize.state = 'DENIED'
+    self.prize.save()
+    self.assertEqual([], donatepayload.get_payload(self.event.id).prizes)
+  def test_donate_page(self):
+    response = self.client.get(reverse('tracker.views.donate', kwargs={'event': self.event.id}))
+    self.assertEqual(200, response.status_code)
+    self.assertContains(response, 'Prize')
+    self.assertEqual([self.option.id, self.challenge.id], [bid['id'] for bid in json.loads(response.context['bidsJson'])])
+
+class TestSaveDonation(TestCase):
+  def setUp(self):
+    self.event = tracker.models.Event.objects.create(short='ev1',name='Event 1',targetamount=5,date=datetime.date.today())
+    self.target = tracker.models.Bid.objects.create(event=self.event, name='Challenge', istarget=True, state='OPENED')
+    self.custom = tracker.models.Bid.objects.create(event=self.event, name='Name The Thing', allowuseroptions=True, state='OPENED')
+    self.existing = tracker.models.Bid.objects.create(event=self.event, name='Existing', parent=self.custom, istarget=True, state='OPENED')
+    self.prize = tracker.models.Prize.objects.create(name='Ticket Prize', event=self.event, minimumbid=Decimal('5.00'), ticketdraw=True, state='ACCEPTED')
+  def donation(self, amount):
+    return tracker.models.Donation(amount=Decimal(amount), domain='PAYPAL', domainId=str(random.getrandbits(128)), event=self.event, currency='USD')
+  def test_save(self):
+    donation = viewutil.save_donation(self.donation('20.00'), [(self.target, None, Decimal('5.00')), (self.custom, 'existing', Decimal('5.00'))], [(self.prize, Decimal('10.00'))])
+    self.assertEqual(sorted([self.target.id, self.existing.id]), sorted(donation.bids.values_list('bid', flat=True)))
+    self.assertEqual([self.prize.id], list(donation.tickets.values_list('prize', flat=True)))
+  def test_new_options(self):
+    first = viewutil.save_donation(self.donation('5.00'), [(self.custom, 'New Name', Decimal('5.00'))], [])
+    second = viewutil.save_donation(self.donation('5.00'), [(self.custom, 'new name', Decimal('5.00'))], [])
+    option = tracker.models.Bid.objects.get(parent=self.custom, name='New Name')
+    self.assertEqual('PENDING', option.state)
+    self.assertEqual([option.id], list(first.bids.values_list('bid', flat=True)))
+    self.assertEqual([option.id], list(second.bids.values_list('bid', flat=True)))
+    self.assertEqual(2, tracker.models.Bid.objects.filter(parent=self.custom).count())
+  def test_totals_checked_first(self):
+    with self.assertRaises(ValidationError):
+      viewutil.save_donation(self.donation('5.00'), [(self.target, None, Decimal('10.00'))], [])
+    with self.assertRaises(ValidationError):
+      viewutil.save_donation(self.donation('5.00'), [], [(self.prize, Decimal('10.00'))])
+    self.assertEqual(0, tracker.models.Donation.objects.count())
+  def test_same_bid_twice(self):
+    with self.assertRaises(ValidationError):
+      viewutil.save_donation(self.donation('20.00'), [(self.existing, None, Decimal('5.00')), (self.custom, 'EXISTING', Decimal('5.00'))], [])
+    self.assertEqual(0, tracker.models.Donation.objects.count())
+    # plain bids are checked before anything is written
+    with self.assertNumQueries(0):
+      with self.assertRaises(ValidationError):
+        viewutil.save_donation(self.donation('20.00'), [(self.target, None, Decimal('5.00')), (self.target, None, Decimal('5.00'))], [])
+
+class TestLanguageDetection(TestCase):
+  def setUp(self):
+    cache.clear()
+    self.event = tracker.models.Event.objects.create(short='ev1',name='Event 1',targetamount=5,date=datetime.date.today())
+    self.donor = tracker.models.Donor.objects.create(firstname='John', lastname='Doe', email='johndoe@example.com')
+    self.detected = []
+    # no background detection on save, the tests submit what they want themselves
+    self.oldDetect, langdetect._detect = langdetect._detect, self.fake_detect
+    self.oldCld, langdetect.cld = langdetect.cld, None
+  def tearDown(self):
+    langdetect._detect = self.oldDetect
+    langdetect.cld = self.oldCld
+  def fake_detect(self, comment):
+    self.detected.append(comment)
+    return {u'Bonjour': 'fr', u'Hallo': 'de'}.get(comment, 'un')
+  def donate(self, comment, **kwargs):
+    return tracker.models.Donation.objects.create(donor=self.donor, event=self.event, amount=Decimal('5.00'), domainId=str(random.getrandbits(128)), transactionstate='COMPLETED', timereceived=datetime.datetime.now(pytz.utc), comment=comment, **kwargs)
+  def language(self, donation):
+    return tracker.models.Donation.objects.get(pk=donation.pk).commentlanguage
+  def test_known_comment_on_save(self):
+    self.assertEqual('fr', langdetect.detect(u'Bonjour'))
+    self.assertEqual('fr', self.donate(u'Bonjour').commentlanguage)
+    self.assertEqual('un', self.donate(u'Hallo').commentlanguage)
+    self.assertEqual('un', self.donate(u'').commentlanguage)
+    self.assertEqual([u'Bonjour'], self.detected)
+  def test_classifier(self):
+    classifier = langdetect.LanguageClassifier(workers=1, detector=langdetect.detect)
+    donations = [self.donate(comment) for comment in [u'Bonjour', u'Hallo', u'Hallo', u'Hmm']]
+    for donation in donations:
+      self.assertTrue(classifier.submit(donation.id, donation.comment))
+    self.assertEqual(4, classifier.flush())
+    self.assertEqual(['fr', 'de', 'de', 'un'], [self.language(donation) for donation in donations])
+    self.assertEqual(3, len(self.detected))
+  def test_retry_unseen_donation(self):
+    donation = self.donate(u'Bonjour')
+    classifier = langdetect.LanguageClassifier(workers=0)
+    classifier.results.put((donation.id, 'fr', 0))
+    # a donation that isn't committed yet looks the same as one that is gone
+    classifier.results.put((donation.id + 1000, 'de', 0))
+    self.assertEqual(1, classifier.save_results())
+    self.assertEqual('fr', self.language(donation))
+    self.assertEqual(1, classifier.results.qsize())
+    for i in range(langdetect._MaxAttempts):
+      self.assertEqual(0, classifier.save_results())
+    self.assertEqual(0, classifier.results.qsize())
+  def test_bounded_queue(self):
+    classifier = langdetect.LanguageClassifier(workers=0, maxQueued=1)
+    self.assertTrue(classifier.submit(1, u'Bonjour'))
+    self.assertFalse(classifier.submit(2, u'Hallo'))
+  def test_backfill(self):
+    donations = [self.donate(comment) for comment in [u'Bonjour', u'Hallo', u'Bonjour', u'Hmm']]
+    self.assertEqual(3, langdetect.detect_languages(event=self.event, batchSize=2))
+    self.assertEqual(['fr', 'de', 'fr', 'un'], [self.language(donation) for donation in donations])
+    self.assertEqual([u'Bonjour', u'Hallo', u'Hmm'], self.detected)
+
+class TestQueryBudgets(TestCase):
+  # the most queries each view may make for the data set up below; raise one
+  # only when the extra queries are really needed
+  Budgets = {
+    'donationindex' : 10,
+    'bidindex'      : 8,
+    'donate'        : 10,
+    'search'        : 5,
+    'ipn'           : 3,
+  }
+  def setUp(self):
+    cache.clear()
+    self.event = tracker.models.Event.objects.create(short='ev1',name='Event 1',targetamount=5,date=datetime.date.today())
+    self.donor = tracker.models.Donor.objects.create(firstname='John', lastname='Doe', email='johndoe@example.com')
+    now = datetime.datetime.now(pytz.utc)
+    self.run = tracker.models.SpeedRun.objects.create(name='Run', event=self.event, starttime=now, endtime=now + datetime.timedelta(hours=1))
+    parent = tracker.models.Bid.objects.create(speedrun=self.run, name='Parent', istarget=False, state='OPENED')
+    options = [tracker.models.Bid.objects.create(speedrun=self.run, name='Option %d' % i, parent=parent, istarget=True, state='OPENED') for i in range(3)]
+    tracker.models.Bid.objects.create(event=self.event, name='Challenge', istarget=True, goal=Decimal('100.00'), state='OPENED')
+    tracker.models.Prize.objects.create(name='Prize', event=self.event, minimumbid=Decimal('5.00'), state='ACCEPTED')
+    for i in range(5):
+      donation = tracker.models.Donation.objects.create(donor=self.donor, event=self.event, amount=Decimal('10.00'), domainId='budget%d' % i, transactionstate='COMPLETED', timereceived=now)
+      tracker.models.DonationBid.objects.create(donation=donation, bid=options[i % 3], amount=Decimal('5.00'))
+  def assertWithinBudget(self, name, send):
+    with querylog.record(name) as recorder:
+      response = send()
+    self.assertIn(response.status_code, (200, 302))
+    stats = recorder.summary()
+    self.assertLessEqual(stats['queries'], self.Budgets[name], '%s made %d queries (budget %d), repeated: %s' % (name, stats['queries'], self.Budgets[name], json.dumps(stats['duplicates'], indent=1)))
+  def test_donationindex(self):
+    self.assertWithinBudget('donationindex', lambda: self.client.get(reverse('tracker.views.donationindex', kwargs={'event': self.event.id})))
+  def test_bidindex(self):
+    self.assertWithinBudget('bidindex', lambda: self.client.get(reverse('tracker.views.bidindex', kwargs={'event': self.event.id})))
+  def test_donate(self):
+    self.assertWithinBudget('donate', lambda: self.client.get(reverse('tracker.views.donate', kwargs={'event': self.event.id})))
+  def test_search(self):
+    self.assertWithinBudget('search', lambda: self.client.get(reverse('tracker.views.search'), {'type': 'donation', 'event': self.event.id}))
+  def test_ipn(self):
+    self.assertWithinBudget('ipn', lambda: self.client.post(reverse('tracker.views.ipn'), {'txn_id': 'budget', 'payment_status': 'Completed'}))
+  def test_recorder(self):
+    with querylog.record('test') as recorder:
+      for donor in tracker.models.Donor.objects.all():
+        list(tracker.models.Donation.objects.filter(donor=donor.id))
+      list(tracker.models.Donation.objects.filter(donor=self.donor.id + 1))
+    stats = recorder.summary()
+    self.assertEqual(3, stats['queries'])
+    self.assertEqual(1, len(stats['duplicates']))
+    self.assertEqual(2, stats['duplicates'][0]['count'])
+    self.assertEqual(querylog.fingerprint("SELECT 1 FROM a WHERE b IN (1, 2, 'x''y')"), querylog.fingerprint("SELECT 3 FROM a WHERE b IN (4)"))
+
+class TestScheduleIndex(TestCase):
+  def setUp(self):
+    self.event = tracker.models.Event.objects.create(short='ev1',name='Event 1',targetamount=5,date=datetime.date.today())
+    self.now = datetime.datetime(2014, 1, 1, 12, 0, 0, tzinfo=pytz.utc)
+    self.runs = [tracker.models.SpeedRun.objects.create(name='Run %d' % i, event=self.event, starttime=self.now + datetime.timedelta(hours=i), endtime=self.now + datetime.timedelta(hours=i + 1)) for i in range(-3, 10)]
+    self.prizeDuring = tracker.models.Prize.objects.create(name='During', event=self.event, startrun=self.runs[3], endrun=self.runs[4], state='ACCEPTED')
+    self.prizeLater = tracker.models.Prize.objects.create(name='Later', event=self.event, starttime=self.now + datetime.timedelta(hours=8), endtime=self.now + datetime.timedelta(hours=9), state='ACCEPTED')
+    self.prizeEarlier = tracker.models.Prize.objects.create(name='Earlier', event=self.event, startrun=self.runs[0], endrun=self.runs[1], state='ACCEPTED')
+    self.prizeAnytime = tracker.models.Prize.objects.create(name='Anytime', event=self.event, state='ACCEPTED')
+  def test_interval_index(self):
+    rand = random.Random(42)
+    intervals = []
+    for i in range(200):
+      start = rand.randint(0, 1000)
+      intervals.append((start, start + rand.randint(0, 50), i))
+    index = scheduleindex.IntervalIndex(intervals)
+    for i in range(100):
+      start = rand.randint(0, 1000)
+      end = start + rand.randint(0, 20)
+      expected = set(value for s, e, value in intervals if s <= end and e >= start)
+      self.assertEqual(expected, set(index.overlapping(start, end)))
+    self.assertEqual([], scheduleindex.IntervalIndex([]).at(5))
+  def test_upcoming_runs_match_query(self):
+    for offset in [self.now - datetime.timedelta(minutes=30), self.now, self.now + datetime.timedelta(hours=5, minutes=30)]:
+      for params in [{}, {'maxRuns': 2}, {'minRuns': 5, 'delta': datetime.timedelta(hours=1)}, {'maxRuns': None, 'minRuns': None}]:
+        for includeCurrent in [True, False]:
+          expected = [run.id for run in filters.get_upcomming_runs(queryOffset=offset, includeCurrent=includeCurrent, **params)]
+          self.assertEqual(expected, filters.upcomming_run_ids(queryOffset=offset, includeCurrent=includeCurrent, **params))
+  def test_prize_feeds(self):
+    def feed(name, offset):
+      return set(filters.run_model_query('prize', {'feed': name, 'offset': offset.isoformat()}))
+    self.assertEqual(set([self.prizeDuring, self.prizeAnytime]), feed('current', self.now + datetime.timedelta(minutes=90)))
+    self.assertEqual(set([self.prizeEarlier, self.prizeAnytime]), feed('current', self.now - datetime.timedelta(hours=2)))
+    # the default window covers the next six hours of runs
+    self.assertEqual(set([self.prizeDuring, self.prizeAnytime]), feed('future', self.now + datetime.timedelta(minutes=30)))
+    self.assertEqual(set([self.prizeEarlier, self.prizeAnytime]), set(tracker.models.Prize.objects.filter(filters.todraw_prizes_filter(self.now))))
+  def test_prize_feeds_by_event(self):
+    other = tracker.models.Event.objects.create(short='ev2', name='Event 2', targetamount=5, date=datetime.date.today())
+    otherAnytime = tracker.models.Prize.objects.create(name='Other Anytime', event=other, state='ACCEPTED')
+    def feed(name, offset, **params):
+      params.update({'feed': name, 'offset': offset.isoformat()})
+      return set(filters.run_model_query('prize', params))
+    offset = self.now + datetime.timedelta(minutes=90)
+    self.assertEqual(set([self.prizeDuring, self.prizeAnytime, otherAnytime]), feed('current', offset))
+    self.assertEqual(set([self.prizeDuring, self.prizeAnytime]), feed('current', offset, event=str(self.event.id)))
+    self.assertEqual(set([self.prizeDuring, self.prizeAnytime]), feed('future', self.now + datetime.timedelta(minutes=30), event=str(self.event.id)))
+    self.assertEqual(set([self.prizeEarlier, self.prizeAnytime]), set(tracker.models.Prize.objects.filter(filters.todraw_prizes_filter(self.now, event=self.event.id))))
+  def test_saves_rebuild_index(self):
+    index = scheduleindex.get_index(self.event.id)
+    self.assertTrue(index is scheduleindex.get_index(self.event.id))
+    late = tracker.models.SpeedRun.objects.create(name='Late Run', event=self.event, starttime=self.now + datetime.timedelta(days=1), endtime=self.now + datetime.timedelta(days=1, hours=1))
+    index = scheduleindex.get_index(self.event.id)
+    self.assertEqual([late.id], index.live_runs(late.starttime))
+    self.assertEqual([late.id], [run.id for run in filters.run_model_query('run', {'feed': 'future', 'event': str(self.event.id), 'offset': (self.now + datetime.timedelta(hours=20)).isoformat()})])
+
+class TestDonationPrizeInfo(TestCase):
+  def setUp(self):
+    self.event = tracker.models.Event.objects.create(short='ev1',name='Event 1',targetamount=5,date=datetime.date.today())
+    self.other = tracker.models.Event.objects.create(short='ev2',name='Event 2',targetamount=5,date=datetime.date.today())
+    self.donor = tracker.models.Donor.objects.create(firstname='John', lastname='Doe', email='johndoe@example.com')
+    self.now = datetime.datetime(2014, 1, 1, 12, 0, 0, tzinfo=pytz.utc)
+    run = tracker.models.SpeedRun.objects.create(name='Run', event=self.event, starttime=self.now, endtime=self.now + datetime.timedelta(hours=1))
+    self.minimum = tracker.models.Prize.objects.create(name='Minimum', event=self.event, startrun=run, endrun=run, minimumbid=Decimal('10.00'), state='ACCEPTED')
+    self.summed = tracker.models.Prize.objects.create(name='Summed', event=self.event, starttime=self.now, endtime=self.now + datetime.timedelta(hours=2), minimumbid=Decimal('50.00'), sumdonations=True, state='ACCEPTED')
+    self.anytime = tracker.models.Prize.objects.create(name='Anytime', event=self.event, minimumbid=Decimal('1.00'), state='ACCEPTED')
+    self.ticketed = tracker.models.Prize.objects.create(name='Ticketed', event=self.event, minimumbid=Decimal('5.00'), ticketdraw=True, state='ACCEPTED')
+    self.won = tracker.models.Prize.objects.create(name='Won', event=self.event, minimumbid=Decimal('1.00'), state='ACCEPTED')
+    tracker.models.PrizeWinner.objects.create(prize=self.won, winner=self.donor)
+    # same time, but another event's prize
+    tracker.models.Prize.objects.create(name='Elsewhere', event=self.other, minimumbid=Decimal('1.00'), state='ACCEPTED')
+  def donate(self, amount, minutes):
+    return tracker.models.Donation.objects.create(donor=self.donor,event=self.event,amount=amount,domainId='prizeinfo%d_%d' % (amount, minutes),transactionstate='COMPLETED',timereceived=self.now + datetime.timedelta(minutes=minutes))
+  def info(self, prizeList):
+    return sorted((entry['prize'].name, entry['amount']) for entry in prizeList)
+  def test_eligibility(self):
+    big = self.donate(Decimal('20.00'), 30)
+    small = self.donate(Decimal('5.00'), 90)
+    tracker.models.PrizeTicket.objects.create(prize=self.ticketed, donation=big, amount=Decimal('15.00'))
+    self.assertEqual([('Anytime', Decimal('20.00')), ('Minimum', Decimal('20.00')), ('Summed', Decimal('20.00')), ('Ticketed', Decimal('15.00'))], self.info(viewutil.get_donation_prize_info(big)))
+    # past the run, and under the minimum anyway
+    self.assertEqual([('Anytime', Decimal('5.00')), ('Summed', Decimal('5.00'))], self.info(viewutil.get_donation_prize_info(small)))
+  def test_no_queries(self):
+    donation = self.donate(Decimal('20.00'), 30)
+    viewutil.get_donation_prize_info(donation, tickets=[])
+    with self.assertNumQueries(0):
+      self.assertEqual(3, len(viewutil.get_donation_prize_info(donation, tickets=[])))
+  def test_annotate_page(self):
+    donations = [self.donate(Decimal(amount), minutes) for amount, minutes in [(20, 30), (5, 30), (5, 90)]]
+    tracker.models.PrizeTicket.objects.create(prize=self.ticketed, donation=donations[1], amount=Decimal('5.00'))
+    scheduleindex.get_prize_eligibility(self.event.id)
+    with self.assertNumQueries(1):
+      viewutil.annotate_donation_prizes(donations)
+    for donation in donations:
+      self.assertEqual(self.info(viewutil.get_donation_prize_info(donation)), self.info(donation.prizeinfo))
+    self.assertEqual(['Anytime', 'Summed', 'Ticketed'], [name for name, amount in self.info(donations[1].prizeinfo)])
+    # a new winner takes the prize out of the running
+    tracker.models.PrizeWinner.objects.create(prize=self.anytime, winner=self.donor)
+    self.assertEqual(['Summed', 'Ticketed'], [name for name, amount in self.info(viewutil.get_donation_prize_info(donations[1]))])
+
+class TestBulkGeneration(TestCase):
+  def setUp(self):
+    cache.clear()
+    self.rand = random.Random(None)
+    self.eventStart = parse_date("2014-01-01 16:00:00").replace(tzinfo=pytz.utc)
+  def test_bulk_event_is_consistent(self):
+    event = randgen.build_bulk_event(self.rand, startTime=self.eventStart, numDonors=20, numDonations=120, numRuns=5, numBids=4, numPrizes=3, batchSize=50)
+    self.assertEqual(20, tracker.models.Donor.objects.count())
+    self.assertEqual(120, tracker.models.Donation.objects.filter(event=event).count())
+    for bid in tracker.models.Bid.objects.filter(Q(event=event) | Q(speedrun__event=event)):
+      stored = (bid.total, bid.count)
+      bid.update_total()
+      self.assertEqual((bid.total, bid.count), stored)
+    completed = tracker.models.Donation.objects.filter(event=event, transactionstate='COMPLETED')
+    donorIds = set(completed.values_list('donor', flat=True))
+    caches = tracker.models.DonorCache.objects.filter(event=event)
+    self.assertEqual(donorIds, set(caches.values_list('donor', flat=True)))
+    for donorCache in caches:
+      self.assertEqual(sum(d.amount for d in completed.filter(donor=donorCache.donor_id)), donorCache.donation_total)
+  def test_benchmark_scale(self):
+    results = benchmarks.benchmark_scale('tiny', {'numDonors': 5, 'numDonations': 20, 'numRuns': 3, 'numBids': 2, 'numPrizes': 2}, repeat=1)
+    self.assertEqual(['generate', 'index_json', 'search', 'donate', 'ipn', 'prize_draw'], [result['endpoint'] for result in results])
+    for result in results[1:-1]:
+      self.assertEqual(200, result['status'])
+    self.assertEqual(set(['tiny']), set(result['scale'] for result in results))
 
 class TestPrizeGameRange(TestCase):
   def setUp(self):
@@ -500,6 +1394,264 @@ class TestDonorPrizeEntryDraw(TestCase):
     for donorId in map(lambda x: x['donor'], eligible):
       self.assertTrue(donorId in donors) 
       
+class TestWeightedPool(TestCase):
+  def setUp(self):
+    self.rand = random.Random(4512342)
+  def linear_draw(self, entries, result):
+    for i, d in enumerate(entries):
+      if result < d['weight']:
+        return i
+      result -= d['weight']
+  def test_matches_linear_draw(self):
+    entries = [{'donor': i, 'weight': self.rand.uniform(1.0, 50.0)} for i in range(200)]
+    pool = viewutil.WeightedPool(entries)
+    for i in range(1000):
+      result = self.rand.random() * pool.total
+      self.assertEqual(self.linear_draw(entries, result), pool.find(result))
+  def test_remove(self):
+    pool = viewutil.WeightedPool([{'donor': i, 'weight': 1.0} for i in range(10)])
+    drawn = set()
+    while len(pool):
+      index, result = pool.draw(self.rand)
+      self.assertNotIn(index, drawn)
+      drawn.add(index)
+      pool.remove(index)
+    self.assertEqual(set(range(10)), drawn)
+  def test_draw_many_winners(self):
+    event = randgen.generate_event(self.rand)
+    event.save()
+    prize = randgen.generate_prize(self.rand, event=event, randomDraw=True, maxwinners=3)
+    prize.save()
+    donors = []
+    for i in range(5):
+      donor = randgen.generate_donor(self.rand)
+      donor.save()
+      tracker.models.DonorPrizeEntry.objects.create(donor=donor, prize=prize)
+      donors.append(donor)
+    result, message = viewutil.draw_prize(prize, seed=1234, count=5)
+    self.assertTrue(result)
+    self.assertEqual(3, len(message['winners']))
+    self.assertEqual(3, len(set(prize.get_winners())))
+    self.assertTrue(prize.maxed_winners())
+    result, message = viewutil.draw_prize(prize)
+    self.assertFalse(result)
+  def test_draw_many_winners_norandom(self):
+    event = randgen.generate_event(self.rand)
+    event.save()
+    prize = randgen.generate_prize(self.rand, event=event, randomDraw=False, ticketDraw=False, sumDonations=True)
+    prize.maxwinners = 3
+    prize.save()
+    donors = []
+    for amount in ['50.00', '10.00', '40.00', '20.00', '30.00']:
+      donor = randgen.generate_donor(self.rand)
+      donor.save()
+      randgen.generate_donation(self.rand, donor=donor, event=event, minAmount=Decimal(amount), maxAmount=Decimal(amount)).save()
+      donors.append(donor)
+    result, message = viewutil.draw_prize(prize, count=3)
+    self.assertTrue(result)
+    self.assertEqual([donors[0].id, donors[2].id, donors[4].id], message['winners'])
+    self.assertEqual(set([donors[0], donors[2], donors[4]]), set(prize.get_winners()))
+
+class TestPrizeDrawBatch(TestCase):
+  def setUp(self):
+    self.rand = random.Random(6655443)
+    self.event = randgen.generate_event(self.rand)
+    self.event.save()
+    self.category = tracker.models.PrizeCategory.objects.create(name='Games')
+    self.prizes = []
+    for i in range(3):
+      prize = randgen.generate_prize(self.rand, event=self.event, category=self.category, randomDraw=True)
+      prize.save()
+      self.prizes.append(prize)
+    self.donors = []
+    for i in range(4):
+      donor = randgen.generate_donor(self.rand)
+      donor.save()
+      self.donors.append(donor)
+      for prize in self.prizes:
+        tracker.models.DonorPrizeEntry.objects.create(donor=donor, prize=prize)
+  def winners(self):
+    return sorted(tracker.models.PrizeWinner.objects.values_list('prize', 'winner'))
+  def test_category_rule_across_batch(self):
+    result = viewutil.draw_prize_batch(self.prizes)
+    self.assertEqual({}, result['errors'])
+    winners = self.winners()
+    self.assertEqual([prize.id for prize in self.prizes], [w[0] for w in winners])
+    # one win per category, so every prize went to a different donor
+    self.assertEqual(3, len(set(w[1] for w in winners)))
+    self.assertIn(unicode(result['seed']), result['log'].message)
+  def test_seed_is_reproducible(self):
+    result = viewutil.draw_prize_batch(self.prizes, seed=90210)
+    winners = self.winners()
+    tracker.models.PrizeWinner.objects.all().delete()
+    viewutil.draw_prize_batch(self.prizes, seed=result['seed'])
+    self.assertEqual(winners, self.winners())
+  def test_existing_winners(self):
+    viewutil.draw_prize(self.prizes[0])
+    result = viewutil.draw_prize_batch(self.prizes)
+    self.assertIn(self.prizes[0].id, result['errors'])
+    self.assertEqual(2, len(result['winners']))
+    self.assertEqual(3, len(set(w[1] for w in self.winners())))
+  def test_norandom_multiple_winners(self):
+    prize = randgen.generate_prize(self.rand, event=self.event, category=self.category, randomDraw=False, ticketDraw=False, sumDonations=True)
+    prize.maxwinners = 3
+    prize.save()
+    for amount, donor in zip(['20.00', '40.00', '10.00', '30.00'], self.donors):
+      randgen.generate_donation(self.rand, donor=donor, event=self.event, minAmount=Decimal(amount), maxAmount=Decimal(amount)).save()
+    result = viewutil.draw_prize_batch([prize])
+    self.assertEqual({}, result['errors'])
+    self.assertEqual([self.donors[1].id, self.donors[3].id, self.donors[0].id], [w.winner_id for w in result['winners']])
+  def test_invalidates_indexes(self):
+    eventId = self.prizes[0].event_id
+    index = scheduleindex.get_index(eventId)
+    payload = donatepayload.get_payload(eventId)
+    viewutil.draw_prize_batch(self.prizes)
+    self.assertIsNot(index, scheduleindex.get_index(eventId))
+    self.assertIsNot(payload, donatepayload.get_payload(eventId))
+
+class TestIPNQueue(TestCase):
+  def setUp(self):
+    self.factory = RequestFactory()
+    self.event = tracker.models.Event.objects.create(short='ev1',name='Event 1',targetamount=5,date=datetime.date.today())
+  def ingest(self, **data):
+    return ipnqueue.ingest(self.factory.post('/ipn', data))
+  def test_ingest_is_idempotent(self):
+    first = self.ingest(txn_id='TXN1', payment_status='Pending')
+    self.assertEqual(first, self.ingest(txn_id='TXN1', payment_status='Pending'))
+    self.assertNotEqual(first, self.ingest(txn_id='TXN1', payment_status='Completed'))
+    self.assertEqual(2, tracker.models.QueuedIPN.objects.count())
+    self.assertEqual('PENDING', first.state)
+  def test_claim_is_exclusive(self):
+    entry = self.ingest(txn_id='TXN1', payment_status='Completed')
+    claimed = ipnqueue.claim(entry.id)
+    self.assertEqual(1, claimed.attempts)
+    self.assertEqual('PROCESSING', claimed.state)
+    self.assertEqual(None, ipnqueue.claim(entry.id))
+    self.assertEqual(None, ipnqueue.claim_next())
+    # unless the worker holding it has gone quiet for too long
+    later = timezone.now() + datetime.timedelta(hours=1)
+    self.assertEqual(entry.id, ipnqueue.claim_next(now=later).id)
+  def test_failure_rolls_back_and_retries(self):
+    # without an amount the donation can't be built, so processing fails part way through
+    entry = self.ingest(txn_id='TXN1', payment_status='Completed')
+    self.assertEqual(1, ipnqueue.process_pending())
+    entry = tracker.models.QueuedIPN.objects.get(pk=entry.pk)
+    self.assertEqual('PENDING', entry.state)
+    self.assertTrue(entry.lasterror)
+    self.assertTrue(entry.nextattempt > timezone.now())
+    self.assertEqual(0, tracker.models.Donor.objects.count())
+    # not due yet
+    self.assertEqual(0, ipnqueue.process_pending())
+    later = timezone.now() + datetime.timedelta(days=1)
+    ipnqueue.process_pending(now=later)
+    entry = tracker.models.QueuedIPN.objects.get(pk=entry.pk)
+    self.assertEqual('FAILED', entry.state)
+    self.assertTrue(tracker.models.Log.objects.filter(category='paypal').exists())
+  def test_pending_after_completed(self):
+    donor = tracker.models.Donor.objects.create(firstname='John', lastname='Doe', email='johndoe@example.com')
+    donation = tracker.models.Donation.objects.create(donor=donor, event=self.event, amount=5, domainId='TXN1', transactionstate='COMPLETED', timereceived=datetime.datetime.now(pytz.utc))
+    custom = '%d:%d' % (donation.id, 1234)
+    pending = self.ingest(txn_id='TXN1', payment_status='Pending', custom=custom)
+    completed = self.ingest(txn_id='TXN1', payment_status='Completed', custom=custom)
+    tracker.models.QueuedIPN.objects.filter(pk=completed.pk).update(state='DONE', donation=donation)
+    # the pending one was retried and comes up after the completed one was applied
+    self.assertEqual(None, ipnqueue.process_entry(ipnqueue.claim(pending.id)))
+    self.assertEqual('SUPERSEDED', tracker.models.QueuedIPN.objects.get(pk=pending.pk).state)
+    self.assertEqual('COMPLETED', tracker.models.Donation.objects.get(pk=donation.pk).transactionstate)
+    self.assertEqual(donation.id, ipnqueue.ipn_donation_id(pending))
+  def test_body_stored_verbatim(self):
+    body = 'txn_id=TXN1&payment_status=Completed&first_name=Jos%E9&charset=windows-1252'
+    entry = ipnqueue.ingest(self.factory.post('/ipn', body, content_type='application/x-www-form-urlencoded'))
+    request = ipnqueue.StoredIPNRequest(tracker.models.QueuedIPN.objects.get(pk=entry.pk))
+    self.assertEqual(body, request.body)
+    self.assertEqual('application/x-www-form-urlencoded', request.META['CONTENT_TYPE'])
+    self.assertEqual(u'Jos\xe9', request.POST['first_name'])
+  def test_retry_backoff(self):
+    self.assertEqual(datetime.timedelta(seconds=30), ipnqueue.retry_delay(1))
+    self.assertEqual(datetime.timedelta(seconds=120), ipnqueue.retry_delay(3))
+    self.assertEqual(datetime.timedelta(hours=1), ipnqueue.retry_delay(20))
+
+class PostbackStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers.getheader('content-length')))
+    self.server.received.append(json.loads(body))
+    self.send_response(self.server.status)
+    self.end_headers()
+  def log_message(self, *args):
+    pass
+
+class TestPostbackDispatcher(TestCase):
+  def setUp(self):
+    self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), PostbackStubHandler)
+    self.server.received = []
+    self.server.status = 200
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+    self.event = tracker.models.Event.objects.create(short='ev1',name='Event 1',targetamount=5,date=datetime.date.today())
+    self.donor = tracker.models.Donor.objects.create(firstname='John', lastname='Doe', email='john@example.com', alias='JD', visibility='ALIAS')
+    self.dispatcher = postbacks.PostbackDispatcher(workers=2, window=30, retries=2, retryDelay=0, threshold=2, cooldown=60)
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+  def donate(self, amount):
+    return tracker.models.Donation.objects.create(event=self.event, donor=self.donor, amount=amount, domainId='pb%d' % amount, transactionstate='COMPLETED', timereceived=timezone.now())
+  def test_send_and_record(self):
+    postback = tracker.models.PostbackURL.objects.create(event=self.event, url=self.url)
+    donation = self.donate(10)
+    postbacks.send_donation(donation, dispatcher=self.dispatcher)
+    self.assertEqual(1, self.dispatcher.flush())
+    self.assertEqual(donation.id, self.server.received[0]['id'])
+    self.assertEqual('JD', self.server.received[0]['donor__visiblename'])
+    delivery = postback.deliveries.get()
+    self.assertEqual('SENT', delivery.state)
+    self.assertEqual(200, delivery.statuscode)
+    self.assertEqual(1, delivery.attempts)
+    self.assertTrue(delivery.latency >= 0)
+  def test_batch_coalesces_burst(self):
+    batched = tracker.models.PostbackURL.objects.create(event=self.event, url=self.url, batch=True)
+    tracker.models.PostbackURL.objects.create(event=self.event, url=self.url)
+    for amount in [5, 10, 15]:
+      postbacks.send_donation(self.donate(amount), dispatcher=self.dispatcher)
+    self.assertEqual(4, self.dispatcher.flush())
+    deliveries = list(batched.deliveries.all())
+    self.assertEqual(1, len(deliveries))
+    self.assertEqual(3, deliveries[0].donations)
+    # the window is long enough that the batch only goes out on flush
+    self.assertEqual([5, 10, 15], [entry['amount'] for entry in self.server.received[-1]])
+    # the plain endpoint still got one request per donation
+    self.assertEqual(4, len(self.server.received))
+    self.assertEqual(3, tracker.models.PostbackDelivery.objects.exclude(postback=batched).count())
+  def test_circuit_breaker(self):
+    self.server.status = 500
+    postback = tracker.models.PostbackURL.objects.create(event=self.event, url=self.url)
+    postbacks.send_donation(self.donate(5), dispatcher=self.dispatcher)
+    self.dispatcher.flush()
+    failed = postback.deliveries.get()
+    self.assertEqual('FAILED', failed.state)
+    self.assertEqual(500, failed.statuscode)
+    self.assertEqual(2, failed.attempts)
+    self.assertTrue(tracker.models.Log.objects.filter(category='postback').exists())
+    # the endpoint is now left alone until the cooldown runs out
+    postbacks.send_donation(self.donate(10), dispatcher=self.dispatcher)
+    self.dispatcher.flush()
+    self.assertEqual(2, len(self.server.received))
+    self.assertEqual('SKIPPED', postback.deliveries.order_by('-id')[0].state)
+  def test_breaker_half_open(self):
+    now = [0]
+    breaker = postbacks.CircuitBreaker(threshold=2, cooldown=10, clock=lambda: now[0])
+    breaker.failure()
+    self.assertTrue(breaker.allow())
+    breaker.failure()
+    self.assertFalse(breaker.allow())
+    now[0] = 10
+    self.assertTrue(breaker.allow())
+    # only a single probe gets through
+    self.assertFalse(breaker.allow())
+    breaker.success()
+    self.assertTrue(breaker.allow())
+
 class TestMergeSchedule(TestCase):
   def setUp(self):
     self.eventStart = parse_date("2012-01-01 01:00:00")
@@ -537,6 +1689,51 @@ class TestMergeSchedule(TestCase):
     self.assertEqual("Game 1", runs[0].name)
     self.assertEqual("Game 3", runs[1].name)
 
+  def schedule(self):
+    return [
+      {"time": "9/5/2014 12:00:00", "game": "Game 1", "runners": "A Runner1", "estimate": "1:00:00", "setup": "0:00:00", "commentators": "", "comments": ""},
+      {"time": "9/5/2014 13:00:00", "game": "Game 2", "runners": "A Runner2", "estimate": "1:30:00", "setup": "0:00:00", "commentators": "", "comments": ""},
+      {"time": "9/5/2014 14:30:00", "game": "Game 3", "runners": "A Runner3", "estimate": "2:00:00", "setup": "0:00:00", "commentators": "", "comments": ""},
+    ]
+
+  def test_diff(self):
+    diff = viewutil.merge_schedule_list(self.event, self.schedule())
+    self.assertEqual(['Game 1', 'Game 2', 'Game 3'], diff.summary()['inserted'])
+    ssRuns = self.schedule()
+    ssRuns[1]["time"] = "9/5/2014 13:15:00"
+    ssRuns[2]["game"] = "GAME 3"
+    ssRuns.pop(0)
+    ssRuns.append({"time": "9/5/2014 17:00:00", "game": "Game 4", "runners": "A Runner4", "estimate": "1:00:00", "setup": "0:00:00", "commentators": "", "comments": "Hi"})
+    diff = viewutil.merge_schedule_list(self.event, ssRuns)
+    self.assertEqual({
+      'inserted': ['Game 4'],
+      'updated': [{'name': 'Game 2', 'fields': ['endtime', 'starttime']}, {'name': 'Game 3', 'fields': ['name']}],
+      'deleted': ['Game 1'],
+      'unchanged': 0,
+    }, diff.summary())
+    runs = tracker.models.SpeedRun.objects.filter(event=self.event)
+    self.assertEqual(['Game 2', 'GAME 3', 'Game 4'], [run.name for run in runs])
+    self.assertEqual('Hi', runs[2].description)
+
+  def test_unchanged_schedule(self):
+    viewutil.merge_schedule_list(self.event, self.schedule())
+    with self.assertNumQueries(1):
+      diff = viewutil.merge_schedule_list(self.event, self.schedule())
+    self.assertFalse(diff.has_changes())
+    self.assertEqual(3, diff.unchanged)
+    self.assertEqual(3, len(diff))
+
+  def test_csv(self):
+    lines = [
+      'Time,Game,Runners,Estimate,Setup,Commentators,Comments',
+      '9/5/2014 12:00:00,Game 1,A Runner1,1:00:00,0:00:00,,',
+      ',,,,,,',
+      '9/5/2014 13:00:00,Game 2,A Runner2,1:30:00,0:00:00,,',
+    ]
+    diff = viewutil.merge_schedule_csv(self.event, lines)
+    self.assertEqual(['Game 1', 'Game 2'], diff.summary()['inserted'])
+    self.assertEqual(['A Runner1', 'A Runner2'], list(tracker.models.SpeedRun.objects.filter(event=self.event).values_list('deprecated_runners', flat=True)))
+
 def parse_mail(mail):
   lines = list(map(lambda x: x.partition(':'), filter(lambda x: x, map(lambda x: x.strip(), mail.message.split("\n")))))
   result = {}
@@ -18,6 +18,7 @@ urlpatterns = patterns('tracker.views',
 	url(r'^setusername/$', 'setusername'),
 	url(r'^i18n/', include('django.conf.urls.i18n')),
 	url(r'^search/$', 'search'),
+	url(r'^live/$', 'live'),
 	url(r'^add/$', 'add'),
 	url(r'^edit/$', 'edit'),
 	url(r'^delete/$', 'delete'),
@@ -4,15 +4,13 @@ import traceback
 from django import shortcuts
 from django.shortcuts import render,render_to_response, redirect
 
-from django.db import connection
 from django.db.models import Count,Sum,Max,Avg,Q
 from django.db.utils import ConnectionDoesNotExist,IntegrityError
-from django.db import transaction
 
 from django.forms import ValidationError
 
 from django.core import serializers,paginator
-from django.core.paginator import Paginator
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.cache import cache
 from django.core.exceptions import FieldError,ObjectDoesNotExist
 from django.core.urlresolvers import reverse
@@ -23,7 +21,7 @@ import django.contrib.auth.views as auth_views
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.tokens import default_token_generator
 
-from django.http import HttpResponse,HttpResponseRedirect,Http404
+from django.http import HttpResponse,HttpResponseRedirect,Http404,StreamingHttpResponse
 
 from django import template
 from django.template import RequestContext
@@ -33,9 +31,8 @@ from django.views.decorators.cache import never_cache,cache_page
 from django.views.decorators.csrf import csrf_protect,csrf_exempt,get_token as get_csrf_token
 from django.views.decorators.http import require_POST
 
-import post_office.mail
-
 from django.utils import translation
+from django.utils.functional import SimpleLazyObject
 from django.utils.http import urlsafe_base64_decode 
 import simplejson as json
 
@@ -48,7 +45,13 @@ from tracker.forms import *
 import tracker.filters as filters
 
 import tracker.viewutil as viewutil
-import tracker.paypalutil as paypalutil
+import tracker.cacheutil as cacheutil
+import tracker.ipnqueue as ipnqueue
+import tracker.livefeed as livefeed
+import tracker.bidforest as bidforest
+import tracker.querylog as querylog
+import tracker.pagination as pagination
+import tracker.donatepayload as donatepayload
 
 import gdata.spreadsheet.service
 import gdata.spreadsheet.text_db
@@ -64,7 +67,6 @@ import decimal
 import re
 import dateutil.parser
 import itertools
-import urllib2
 
 def dv():
   return str(django.VERSION[0]) + '.' + str(django.VERSION[1]) + '.' + str(django.VERSION[2])
@@ -78,6 +80,43 @@ def fixorder(queryset, orderdict, sort, order):
     queryset = queryset.reverse()
   return queryset
 
+def page_number(pages, page):
+  try:
+    return pages.validate_number(page)
+  except paginator.PageNotAnInteger:
+    return 1
+  except paginator.EmptyPage:
+    return pages.num_pages
+
+_StreamMarker = '<!--tracker:rows-->'
+
+# Renders a whole index page as it would look with every row on it, without
+# holding every row in memory: the page is rendered once with a marker where
+# the rows go ('streamrows'), and the rows are streamed in between, rendered one
+# at a time with 'rowTemplate' as 'rowName'
+def stream_rows(request, templateName, rowTemplate, rowName, rows, qdict):
+  qdict['streamrows'] = _StreamMarker
+  page = tracker_response(request, templateName, qdict)
+  if page.status_code != 200 or _StreamMarker not in page.content:
+    return page
+  head, tail = page.content.split(_StreamMarker, 1)
+  rowTemplate = template.loader.get_template(rowTemplate)
+  context = RequestContext(request, qdict)
+  def render():
+    yield head
+    chunk = []
+    for row in rows.iterator():
+      context.push()
+      context[rowName] = row
+      chunk.append(rowTemplate.render(context))
+      context.pop()
+      if len(chunk) >= 500:
+        yield u''.join(chunk)
+        chunk = []
+    yield u''.join(chunk)
+    yield tail
+  return StreamingHttpResponse(render(), content_type=page['Content-Type'])
+
 @never_cache
 def login(request):
   message = None
@@ -148,44 +187,39 @@ def confirm_registration(request):
     form = RegistrationConfirmationForm(user=user, token=token, token_generator=tokenGenerator, initial={'userid': uid, 'authtoken': token, 'username': user.username if user else ''})
   return tracker_response(request, 'tracker/confirm_registration.html', {'formuser': user, 'tokenmatches': tokenGenerator.check_token(user, token) if token else False, 'form': form, 'csrftoken': get_csrf_token(request)})
 
-def tracker_response(request=None, template='tracker/index.html', qdict={}, status=200):
-  starttime = datetime.datetime.now()
-  context = RequestContext(request)
-  language = translation.get_language_from_request(request)
-  translation.activate(language)
-  request.LANGUAGE_CODE = translation.get_language()
-  profile = None
-  if request.user.is_authenticated():
-    try:
-      profile = request.user.get_profile()
-    except UserProfile.DoesNotExist:
-      profile = UserProfile()
-      profile.user = request.user
-      profile.save()
-  if profile:
-    template = profile.prepend + template
-    prepend = profile.prepend
-  else:
-    prepend = ''
-  authform = AuthenticationForm(request.POST)
+# The context every tracker page gets, and the template prefix to use. Nothing
+# here should cost a query on a warm process: the event list and the profile's
+# prefix are cached (see cacheutil and viewutil.user_prepend), and what only
+# some templates use is computed if a template asks for it.
+def page_context(request, qdict):
+  prepend = viewutil.user_prepend(request.user)
   qdict.update({
     'djangoversion' : dv(),
     'pythonversion' : pv(),
     'user' : request.user,
-    'profile' : profile,
+    'profile' : SimpleLazyObject(lambda: viewutil.get_user_profile(request.user)) if request.user.is_authenticated() else None,
     'prepend' : prepend,
     'next' : request.REQUEST.get('next', request.path),
-    'starttime' : starttime,
-    'events': Event.objects.all(),
-    'authform' : authform })
+    'querylog' : getattr(request, 'querylog', None),
+    'events': cacheutil.get_events(),
+    'authform' : SimpleLazyObject(lambda: AuthenticationForm(request.POST)) })
   qdict.setdefault('event',viewutil.get_event(None))
+  return prepend
+
+def tracker_response(request=None, template='tracker/index.html', qdict={}, status=200):
+  starttime = datetime.datetime.now()
+  language = translation.get_language_from_request(request)
+  translation.activate(language)
+  request.LANGUAGE_CODE = translation.get_language()
+  qdict = dict(qdict, starttime=starttime)
+  template = page_context(request, qdict) + template
   try:
     if request.user.username[:10]=='openiduser':
       qdict.setdefault('usernameform', UsernameForm())
       return render(request, 'tracker/username.html', dictionary=qdict)
     resp = render(request, template, dictionary=qdict, status=status)
-    if 'queries' in request.GET and request.user.has_perm('tracker.view_queries'):
-      return HttpResponse(json.dumps(connection.queries, ensure_ascii=False, indent=1),content_type='application/json;charset=utf-8')
+    if querylog.wants_queries(request):
+      return querylog.queries_response(request)
     return resp
   except Exception,e:
     if request.user.is_staff and not settings.DEBUG:
@@ -193,28 +227,33 @@ def tracker_response(request=None, template='tracker/index.html', qdict={}, stat
     raise
 
 def eventlist(request):
-  return tracker_response(request, 'tracker/eventlist.html', { 'events' : Event.objects.all() })
+  return tracker_response(request, 'tracker/eventlist.html')
 
-def index(request,event=None):
-  event = viewutil.get_event(event)
+def index_aggregates(event):
   eventParams = {}
   if event.id:
     eventParams['event'] = event.id
-  agg = filters.run_model_query('donation', eventParams, user=request.user, mode='user').aggregate(amount=Sum('amount'), count=Count('amount'), max=Max('amount'), avg=Avg('amount'))
+  # only public data is counted here, so the result is the same for every user
+  agg = filters.run_model_query('donation', eventParams, mode='user').aggregate(amount=Sum('amount'), count=Count('amount'), max=Max('amount'), avg=Avg('amount'))
   agg['target'] = event.targetamount
   count = {
-    'runs' : filters.run_model_query('run', eventParams, user=request.user).count(),
-    'prizes' : filters.run_model_query('prize', eventParams, user=request.user).count(),
-    'bids' : filters.run_model_query('bid', eventParams, user=request.user).count(),
-    'donors' : filters.run_model_query('donorcache', eventParams, user=request.user).values('donor').distinct().count(),
+    'runs' : filters.run_model_query('run', eventParams).count(),
+    'prizes' : filters.run_model_query('prize', eventParams).count(),
+    'bids' : filters.run_model_query('bid', eventParams).count(),
+    'donors' : filters.run_model_query('donorcache', eventParams).values('donor').distinct().count(),
   }
+  return { 'agg': agg, 'count': count, 'json': json.dumps({'count':count,'agg':agg},ensure_ascii=False) }
+
+def index(request,event=None):
+  event = viewutil.get_event(event)
+  aggregates = cacheutil.get_or_compute(cacheutil.index_namespace(event.id), 'aggregates', lambda: index_aggregates(event))
 
   if 'json' in request.GET:
-    return HttpResponse(json.dumps({'count':count,'agg':agg},ensure_ascii=False),content_type='application/json;charset=utf-8')
+    return HttpResponse(aggregates['json'],content_type='application/json;charset=utf-8')
   elif 'jsonp' in request.GET:
     callback = request.GET['jsonp']
-    return HttpResponse('%s(%s);' % (callback, json.dumps({'count':count,'agg':agg},ensure_ascii=False)), content_type='text/javascript;charset=utf-8')
-  return tracker_response(request, 'tracker/index.html', { 'agg' : agg, 'count' : count, 'event': event })
+    return HttpResponse('%s(%s);' % (callback, aggregates['json']), content_type='text/javascript;charset=utf-8')
+  return tracker_response(request, 'tracker/index.html', { 'agg' : aggregates['agg'], 'count' : aggregates['count'], 'event': event })
 
 @never_cache
 def setusername(request):
@@ -323,6 +362,8 @@ def search(request):
     searchParams = viewutil.request_params(request)
     searchtype = searchParams['type']
     qs = filters.run_model_query(searchtype, searchParams, user=request.user, mode='admin' if authorizedUser else 'user')
+    if searchParams.get('format') == 'ndjson':
+      return search_stream(searchtype, qs, searchParams, authorizedUser)
     if searchtype in related:
       qs = qs.select_related(*related[searchtype])
     if searchtype in defer:
@@ -353,13 +394,15 @@ def search(request):
         donation_privacy_filter(searchtype, o['fields'])
         prize_privacy_filter(searchtype, o['fields'])
     resp = HttpResponse(json.dumps(jsonData,ensure_ascii=False),content_type='application/json;charset=utf-8')
-    if 'queries' in request.GET and request.user.has_perm('tracker.view_queries'):
-      return HttpResponse(json.dumps(connection.queries, ensure_ascii=False, indent=1),content_type='application/json;charset=utf-8')
+    if querylog.wants_queries(request):
+      return querylog.queries_response(request)
     return resp
   except KeyError, e:
     return HttpResponse(json.dumps({'error': 'Key Error, malformed search parameters'}, ensure_ascii=False), status=400, content_type='application/json;charset=utf-8')
   except FieldError, e:
     return HttpResponse(json.dumps({'error': 'Field Error, malformed search parameters'}, ensure_ascii=False), status=400, content_type='application/json;charset=utf-8')
+  except ValueError, e:
+    return HttpResponse(json.dumps({'error': 'Value Error, malformed search parameters'}, ensure_ascii=False), status=400, content_type='application/json;charset=utf-8')
   except ValidationError, e:
     d = {'error': u'Validation Error'}
     if hasattr(e,'message_dict') and e.message_dict:
@@ -368,6 +411,96 @@ def search(request):
       d['messages'] = e.messages
     return HttpResponse(json.dumps(d, ensure_ascii=False), status=400, content_type='application/json;charset=utf-8')
 
+searchStreamBatchSize = 500
+
+def search_stream_fields(searchtype, model):
+  fields = [f.name for f in model._meta.concrete_fields if not f.primary_key]
+  for r in related.get(searchtype,[]):
+    relatedModel = model
+    for f in r.split('__'):
+      relatedModel = relatedModel._meta.get_field(f).rel.to
+    for f in relatedModel._meta.concrete_fields:
+      if f.rel or f.attname.endswith('id') or (r + '__' + f.name) in defer.get(searchtype,[]): continue
+      fields.append(r + '__' + f.name)
+  return fields
+
+def search_stream_rows(searchtype, qs, batch, limit, authorizedUser):
+  # Walks the result set in primary key order, one bounded query per batch, so
+  # that arbitrarily large exports never hold more than a batch in memory
+  encoder = DjangoJSONEncoder()
+  modelName = qs.model._meta.app_label + '.' + qs.model._meta.model_name
+  lastPk = None
+  sent = 0
+  while batch:
+    for row in batch:
+      pk = row.pop('id')
+      # joins used by the filters can repeat a row, those arrive next to each other
+      if pk == lastPk: continue
+      lastPk = pk
+      if not authorizedUser:
+        donor_privacy_filter(searchtype, row)
+        donation_privacy_filter(searchtype, row)
+        prize_privacy_filter(searchtype, row)
+      yield json.dumps({'pk': pk, 'model': modelName, 'fields': row}, ensure_ascii=False, use_decimal=False, default=encoder.default) + '\n'
+      sent += 1
+      if limit and sent >= limit: return
+    batch = list(qs.filter(pk__gt=lastPk)[:searchStreamBatchSize])
+
+# Streams search results as newline delimited JSON, one object per line in the
+# same shape as the regular search output (minus 'public' and many-to-many
+# fields). Pass the last pk seen as 'after' to resume an interrupted export.
+def search_stream(searchtype, qs, searchParams, authorizedUser):
+  if not qs.query.can_filter():
+    # some feeds slice the query, which can't be narrowed by the cursor anymore
+    qs = qs.model.objects.filter(pk__in=list(qs.values_list('pk', flat=True)))
+  fields = search_stream_fields(searchtype, qs.model)
+  annotations = viewutil.ModelAnnotations.get(searchtype,{})
+  qs = qs.annotate(**annotations).values('id', *(fields + annotations.keys())).order_by('pk')
+  if 'after' in searchParams:
+    qs = qs.filter(pk__gt=int(searchParams['after']))
+  limit = int(searchParams['limit']) if 'limit' in searchParams else None
+  # fetch the first batch up front so malformed queries still produce a proper error response
+  batch = list(qs[:searchStreamBatchSize])
+  return StreamingHttpResponse(search_stream_rows(searchtype, qs, batch, limit, authorizedUser), content_type='application/x-ndjson;charset=utf-8')
+
+liveDuration = 30
+livePollInterval = 0.5
+
+def live_entry_data(entry, eventId, kinds, authorizedUser, encoder):
+  if eventId and entry['event'] != eventId:
+    return None
+  if kinds and entry['kind'] not in kinds:
+    return None
+  if not authorizedUser and not entry['public']:
+    return None
+  fields = dict(entry['data'])
+  if not authorizedUser:
+    donor_privacy_filter(entry['kind'], fields)
+    donation_privacy_filter(entry['kind'], fields)
+  return json.dumps(fields, ensure_ascii=False, use_decimal=False, default=encoder.default)
+
+# Server-Sent Events stream of donation and bid changes (see tracker.livefeed).
+# Optional parameters: 'event' to follow a single event, 'kinds' as a comma
+# separated list of 'donation', 'donation_delete' and 'bid', and 'after' (or
+# the Last-Event-ID header) to resume from an earlier entry.
+@never_cache
+def live(request):
+  authorizedUser = request.user.has_perm('tracker.can_search')
+  try:
+    searchParams = viewutil.request_params(request)
+    eventId = viewutil.get_event(searchParams.get('event')).id or None
+    kinds = set(filter(None, searchParams.get('kinds', '').split(',')))
+    cursor = request.META.get('HTTP_LAST_EVENT_ID') or searchParams.get('after')
+    cursor = int(cursor) if cursor else livefeed.latest()
+  except ValueError:
+    return HttpResponse(json.dumps({'error': 'Malformed cursor'}, ensure_ascii=False), status=400, content_type='application/json;charset=utf-8')
+  encoder = DjangoJSONEncoder()
+  transform = lambda entry: live_entry_data(entry, eventId, kinds, authorizedUser, encoder)
+  resp = StreamingHttpResponse(livefeed.follow(cursor, transform, duration=liveDuration, poll=livePollInterval), content_type='text/event-stream;charset=utf-8')
+  # keep proxies from holding back the stream
+  resp['X-Accel-Buffering'] = 'no'
+  return resp
+
 @csrf_exempt
 @never_cache
 def add(request):
@@ -390,8 +523,8 @@ def add(request):
     newobj.save()
     log.addition(request, newobj)
     resp = HttpResponse(serializers.serialize('json', Model.objects.filter(id=newobj.id), ensure_ascii=False),content_type='application/json;charset=utf-8')
-    if 'queries' in request.GET and request.user.has_perm('tracker.view_queries'):
-      return HttpResponse(json.dumps(connection.queries, ensure_ascii=False, indent=1),content_type='application/json;charset=utf-8')
+    if querylog.wants_queries(request):
+      return querylog.queries_response(request)
     return resp
   except IntegrityError, e:
     return HttpResponse(json.dumps({'error': u'Integrity error: %s' % e}, ensure_ascii=False), status=400, content_type='application/json;charset=utf-8')
@@ -460,8 +593,8 @@ def edit(request):
     if changed:
       log.change(request,obj,u'Changed field%s %s.' % (len(changed) > 1 and 's' or '', ', '.join(changed)))
     resp = HttpResponse(serializers.serialize('json', Model.objects.filter(id=obj.id), ensure_ascii=False),content_type='application/json;charset=utf-8')
-    if 'queries' in request.GET and request.user.has_perm('tracker.view_queries'):
-      return HttpResponse(json.dumps(connection.queries, ensure_ascii=False, indent=1),content_type='application/json;charset=utf-8')
+    if querylog.wants_queries(request):
+      return querylog.queries_response(request)
     return resp
   except IntegrityError, e:
     return HttpResponse(json.dumps({'error': u'Integrity error: %s' % e}, ensure_ascii=False), status=400, content_type='application/json;charset=utf-8')
@@ -493,11 +626,10 @@ def bidindex(request, event=None):
     return HttpResponseRedirect('/tracker')
   bids = filters.run_model_query('bid', searchParams, user=request.user)
   bids = bids.filter(parent=None)
-  total = bids.aggregate(Sum('total'))['total__sum'] or Decimal('0.00')
-  choiceTotal = bids.filter(goal=None).aggregate(Sum('total'))['total__sum'] or Decimal('0.00')
-  challengeTotal = bids.exclude(goal=None).aggregate(Sum('total'))['total__sum'] or Decimal('0.00')
-  bids = viewutil.get_tree_queryset_descendants(Bid, bids, include_self=True).prefetch_related('options')
-  bids = bids.filter(parent=None)
+  # the options and the totals all come from the event's cached bids
+  forest = bidforest.get_forest(event.id)
+  bids = forest.select(bids.values_list('id', flat=True))
+  total, choiceTotal, challengeTotal = forest.totals(bids)
   if event.id:
     bidNameSpan = 2
   else:
@@ -550,27 +682,26 @@ def donorindex(request,event=None):
   except ValueError:
     order = 1
 
-  donors = DonorCache.objects.filter(event=event.id if event.id else None).order_by(*orderdict[sort])
-  if order == -1:
-    donors = donors.reverse()
+  donors = DonorCache.objects.filter(event=event.id if event.id else None).select_related('donor')
+  qdict = { 'event' : event, 'sort' : sort, 'order' : order }
 
-  fulllist = request.user.has_perm('tracker.view_full_list') and page == 'full'
-  pages = Paginator(donors,50)
+  pages = pagination.CountedPaginator(fixorder(donors, orderdict, sort, order), 50, pagination.cached_count(cacheutil.index_namespace(event.id), donors))
 
-  if fulllist:
-    pageinfo = { 'paginator' : pages, 'has_previous' : False, 'has_next' : False, 'paginator.num_pages' : pages.num_pages }
-    page = 0
-  else:
-    try:
+  if request.user.has_perm('tracker.view_full_list') and page == 'full':
+    qdict.update({ 'donors' : [], 'pageinfo' : { 'paginator' : pages, 'has_previous' : False, 'has_next' : False }, 'page' : 0, 'fulllist' : True })
+    return stream_rows(request, 'tracker/donorindex.html', 'tracker/donorrow.html', 'donor', pages.object_list, qdict)
+
+  page = page_number(pages, page)
+  try:
+    if sort == 'total':
+      pageinfo = pagination.keyset_page(donors, 'donation_total', order == -1, pages, page, after=request.GET.get('after'), before=request.GET.get('before'))
+    else:
       pageinfo = pages.page(page)
-    except paginator.PageNotAnInteger:
-      pageinfo = pages.page(1)
-    except paginator.EmptyPage:
-      pageinfo = pages.page(pages.num_pages)
-      page = pages.num_pages
-    donors = pageinfo.object_list
+  except (ValueError, ValidationError):
+    return HttpResponse('Invalid page cursor', status=400)
 
-  return tracker_response(request, 'tracker/donorindex.html', { 'donors' : donors, 'event' : event, 'pageinfo' : pageinfo, 'page' : page, 'fulllist' : fulllist, 'sort' : sort, 'order' : order })
+  qdict.update({ 'donors' : pageinfo.object_list, 'pageinfo' : pageinfo, 'page' : page, 'fulllist' : False })
+  return tracker_response(request, 'tracker/donorindex.html', qdict)
 
 def donor(request,id,event=None):
   try:
@@ -608,24 +739,28 @@ def donationindex(request,event=None):
   searchParams.update(searchForm.cleaned_data)
   if event.id:
     searchParams['event'] = event.id
-  donations = filters.run_model_query('donation', searchParams, user=request.user)
-  donations = fixorder(donations, orderdict, sort, order)
-  fulllist = request.user.has_perm('tracker.view_full_list') and page == 'full'
-  pages = Paginator(donations,50)
-  if fulllist:
-    pageinfo = { 'paginator' : pages, 'has_previous' : False, 'has_next' : False, 'paginator.num_pages' : pages.num_pages }
-    page = 0
-  else:
-    try:
+  donations = filters.run_model_query('donation', searchParams, user=request.user).select_related('donor', 'event')
+  # the header sums up every matching donation, and its count pages them
+  agg = pagination.cached_aggregate(cacheutil.index_namespace(event.id), donations.order_by(), amount=Sum('amount'), count=Count('amount'), max=Max('amount'), avg=Avg('amount'))
+  qdict = { 'searchForm': searchForm, 'agg' : agg, 'sort' : sort, 'order' : order, 'event': event }
+
+  pages = pagination.CountedPaginator(fixorder(donations, orderdict, sort, order), 50, agg['count'])
+
+  if request.user.has_perm('tracker.view_full_list') and page == 'full':
+    qdict.update({ 'donations' : [], 'pageinfo' : { 'paginator' : pages, 'has_previous' : False, 'has_next' : False }, 'page' : 0, 'fulllist' : True })
+    return stream_rows(request, 'tracker/donationindex.html', 'tracker/donationrow.html', 'donation', pages.object_list, qdict)
+
+  page = page_number(pages, page)
+  try:
+    if sort == 'time':
+      pageinfo = pagination.keyset_page(donations, 'timereceived', order == -1, pages, page, after=request.GET.get('after'), before=request.GET.get('before'))
+    else:
       pageinfo = pages.page(page)
-    except paginator.PageNotAnInteger:
-      pageinfo = pages.page(1)
-    except paginator.EmptyPage:
-      pageinfo = pages.page(paginator.num_pages)
-      page = pages.num_pages
-    donations = pageinfo.object_list
-  agg = donations.aggregate(amount=Sum('amount'), count=Count('amount'), max=Max('amount'), avg=Avg('amount'))
-  return tracker_response(request, 'tracker/donationindex.html', { 'searchForm': searchForm, 'donations' : donations, 'pageinfo' :  pageinfo, 'page' : page, 'fulllist' : fulllist, 'agg' : agg, 'sort' : sort, 'order' : order, 'event': event })
+  except (ValueError, ValidationError):
+    return HttpResponse('Invalid page cursor', status=400)
+
+  qdict.update({ 'donations' : pageinfo.object_list, 'pageinfo' : pageinfo, 'page' : page, 'fulllist' : False })
+  return tracker_response(request, 'tracker/donationindex.html', qdict)
 
 def donation(request,id):
   try:
@@ -659,9 +794,7 @@ def run(request,id):
     runners = run.runners.all()
     event = run.event
     bids = filters.run_model_query('bid', {'run': id}, user=request.user)
-    bids = viewutil.get_tree_queryset_descendants(Bid, bids, include_self=True).select_related('speedrun','event', 'parent').prefetch_related('options')
-    topLevelBids = filter(lambda bid: bid.parent == None, bids)
-    bids = topLevelBids
+    topLevelBids = filter(lambda bid: bid.parent_id == None, bidforest.select(run.event_id, bids.values_list('id', flat=True)))
 
     return tracker_response(request, 'tracker/run.html', { 'event': event, 'run' : run, 'runners': runners, 'bids' : topLevelBids })
   except SpeedRun.DoesNotExist:
@@ -703,8 +836,8 @@ def prize_donors(request):
     requestParams = viewutil.request_params(request)
     id = int(requestParams['id'])
     resp = HttpResponse(json.dumps(Prize.objects.get(pk=id).eligible_donors()),content_type='application/json;charset=utf-8')
-    if 'queries' in request.GET and request.user.has_perm('tracker.view_queries'):
-      return HttpResponse(json.dumps(connection.queries, ensure_ascii=False, indent=1),content_type='application/json;charset=utf-8')
+    if querylog.wants_queries(request):
+      return querylog.queries_response(request)
     return resp
   except Prize.DoesNotExist:
     return HttpResponse(json.dumps({'error': 'Prize id does not exist'}),status=404,content_type='application/json;charset=utf-8')
@@ -742,8 +875,8 @@ def draw_prize(request):
         except (ValueError,KeyError),e:
           return HttpResponse(json.dumps({'error': 'Key field was missing or malformed', 'exception': '%s %s' % (type(e),e)},ensure_ascii=False),status=400,content_type='application/json;charset=utf-8')
 
-    if 'queries' in request.GET and request.user.has_perm('tracker.view_queries'):
-      return HttpResponse(json.dumps(connection.queries, ensure_ascii=False, indent=1),content_type='application/json;charset=utf-8')
+    if querylog.wants_queries(request):
+      return querylog.queries_response(request)
 
     limit = requestParams.get('limit', prize.maxwinners)
     if not limit:
@@ -811,11 +944,11 @@ def merge_schedule(request,id):
   except Event.DoesNotExist:
     return tracker_response(request, template='tracker/badobject.html', status=404)
   try:
-    numRuns = viewutil.merge_schedule_gdoc(event)
+    diff = viewutil.merge_schedule_gdoc(event)
   except Exception as e:
     return HttpResponse(json.dumps({'error': e.message }),status=500,content_type='application/json;charset=utf-8')
 
-  return HttpResponse(json.dumps({'result': 'Merged %d run(s)' % numRuns }),content_type='application/json;charset=utf-8')
+  return HttpResponse(json.dumps({'result': 'Merged %d run(s)' % len(diff), 'diff': diff.summary() }),content_type='application/json;charset=utf-8')
 
 @never_cache
 @csrf_exempt
@@ -839,7 +972,6 @@ def paypal_cancel(request):
 def paypal_return(request):
   return tracker_response(request, "tracker/paypal_return.html")
 
-@transaction.commit_on_success
 @csrf_exempt
 def donate(request, event):
   event = viewutil.get_event(event)
@@ -853,56 +985,39 @@ def donate(request, event):
       prizesform = PrizeTicketFormSet(amount=commentform.cleaned_data['amount'], data=request.POST, prefix=prizeFormPrefix)
       bidsform = DonationBidFormSet(amount=commentform.cleaned_data['amount'], data=request.POST, prefix=bidsFormPrefix)
       if bidsform.is_valid() and prizesform.is_valid():
+        donation = Donation(amount=commentform.cleaned_data['amount'], timereceived=pytz.utc.localize(datetime.datetime.utcnow()), domain='PAYPAL', domainId=str(random.getrandbits(128)), event=event, testdonation=event.usepaypalsandbox)
+        if commentform.cleaned_data['comment']:
+          donation.comment = commentform.cleaned_data['comment']
+          donation.commentstate = "PENDING"
+        donation.requestedvisibility = commentform.cleaned_data['requestedvisibility']
+        donation.requestedalias = commentform.cleaned_data['requestedalias']
+        donation.requestedemail = commentform.cleaned_data['requestedemail']
+        donation.currency = event.paypalcurrency
+        # custom options are matched (or created) by name under the chosen bid
+        bids = [(form.cleaned_data['bid'], form.cleaned_data['customoptionname'] if form.cleaned_data['bid'].allowuseroptions else None, Decimal(form.cleaned_data['amount'])) for form in bidsform if form.cleaned_data.get('bid')]
+        tickets = [(form.cleaned_data['prize'], Decimal(form.cleaned_data['amount'])) for form in prizesform if form.cleaned_data.get('prize')]
         try:
-          donation = Donation(amount=commentform.cleaned_data['amount'], timereceived=pytz.utc.localize(datetime.datetime.utcnow()), domain='PAYPAL', domainId=str(random.getrandbits(128)), event=event, testdonation=event.usepaypalsandbox)
-          if commentform.cleaned_data['comment']:
-            donation.comment = commentform.cleaned_data['comment']
-            donation.commentstate = "PENDING"
-          donation.requestedvisibility = commentform.cleaned_data['requestedvisibility']
-          donation.requestedalias = commentform.cleaned_data['requestedalias']
-          donation.requestedemail = commentform.cleaned_data['requestedemail']
-          donation.currency = event.paypalcurrency
-          donation.save()
-          for bidform in bidsform:
-            if 'bid' in bidform.cleaned_data and bidform.cleaned_data['bid']:
-              bid = bidform.cleaned_data['bid']
-              if bid.allowuseroptions:
-                # unfortunately, you can't use get_or_create when using a non-atomic transaction
-                # this does technically introduce a race condition, I'm just going to hope that two people don't
-                # suggest the same option at the exact same time
-                # also, I want to do case-insensitive comparison on the name
-                try:
-                  bid = Bid.objects.get(event=bid.event, speedrun=bid.speedrun, name__iexact=bidform.cleaned_data['customoptionname'], parent=bid)
-                except Bid.DoesNotExist:
-                  bid = Bid.objects.create(event=bid.event, speedrun=bid.speedrun, name=bidform.cleaned_data['customoptionname'], parent=bid, state='PENDING', istarget=True)
-              donation.bids.add(DonationBid(bid=bid, amount=Decimal(bidform.cleaned_data['amount'])))
-          for prizeform in prizesform:
-            if 'prize' in prizeform.cleaned_data and prizeform.cleaned_data['prize']:
-              prize = prizeform.cleaned_data['prize']
-              donation.tickets.add(PrizeTicket(prize=prize, amount=Decimal(prizeform.cleaned_data['amount'])))
-          donation.full_clean()
-          donation.save()
-        except Exception as e:
-          transaction.rollback()
-          raise e
-
-        serverURL = viewutil.get_request_server_url(request)
-
-        paypal_dict = {
-          "amount": str(donation.amount),
-          "cmd": "_donations",
-          "business": donation.event.paypalemail,
-          "item_name": donation.event.receivername,
-          "notify_url": serverURL + reverse('tracker.views.ipn'),
-          "return_url": serverURL + reverse('tracker.views.paypal_return'),
-          "cancel_return": serverURL + reverse('tracker.views.paypal_cancel'),
-          "custom": str(donation.id) + ":" + donation.domainId,
-          "currency_code": donation.event.paypalcurrency,
-        }
-        # Create the form instance
-        form = PayPalPaymentsForm(button_type="donate", sandbox=donation.event.usepaypalsandbox, initial=paypal_dict)
-        context = {"event": donation.event, "form": form }
-        return tracker_response(request, "tracker/paypal_redirect.html", context)
+          viewutil.save_donation(donation, bids, tickets)
+        except ValidationError as e:
+          commentform.errors['__all__'] = commentform.error_class(e.messages)
+        else:
+          serverURL = viewutil.get_request_server_url(request)
+
+          paypal_dict = {
+            "amount": str(donation.amount),
+            "cmd": "_donations",
+            "business": donation.event.paypalemail,
+            "item_name": donation.event.receivername,
+            "notify_url": serverURL + reverse('tracker.views.ipn'),
+            "return_url": serverURL + reverse('tracker.views.paypal_return'),
+            "cancel_return": serverURL + reverse('tracker.views.paypal_cancel'),
+            "custom": str(donation.id) + ":" + donation.domainId,
+            "currency_code": donation.event.paypalcurrency,
+          }
+          # Create the form instance
+          form = PayPalPaymentsForm(button_type="donate", sandbox=donation.event.usepaypalsandbox, initial=paypal_dict)
+          context = {"event": donation.event, "form": form }
+          return tracker_response(request, "tracker/paypal_redirect.html", context)
     else:
       bidsform = DonationBidFormSet(amount=Decimal('0.00'), data=request.POST, prefix=bidsFormPrefix)
       prizesform = PrizeTicketFormSet(amount=Decimal('0.00'), data=request.POST, prefix=prizeFormPrefix)
@@ -911,118 +1026,24 @@ def donate(request, event):
     bidsform = DonationBidFormSet(amount=Decimal('0.00'), prefix=bidsFormPrefix)
     prizesform = PrizeTicketFormSet(amount=Decimal('0.00'), prefix=prizeFormPrefix)
 
-  def bid_parent_info(bid):
-    if bid != None:
-      return {'name': bid.name, 'description': bid.description, 'parent': bid_parent_info(bid.parent) }
-    else:
-      return None
-
-  def bid_info(bid):
-    result = {
-      'id': bid.id,
-      'name': bid.name,
-      'description': bid.description,
-      'label': bid.full_label(not bid.allowuseroptions),
-      'count': bid.count,
-      'amount': bid.total,
-      'goal': Decimal(bid.goal or '0.00'),
-      'parent': bid_parent_info(bid.parent)
-    }
-    if bid.speedrun:
-      result['runname'] = bid.speedrun.name
-    if bid.suggestions.exists():
-      result['suggested'] = list(map(lambda x: x.name, bid.suggestions.all()))
-    if bid.allowuseroptions:
-      result['custom'] = ['custom']
-      result['label'] += ' (select and add a name next to "New Option Name")'
-    return result
-
-  bids = filters.run_model_query('bidtarget', {'state':'OPENED', 'event':event.id }, user=request.user).distinct().select_related('parent').prefetch_related('suggestions')
-
-  allPrizes = filters.run_model_query('prize', {'feed': 'current', 'event': event.id })
-
-  prizes = allPrizes.filter(ticketdraw=False)
-
-  dumpArray = [bid_info(o) for o in bids]
-  bidsJson = json.dumps(dumpArray)
-
-  ticketPrizes = allPrizes.filter(ticketdraw=True)
-
-  def prize_info(prize):
-    result = {'id': prize.id, 'name': prize.name, 'description': prize.description, 'minimumbid': prize.minimumbid, 'maximumbid': prize.maximumbid}
-    return result
-
-  dumpArray = [prize_info(o) for o in ticketPrizes.all()]
-  ticketPrizesJson = json.dumps(dumpArray)
-
-  return tracker_response(request, "tracker/donate.html", { 'event': event, 'bidsform': bidsform, 'prizesform': prizesform, 'commentform': commentform, 'hasBids': bids.count() > 0, 'bidsJson': bidsJson, 'hasTicketPrizes': ticketPrizes.count() > 0, 'ticketPrizesJson': ticketPrizesJson, 'prizes': prizes})
+  context = { 'event': event, 'bidsform': bidsform, 'prizesform': prizesform, 'commentform': commentform }
+  context.update(donatepayload.get_payload(event.id).context())
+  return tracker_response(request, "tracker/donate.html", context)
 
 @csrf_exempt
 @never_cache
 def ipn(request):
-  donation = None
-  ipnObj = None
-
   if request.method == 'GET' or len(request.POST) == 0:
     return tracker_response(request, "tracker/badobject.html", {})
 
+  # the IPN is only stored here, verifying and applying it is done by the ipn workers (see ipnqueue)
   try:
-    ipnObj = paypalutil.create_ipn(request)
-    ipnObj.save()
-
-    donation = paypalutil.initialize_paypal_donation(ipnObj)
-    donation.save()
-
-    if donation.transactionstate == 'PENDING':
-      reasonExplanation, ourFault = paypalutil.get_pending_reason_details(ipnObj.pending_reason)
-      if donation.event.pendingdonationemailtemplate:
-        formatContext = {
-          'event': donation.event,
-          'donation': donation,
-          'donor': donor,
-          'pending_reason': ipnObj.pending_reason,
-          'reason_info': reasonExplanation if not ourFault else '',
-        }
-        post_office.mail.send(recipients=[donation.donor.email], sender=donation.event.donationemailsender, template=donation.event.pendingdonationemailtemplate, context=formatContext)
-      # some pending reasons can be a problem with the receiver account, we should keep track of them
-      if ourFault:
-        paypalutil.log_ipn(ipnObj, 'Unhandled pending error')
-    elif donation.transactionstate == 'COMPLETED':
-      if donation.event.donationemailtemplate != None:
-        formatContext = {
-          'donation': donation,
-          'donor': donation.donor,
-          'event': donation.event,
-          'prizes': viewutil.get_donation_prize_info(donation),
-        }
-        post_office.mail.send(recipients=[donation.donor.email], sender=donation.event.donationemailsender, template=donation.event.donationemailtemplate, context=formatContext)
-
-      # TODO: this should eventually share code with the 'search' method, to
-      postbackData = {
-        'id': donation.id,
-        'timereceived': str(donation.timereceived),
-        'comment': donation.comment,
-        'amount': donation.amount,
-        'donor__visibility': donation.donor.visibility,
-        'donor__visiblename': donation.donor.visible_name(),
-      }
-      postbackJSon = json.dumps(postbackData)
-      postbacks = PostbackURL.objects.filter(event=donation.event)
-      for postback in postbacks:
-        opener = urllib2.build_opener()
-        req = urllib2.Request(postback.url, postbackJSon, headers={'Content-Type': 'application/json; charset=utf-8'})
-        response = opener.open(req, timeout=5)
-    elif donation.transactionstate == 'CANCELLED':
-      # eventually we may want to send out e-mail for some of the possible cases
-      # such as payment reversal due to double-transactions (this has happened before)
-      paypalutil.log_ipn(ipnObj, 'Cancelled/reversed payment')
-
+    ipnqueue.ingest(request)
   except Exception as inst:
     print(inst)
     print(traceback.format_exc(inst))
-    if ipnObj:
-      paypalutil.log_ipn(ipnObj, "{0} \n {1}. POST data : {2}".format(inst, traceback.format_exc(inst), request.POST))
-    else:
-      viewutil.tracker_log('paypal', 'IPN creation failed: {0} \n {1}. POST data : {2}'.format(inst, traceback.format_exc(inst), request.POST))
+    viewutil.tracker_log('paypal', 'IPN creation failed: {0} \n {1}. POST data : {2}'.format(inst, traceback.format_exc(inst), request.POST))
+    # we couldn't even store it, so let PayPal send it again later
+    return HttpResponse("ERROR", status=500)
 
   return HttpResponse("OKAY")
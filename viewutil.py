@@ -1,8 +1,15 @@
 from tracker.models import *
-import filters
+import cacheutil
+import scheduleindex
+# not used here, but their signal handlers have to be connected in every
+# process that changes donations and bids (the ipn workers included)
+import livefeed
+import bidforest
 from django.db.models import Count,Sum,Max,Avg,Q
+from django.db import transaction
 from django.core.urlresolvers import reverse
 from django.http import Http404
+from django.core.exceptions import ValidationError
 from django.utils.safestring import mark_safe
 from django.contrib.auth import get_user_model
 from django.utils.http import urlsafe_base64_encode
@@ -10,13 +17,14 @@ from django.contrib.auth.tokens import default_token_generator
 from django.utils.encoding import force_bytes
 from decimal import Decimal
 import random
+import bisect
 import httplib2
 from oauth2client.file import Storage
 import gdata.spreadsheet.service
 import settings
 import datetime
 import dateutil.parser
-import operator
+import csv
 import re
 import pytz
 import post_office.mail
@@ -52,6 +60,21 @@ def get_event(event):
   e.name = 'All Events'
   return e
 
+def get_user_profile(user):
+  try:
+    return user.get_profile()
+  except UserProfile.DoesNotExist:
+    profile = UserProfile(user=user)
+    profile.save()
+    return profile
+
+# The template prefix of the user's profile, cached so pages don't load the
+# profile just to pick their template
+def user_prepend(user):
+  if not user.is_authenticated():
+    return ''
+  return cacheutil.get_or_compute(cacheutil.profile_namespace(user.id), 'prepend', lambda: get_user_profile(user).prepend)
+
 # Parses a 'natural language' list, i.e. seperated by commas, semi-colons, and 'and's
 def natural_list_parse(s):
   result = []
@@ -75,9 +98,66 @@ def request_params(request):
   else:
     raise Exception("No request parameters associated with this request method.")
 
-def draw_prize(prize, seed=None):
-  eligible = prize.eligible_donors()
-  if prize.maxed_winners():
+# A weighted pool of donors to draw from, kept in a Fenwick tree so that both
+# picking a donor (a binary search over the cumulative weights) and taking a
+# winner out of the pool are O(log n), no matter how many entrants there are
+class WeightedPool(object):
+  def __init__(self, entries):
+    self.donors = [e['donor'] for e in entries]
+    self.weights = [e['weight'] for e in entries]
+    self.total = 0.0
+    self.remaining = sum(1 for weight in self.weights if weight > 0)
+    self.tree = [0.0] * (len(self.weights) + 1)
+    for i, weight in enumerate(self.weights):
+      self.total += weight
+      self._add(i, weight)
+  def _add(self, i, delta):
+    i += 1
+    while i < len(self.tree):
+      self.tree[i] += delta
+      i += i & -i
+  def __len__(self):
+    return self.remaining
+  # the index of the first entry whose cumulative weight exceeds value
+  def find(self, value):
+    pos = 0
+    step = 1
+    while step * 2 < len(self.tree):
+      step *= 2
+    while step:
+      if pos + step < len(self.tree) and self.tree[pos + step] <= value:
+        pos += step
+        value -= self.tree[pos]
+      step //= 2
+    # rounding can land a value on an entry that was already taken out (or past
+    # the end of the range), in which case the nearest remaining entry is used
+    pos = min(pos, len(self.weights) - 1)
+    while pos > 0 and self.weights[pos] <= 0:
+      pos -= 1
+    while self.weights[pos] <= 0:
+      pos += 1
+    return pos
+  def draw(self, rand):
+    result = rand.random() * self.total
+    return self.find(result), result
+  def remove(self, i):
+    self._add(i, -self.weights[i])
+    self.total -= self.weights[i]
+    self.weights[i] = 0.0
+    self.remaining -= 1
+  # the next winner for the prize: a weighted pick for a random draw, otherwise
+  # the first entry still in the pool, as those come ranked by amount
+  def draw_for(self, prize, rand):
+    if prize.randomdraw:
+      return self.draw(rand)
+    return self.find(0.0), 0.0
+
+# Draws up to 'count' winners for the prize (never more than its open slots),
+# computing the eligible donors only once for all of them
+def draw_prize(prize, seed=None, count=1):
+  eligible = prize.weighted_entries(prize.eligible_donor_amounts())
+  openSlots = prize.maxwinners - len(prize.get_winners())
+  if openSlots <= 0:
     if prize.maxwinners == 1:
       return False, { "error" : "Prize: " + prize.name + " already has a winner." }
     else:
@@ -90,20 +170,171 @@ def draw_prize(prize, seed=None):
       rand = random.Random(seed)
     except TypeError: # not sure how this could happen but hey
       return False, {'error': 'Seed parameter was unhashable'}
-    psum = reduce(lambda a,b: a+b['weight'], eligible, 0.0)
-    result = rand.random() * psum
-    ret = {'sum': psum, 'result': result}
-    for d in eligible:
-      if result < d['weight']:
-        try:
-          winRecord = PrizeWinner.objects.create(prize=prize, winner=Donor.objects.get(pk=d['donor']))
-          ret['winner'] = winRecord.winner.id
-          winRecord.save()
-        except Exception as e:
-          return False, { "error" : "Error drawing prize: " + prize.name + ", " + str(e) }
-        return True, ret
-      result -= d['weight']
-    return False, {"error" : "Prize drawing algorithm failed." }
+    pool = WeightedPool(eligible)
+    ret = {'sum': pool.total, 'winners': []}
+    for i in range(min(count, openSlots)):
+      if not len(pool):
+        break
+      index, result = pool.draw_for(prize, rand)
+      try:
+        winRecord = PrizeWinner.objects.create(prize=prize, winner_id=pool.donors[index])
+      except Exception as e:
+        return False, { "error" : "Error drawing prize: " + prize.name + ", " + str(e) }
+      pool.remove(index)
+      if not ret['winners']:
+        ret['result'] = result
+        ret['winner'] = winRecord.winner_id
+      ret['winners'].append(winRecord.winner_id)
+    return True, ret
+
+# Everything needed to work out prize eligibility for one event, loaded with a
+# handful of queries up front so that any number of prizes can be drawn from it
+class PrizeDrawData(object):
+  def __init__(self, event, prizes):
+    donations = Donation.objects.filter(event=event, transactionstate='COMPLETED', donor__isnull=False).order_by('timereceived')
+    self.donations = list(donations.values_list('timereceived', 'donor', 'amount'))
+    self.times = [d[0] for d in self.donations]
+    prizeIds = [prize.id for prize in prizes]
+    self.tickets = {}
+    tickets = PrizeTicket.objects.filter(prize__in=prizeIds, donation__event=event, donation__transactionstate='COMPLETED', donation__donor__isnull=False)
+    for prizeId, donorId, donationId, amount in tickets.order_by().values_list('prize', 'donation__donor', 'donation').annotate(amount=Sum('amount')):
+      self.tickets.setdefault(prizeId, []).append((donorId, amount))
+    self.entries = {}
+    for prizeId, donorId, weight in DonorPrizeEntry.objects.filter(prize__in=prizeIds).values_list('prize', 'donor', 'weight'):
+      self.entries.setdefault(prizeId, []).append((donorId, weight))
+    self.prizeWinners = {}
+    self.categoryWinners = {}
+    self.openWinners = {}
+    for prizeId, categoryId, donorId, acceptState in PrizeWinner.objects.filter(prize__event=event).values_list('prize', 'prize__category', 'winner', 'acceptstate'):
+      self.add_winner(prizeId, categoryId, donorId)
+      if acceptState in ('PENDING', 'ACCEPTED'):
+        self.openWinners[prizeId] = self.openWinners.get(prizeId, 0) + 1
+  def add_winner(self, prizeId, categoryId, donorId):
+    self.prizeWinners.setdefault(prizeId, set()).add(donorId)
+    self.categoryWinners.setdefault(categoryId, set()).add(donorId)
+  # the same rules as Prize.eligible_donor_amounts, applied to the preloaded data
+  def eligible_donor_amounts(self, prize):
+    excluded = self.prizeWinners.get(prize.id, set()) | self.categoryWinners.get(prize.category_id, set())
+    if prize.ticketdraw:
+      rows = self.tickets.get(prize.id, [])
+    elif prize.has_draw_time():
+      start = bisect.bisect_left(self.times, prize.start_draw_time())
+      end = bisect.bisect_right(self.times, prize.end_draw_time())
+      rows = [d[1:] for d in self.donations[start:end]]
+    else:
+      rows = [d[1:] for d in self.donations]
+    donors = {}
+    for donorId, amount in rows:
+      if donorId in excluded:
+        continue
+      if prize.sumdonations:
+        donors[donorId] = donors.get(donorId, Decimal('0.0')) + amount
+      else:
+        donors[donorId] = max(amount, donors.get(donorId, Decimal('0.0')))
+    for donorId, weight in self.entries.get(prize.id, []):
+      if donorId in self.prizeWinners.get(prize.id, set()):
+        continue
+      donors[donorId] = max(weight*prize.minimumbid, donors.get(donorId, Decimal('0.0')))
+      if prize.maximumbid:
+        donors[donorId] = min(donors[donorId], prize.maximumbid)
+    return donors
+
+# Draws every open winner slot of the given prizes in one pass. Eligibility is
+# computed from data loaded once per event, a donor who wins a prize is ruled
+# out of every other prize in the same category for the rest of the batch, and
+# all PrizeWinner rows are written together in a single transaction. The same
+# seed on the same data always gives the same winners; it is returned together
+# with the audit log entry so a drawing can be checked afterwards.
+def draw_prize_batch(prizes, seed=None, user=None):
+  if seed is None:
+    seed = random.SystemRandom().getrandbits(32)
+  rand = random.Random(seed)
+  prizes = sorted(prizes, key=lambda prize: prize.id)
+  winners = []
+  errors = {}
+  drawData = {}
+  for prize in prizes:
+    if prize.event_id not in drawData:
+      drawData[prize.event_id] = PrizeDrawData(prize.event, [p for p in prizes if p.event_id == prize.event_id])
+    data = drawData[prize.event_id]
+    openSlots = prize.maxwinners - data.openWinners.get(prize.id, 0)
+    if openSlots <= 0:
+      if prize.maxwinners == 1:
+        errors[prize.id] = "Prize: " + prize.name + " already has a winner."
+      else:
+        errors[prize.id] = "Prize: " + prize.name + " already has the maximum number of winners allowed."
+      continue
+    pool = WeightedPool(prize.weighted_entries(data.eligible_donor_amounts(prize)))
+    for i in range(openSlots):
+      if not len(pool):
+        errors[prize.id] = "Prize: " + prize.name + " has no eligible donors."
+        break
+      index, result = pool.draw_for(prize, rand)
+      pool.remove(index)
+      data.add_winner(prize.id, prize.category_id, pool.donors[index])
+      winners.append(PrizeWinner(prize=prize, winner_id=pool.donors[index]))
+  audit = u'Drew %d winner(s) for %d prize(s) with seed %d' % (len(winners), len(prizes), seed)
+  if winners:
+    audit += u': ' + u', '.join(u'prize %d -> donor %d' % (w.prize_id, w.winner_id) for w in winners)
+  with transaction.atomic():
+    PrizeWinner.objects.bulk_create(winners)
+    log = tracker_log(u'prize', audit, event=prizes[0].event if len(drawData) == 1 else None, user=user)
+  # bulk_create sends no signals, drawn prizes are no longer current
+  for eventId in set(winner.prize.event_id for winner in winners):
+    scheduleindex.invalidate(eventId)
+    cacheutil.invalidate_index(eventId)
+  return { 'seed': seed, 'winners': winners, 'errors': errors, 'log': log }
+
+# The custom options named for the given (parent, name) pairs, as a dict keyed
+# the same way. Existing options are matched by name regardless of case, and
+# the rest are created as pending. The parents are locked first, so two
+# donations suggesting the same name at once end up with one option. Has to run
+# in a transaction.
+def resolve_custom_options(requested):
+  parents = dict((parent.id, parent) for parent, name in requested)
+  list(Bid.objects.select_for_update().filter(pk__in=parents.keys()).values_list('pk', flat=True))
+  existing = {}
+  for option in Bid.objects.filter(parent__in=parents.keys()):
+    existing[(option.parent_id, option.name.lower())] = option
+  resolved = {}
+  for parent, name in requested:
+    key = (parent.id, name.lower())
+    if key not in existing:
+      existing[key] = Bid.objects.create(event=parent.event, speedrun=parent.speedrun, name=name, parent=parent, state='PENDING', istarget=True)
+    resolved[(parent, name)] = existing[key]
+  return resolved
+
+_SameBidTwice = 'Cannot bid more than once for the same bid in the same donation.'
+
+# Saves a new (pending) donation from the donate page together with its bids,
+# given as (bid, custom option name or None, amount), and its prize tickets,
+# given as (prize, amount). Everything is checked before anything is written,
+# then the donation and all its rows go in one transaction, the rows with a
+# single insert per model. bulk_create sends no signals, which is only right as
+# long as the donation doesn't count towards any totals yet.
+def save_donation(donation, bids, tickets):
+  for bid, customName, amount in bids:
+    if not customName and not bid.is_leaf_node():
+      raise ValidationError('Target bid must be a leaf node')
+  for prize, amount in tickets:
+    if not prize.ticketdraw:
+      raise ValidationError('Cannot assign tickets to non-ticket prize')
+  bidIds = [bid.id for bid, customName, amount in bids if not customName]
+  if len(set(bidIds)) != len(bidIds):
+    raise ValidationError(_SameBidTwice)
+  donation.check_totals([amount for bid, customName, amount in bids], [amount for prize, amount in tickets])
+  donation.full_clean()
+  with livefeed.deferred(), transaction.atomic():
+    custom = resolve_custom_options([(bid, customName) for bid, customName, amount in bids if customName])
+    # the options named are only known now, a name can turn out to be one of the other bids
+    targets = [custom[(bid, customName)] if customName else bid for bid, customName, amount in bids]
+    if len(set(target.id for target in targets)) != len(targets):
+      raise ValidationError(_SameBidTwice)
+    donation.save()
+    rows = [DonationBid(donation=donation, bid=target, amount=amount) for target, (bid, customName, amount) in zip(targets, bids)]
+    DonationBid.objects.bulk_create(rows)
+    PrizeTicket.objects.bulk_create([PrizeTicket(donation=donation, prize=prize, amount=amount) for prize, amount in tickets])
+  return donation
 
 _1ToManyBidsAggregateFilter = Q(bids__donation__transactionstate='COMPLETED')
 _1ToManyDonationAggregateFilter = Q(donation__transactionstate='COMPLETED')
@@ -113,38 +344,73 @@ EventAggregateFilter = _1ToManyDonationAggregateFilter
 PrizeWinnersFilter = Q(prizewinner__acceptstate='ACCEPTED') | Q(prizewinner__acceptstate='PENDING')
 
 # http://stackoverflow.com/questions/5722767/django-mptt-get-descendants-for-a-list-of-nodes
+# The helpers below turn a set of MPTT nodes into one filter over as few
+# predicates as possible: nodes are grouped by tree, nested ranges collapse
+# into the outermost one, and trees that are wanted whole become a single
+# tree_id__in. Nodes may be model instances or a queryset of them.
+def _tree_nodes(nodes):
+  if hasattr(nodes, 'values_list'):
+    return list(nodes.values_list('tree_id', 'lft', 'rght', 'parent'))
+  return [(n.tree_id, n.lft, n.rght, n.parent_id) for n in nodes]
+
+# the outermost (lft, rght) ranges of the nodes, per tree
+def _tree_ranges(nodes):
+  trees = {}
+  for tree_id, lft, rght, parent in nodes:
+    trees.setdefault(tree_id, []).append((lft, rght))
+  for tree_id, ranges in trees.items():
+    merged = []
+    for lft, rght in sorted(ranges):
+      # MPTT ranges in one tree are either nested or disjoint
+      if merged and lft < merged[-1][1]:
+        continue
+      merged.append((lft, rght))
+    trees[tree_id] = merged
+  return trees
+
 def get_tree_queryset_descendants(model, nodes, include_self=False):
+  nodes = _tree_nodes(nodes)
   if not nodes:
-    return nodes
-  filters = []
-  for n in nodes:
-    lft, rght = n.lft, n.rght
-    if include_self:
-      lft -=1
-      rght += 1
-    filters.append(Q(tree_id=n.tree_id, lft__gt=lft, rght__lt=rght))
-  q = reduce(operator.or_, filters)
+    return model.objects.none()
+  wholeTrees = []
+  q = Q()
+  for tree_id, ranges in _tree_ranges(nodes).items():
+    if include_self and ranges[0][0] == 1:
+      # the root itself, that's everything in the tree
+      wholeTrees.append(tree_id)
+    else:
+      for lft, rght in ranges:
+        if include_self:
+          q |= Q(tree_id=tree_id, lft__gte=lft, rght__lte=rght)
+        else:
+          q |= Q(tree_id=tree_id, lft__gt=lft, rght__lt=rght)
+  if wholeTrees:
+    q |= Q(tree_id__in=wholeTrees)
   return model.objects.filter(q).order_by(*model._meta.ordering)
 
 # http://stackoverflow.com/questions/6471354/efficient-function-to-retrieve-a-queryset-of-ancestors-of-an-mptt-queryset
 def get_tree_queryset_ancestors(model, nodes):
-  tree_list = {}
-  query = Q()
-  for node in nodes:
-    if node.tree_id not in tree_list:
-      tree_list[node.tree_id] = []
-    parent =  node.parent.pk if node.parent is not None else None,
-    if parent not in tree_list[node.tree_id]:
-      tree_list[node.tree_id].append(parent)
-      query |= Q(lft__lt=node.lft, rght__gt=node.rght, tree_id=node.tree_id)
-    return model.objects.filter(query).order_by(*model._meta.ordering)
+  nodes = sorted(_tree_nodes(nodes))
+  q = Q()
+  seen = set()
+  for i, (tree_id, lft, rght, parent) in enumerate(nodes):
+    if parent is None or (tree_id, parent) in seen:
+      # roots have no ancestors, and siblings all have the same ones
+      continue
+    if i + 1 < len(nodes) and nodes[i + 1][0] == tree_id and nodes[i + 1][1] < rght:
+      # the next node sits below this one, its ancestors include this node's
+      continue
+    seen.add((tree_id, parent))
+    q |= Q(tree_id=tree_id, lft__lt=lft, rght__gt=rght)
+  if not q:
+    return model.objects.none()
+  return model.objects.filter(q).order_by(*model._meta.ordering)
 
 def get_tree_queryset_all(model, nodes):
-  filters = []
-  for node in nodes:
-    filters.append(Q(tree_id=node.tree_id))
-  q = reduce(operator.or_, filters)
-  return model.objects.filter(q).order_by(*model._meta.ordering)
+  treeIds = set(node[0] for node in _tree_nodes(nodes))
+  if not treeIds:
+    return model.objects.none()
+  return model.objects.filter(tree_id__in=treeIds).order_by(*model._meta.ordering)
 
 ModelAnnotations = {
   'event'        : { 'amount': Sum('donation__amount', only=EventAggregateFilter), 'count': Count('donation', only=EventAggregateFilter), 'max': Max('donation__amount', only=EventAggregateFilter), 'avg': Avg('donation__amount', only=EventAggregateFilter) },
@@ -152,29 +418,20 @@ ModelAnnotations = {
 }
 
 def parse_gdoc_cell_title(title):
-  digit = re.search("\d", title)
-  if not digit:
+  # 'AB12' is column 27, row 11 (counting from 0)
+  letters = title.rstrip('0123456789')
+  digits = title[len(letters):]
+  if not digits:
     return None
-  letters = title[:digit.start()]
-  digits = title[digit.start():]
   columnIdx = 0
   for letter in letters:
-    if not re.match("[A-Z]", letter):
+    if not 'A' <= letter <= 'Z':
       return None
     columnIdx *= 26
     columnIdx += ord(letter) - ord('A')
   rowIdx = int(digits) - 1
   return columnIdx, rowIdx
 
-def parse_gdoc_cell_headers(cells):
-  headers = {}
-  for cell in cells.entry:
-    col,row = parse_gdoc_cell_title(cell.title.text)
-    if row > 0:
-      break
-    headers[col] = cell.content.text.strip().lower()
-  return headers
-
 def make_empty_row(headers):
   row = {}
   for col in headers:
@@ -182,12 +439,13 @@ def make_empty_row(headers):
   return row
 
 def parse_gdoc_cells_as_list(cells):
-  headers = parse_gdoc_cell_headers(cells)
+  # every title is parsed once, the header row comes first in the feed
+  positions = [(parse_gdoc_cell_title(cell.title.text), cell) for cell in cells.entry]
+  headers = dict((col, cell.content.text.strip().lower()) for (col, row), cell in positions if row == 0)
   currentRowId = 0
   currentRow = make_empty_row(headers)
   rows = []
-  for cell in cells.entry:
-    col,row = parse_gdoc_cell_title(cell.title.text)
+  for (col, row), cell in positions:
     if row == 0:
       continue
     if row != currentRowId and currentRowId != 0:
@@ -200,6 +458,23 @@ def parse_gdoc_cells_as_list(cells):
     rows.append(currentRow)
   return rows
 
+# The same rows from a CSV file (or any iterable of lines) with the column
+# names in its first line, for merging a schedule without the spreadsheet
+def parse_csv_as_list(lines):
+  headers = None
+  rows = []
+  for cells in csv.reader(lines):
+    cells = [cell.decode('utf-8') for cell in cells]
+    if headers is None:
+      headers = [header.strip().lower() for header in cells]
+      continue
+    if not any(cell.strip() for cell in cells):
+      continue
+    row = make_empty_row(dict(enumerate(headers)))
+    row.update(zip(headers, cells))
+    rows.append(row)
+  return rows
+
 def find_people(people_list):
   result = []
   for person in people_list:
@@ -263,68 +538,91 @@ def parse_row_entry(event, rowEntries):
   ret = MarathonSpreadSheetEntry(gameName, startTime, estimatedTime+postGameSetup, runners, commentators, comments)
   return ret
 
-
-def prizecmp(a,b):
-  # if both prizes are run-linked, sort them that way
-  if a.startrun and b.startrun:
-    return cmp(a.startrun.starttime,b.startrun.starttime) or cmp(a.endrun.endtime,b.endrun.endtime) or cmp(a.name,b.name)
-  # else if they're both time-linked, sort them that way
-  if a.starttime and b.starttime:
-    return cmp(a.starttime,b.starttime) or cmp(a.endtime,b.endtime) or cmp(a.name,b.name)
-  # run-linked prizes are listed after time-linked and non-linked
-  if a.startrun and not b.startrun:
-    return 1
-  if b.startrun and not a.startrun:
-    return -1
-  # time-linked prizes are listed after non-linked
-  if a.starttime and not b.starttime:
-    return 1
-  if b.starttime and not a.starttime:
-    return -1
-  # sort by category or name as a fallback
-  return cmp(a.category,b.category) or cmp(a.name,b.name)
-
-def merge_schedule_list(event, scheduleList):
+# What merging a schedule changes: runs to insert (not saved yet), runs to
+# update together with the values that differ, and runs to delete. The runs
+# that stay as they are only get counted.
+class ScheduleDiff(object):
+  def __init__(self):
+    self.inserts = []
+    self.updates = []
+    self.deletes = []
+    self.unchanged = 0
+  # the number of runs in the merged schedule
+  def __len__(self):
+    return len(self.inserts) + len(self.updates) + self.unchanged
+  def has_changes(self):
+    return bool(self.inserts or self.updates or self.deletes)
+  def summary(self):
+    return {
+      'inserted': [run.name for run in self.inserts],
+      'updated': [{'name': run.name, 'fields': sorted(changes.keys())} for run, changes in self.updates],
+      'deleted': [run.name for run in self.deletes],
+      'unchanged': self.unchanged,
+    }
+
+# the fields a schedule sets on its runs, the description only on new ones
+_ScheduleRunFields = ('name', 'deprecated_runners', 'starttime', 'endtime')
+
+def _schedule_value(value):
+  # times may come back from the database without a zone, they are in UTC
+  if isinstance(value, datetime.datetime) and value.tzinfo is None:
+    return value.replace(tzinfo=pytz.utc)
+  return value
+
+def parse_schedule_list(event, scheduleList):
   try:
-    runs = filter(lambda r: r != None, map(lambda x: parse_row_entry(event, x), scheduleList))
+    return filter(lambda r: r != None, map(lambda x: parse_row_entry(event, x), scheduleList))
   except KeyError, k:
     raise Exception('KeyError, \'%s\' make sure the column names are correct' % k.args[0])
-  existingruns = dict(map(lambda r: (r.name.lower(),r),SpeedRun.objects.filter(event=event)))
 
+# Compares MarathonSpreadSheetEntry rows with the event's runs (matched by
+# name, regardless of case), with a single query
+def diff_schedule(event, entries):
+  existingRuns = dict((run.name.lower(), run) for run in SpeedRun.objects.filter(event=event))
   scheduleRunNames = set()
-  addedRuns = []
-
-  for run in runs:
-    uniqueGameName = run.gamename.lower()
+  diff = ScheduleDiff()
+  for entry in entries:
+    uniqueGameName = entry.gamename.lower()
     if uniqueGameName in scheduleRunNames:
       raise Exception('Merged schedule has two runs with the same name \'%s\'' % uniqueGameName)
     scheduleRunNames.add(uniqueGameName)
-    if uniqueGameName in existingruns.keys():
-      r = existingruns[uniqueGameName]
+    values = { 'name': entry.gamename, 'deprecated_runners': entry.runners, 'starttime': entry.starttime, 'endtime': entry.endtime }
+    existing = existingRuns.get(uniqueGameName)
+    if existing is None:
+      diff.inserts.append(SpeedRun(event=event, description=entry.comments, **values))
+      continue
+    changes = dict((field, values[field]) for field in _ScheduleRunFields if _schedule_value(getattr(existing, field)) != values[field])
+    if changes:
+      diff.updates.append((existing, changes))
     else:
-      r = SpeedRun(name=run.gamename, event=event, description=run.comments)
-      addedRuns.append(r)
-    r.name = run.gamename
-    r.deprecated_runners = run.runners
-    #for runner in run.runners:
-    #  r.runners.add(runner)
-    r.starttime = run.starttime
-    r.endtime = run.endtime
-    r.save()
-
-  removedRuns = []
-
-  for existingRunName, existingRun in existingruns.items():
-    if existingRunName not in scheduleRunNames:
-      removedRuns.append(existingRun)
-
+      diff.unchanged += 1
   # Eventually we may want to have something that asks for user descisions regarding runs added/removed
   # from the schdule, for now, we take the schedule as cannon
-  for run in removedRuns:
-    run.delete()
+  diff.deletes = [run for name, run in existingRuns.items() if name not in scheduleRunNames]
+  return diff
+
+# Writes the diff in one transaction: one DELETE, one UPDATE per changed run
+# and one INSERT. None of these send the runs' save signals, so the caches
+# built from runs are dropped here.
+def apply_schedule_diff(event, diff):
+  if not diff.has_changes():
+    return diff
+  with transaction.atomic():
+    if diff.deletes:
+      SpeedRun.objects.filter(pk__in=[deleted.id for deleted in diff.deletes]).delete()
+    for run, changes in diff.updates:
+      SpeedRun.objects.filter(pk=run.id).update(**changes)
+    SpeedRun.objects.bulk_create(diff.inserts)
+  scheduleindex.invalidate(event.id)
+  cacheutil.invalidate_index(event.id)
+  bidforest.invalidate(event.id)
+  return diff
 
-  prizes = sorted(Prize.objects.filter(event=event),cmp=prizecmp)
-  return len(runs)
+def merge_schedule_list(event, scheduleList):
+  return apply_schedule_diff(event, diff_schedule(event, parse_schedule_list(event, scheduleList)))
+
+def merge_schedule_csv(event, lines):
+  return merge_schedule_list(event, parse_csv_as_list(lines))
 
 def merge_schedule_gdoc(event, username=None):
   # This is required by the gdoc api to identify the name of the application making the request, but it can basically be any string
@@ -356,30 +654,28 @@ def set_selected_event(request, event):
   else:
     request.session[EVENT_SELECT] = None
 
-def get_donation_prize_contribution(prize, donation, secondaryAmount=None):
-  if prize.contains_draw_time(donation.timereceived):
-    amount = secondaryAmount if secondaryAmount != None else donation.amount
-    if prize.sumdonations or amount >= prize.minimumbid:
-      return amount
-  return None
-
-def get_donation_prize_info(donation):
+def get_donation_prize_info(donation, tickets=None):
   """ Attempts to find a list of all prizes this donation gives the donor eligibility for.
     Does _not_ attempt to relate this information to any _past_ eligibility.
-    Returns the set as a list of {'prize','amount'} dictionaries. """
-  prizeList = []
-  for ticket in donation.tickets.all():
-    contribAmount = get_donation_prize_contribution(ticket.prize, donation, ticket.amount)
-    if contribAmount != None:
-      prizeList.append({'prize': ticket.prize, 'amount': contribAmount})
-  for timeprize in filters.run_model_query( 'prize', params={ 'feed': 'current', 'ticketdraw': False, 'offset': donation.timereceived, 'noslice': True } ):
-    contribAmount = get_donation_prize_contribution(timeprize, donation)
-    if contribAmount != None:
-      prizeList.append({'prize': timeprize, 'amount': contribAmount})
-  return prizeList
+    Returns the set as a list of {'prize','amount'} dictionaries.
+    Pass the donation's tickets as (prize id, amount) pairs if they are already known. """
+  if tickets is None:
+    tickets = donation.tickets.values_list('prize', 'amount')
+  return scheduleindex.get_prize_eligibility(donation.event_id).donation_prizes(donation, tickets)
+
+def annotate_donation_prizes(donations):
+  """ Sets 'prizeinfo' on each of the donations to what get_donation_prize_info would
+    return for it, with a single query for all of their tickets. """
+  donations = list(donations)
+  tickets = {}
+  for donationId, prizeId, amount in PrizeTicket.objects.filter(donation__in=[donation.id for donation in donations]).values_list('donation', 'prize', 'amount'):
+    tickets.setdefault(donationId, []).append((prizeId, amount))
+  for donation in donations:
+    donation.prizeinfo = get_donation_prize_info(donation, tickets.get(donation.id, []))
+  return donations
 
 def tracker_log(category, message='', event=None, user=None):
-  Log.objects.create(category=category, message=message, event=event, user=user)
+  return Log.objects.create(category=category, message=message, event=event, user=user)
 
 def merge_bids(rootBid, bids):
   for bid in bids:
@@ -394,6 +690,44 @@ def merge_bids(rootBid, bids):
   rootBid.save()
   return rootBid
 
+# Recomputes every bid total from scratch (deepest bids first, so parents aggregate up to date children).
+# Day to day totals are maintained incrementally by propagate_bid_delta, this is the repair path.
+def rebuild_bid_totals(event=None):
+  bids = Bid.objects.all()
+  if event:
+    bids = bids.filter(Q(event=event) | Q(speedrun__event=event))
+  for bid in bids.order_by('-level'):
+    bid.update_total()
+    Bid.objects.filter(pk=bid.pk).update(total=bid.total, count=bid.count, state=bid.state)
+  cacheutil.invalidate_index(event.id if event else None)
+  for eventId in ([event.id] if event else Event.objects.values_list('id', flat=True)):
+    bidforest.invalidate(eventId)
+
+def _donor_cache_rows(donations, event):
+  rows = donations.order_by().values('donor').annotate(total=Sum('amount'), count=Count('amount'), max=Max('amount'), avg=Avg('amount'))
+  return [DonorCache(event=event, donor_id=row['donor'], donation_total=row['total'], donation_count=row['count'], donation_max=row['max'], donation_avg=Decimal(str(row['avg'])).quantize(Decimal('0.01'))) for row in rows]
+
+# Recomputes the donor cache with one GROUP BY per scope, for migrations and repairs.
+# Normal saves keep it up to date incrementally (see DonorCache.donation_update)
+def rebuild_donor_cache(event=None):
+  completed = Donation.objects.filter(transactionstate='COMPLETED', donor__isnull=False)
+  if event:
+    eventDonors = Donation.objects.filter(event=event, donor__isnull=False).order_by().values('donor')
+    DonorCache.objects.filter(Q(event=event) | Q(event=None, donor__in=eventDonors)).delete()
+    rows = _donor_cache_rows(completed.filter(event=event), event)
+    rows += _donor_cache_rows(completed.filter(donor__in=eventDonors), None)
+  else:
+    DonorCache.objects.all().delete()
+    rows = _donor_cache_rows(completed, None)
+    perEvent = completed.order_by().values('donor', 'event').annotate(total=Sum('amount'), count=Count('amount'), max=Max('amount'), avg=Avg('amount'))
+    rows += [DonorCache(event_id=row['event'], donor_id=row['donor'], donation_total=row['total'], donation_count=row['count'], donation_max=row['max'], donation_avg=Decimal(str(row['avg'])).quantize(Decimal('0.01'))) for row in perEvent]
+  DonorCache.objects.bulk_create(rows, batch_size=500)
+  if event:
+    cacheutil.invalidate_index(event.id)
+  else:
+    cacheutil.invalidate_all_indexes()
+  return len(rows)
+
 def merge_donors(rootDonor, donors):
   for other in donors:
     if other != rootDonor: